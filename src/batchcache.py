@@ -0,0 +1,97 @@
+# Copyright (C) 2018 Metatavu Oy
+# 
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+# 
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import time
+from concurrent.futures import Future
+from logging import error
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+from serverconnection import ServerConnection
+
+
+class BatchNameCache:
+    """Device-side cache of batch code to batch name.
+
+    Entries older than `ttl` seconds are still returned, so the operator
+    sees a name at once, and the caller refreshes them in the background.
+    Refresh listeners are called with the code and name whenever a
+    refreshed name arrives.
+    """
+    _server_connection: ServerConnection
+    _ttl: float
+    _clock: Callable[[], float]
+    _entries: Dict[str, Tuple[str, float]]
+    _refreshing: Set[str]
+    _refresh_listeners: List[Callable[[str, str], None]]
+
+    def __init__(self,
+                 server_connection: ServerConnection,
+                 ttl: float = 300.0,
+                 clock: Callable[[], float] = time.monotonic) -> None:
+        self._server_connection = server_connection
+        self._ttl = ttl
+        self._clock = clock
+        self._entries = {}
+        self._refreshing = set()
+        self._refresh_listeners = []
+
+    def add_refresh_listener(
+            self,
+            listener: Callable[[str, str], None]) -> None:
+        self._refresh_listeners.append(listener)
+
+    def warm(self, limit: int) -> None:
+        """Fetches the names of the most recently used batches."""
+        def on_batches(batches: 'Future[List[Tuple[str, str]]]') -> None:
+            if batches.exception() is not None:
+                error(f"Prefetching batch names failed: {batches.exception()!r}")
+                return
+            for code, name in batches.result():
+                self.put(code, name)
+        self._server_connection.fetch_recent_batches(limit) \
+            .add_done_callback(on_batches)
+
+    def put(self, batch_code: str, batch_name: str) -> None:
+        self._entries[batch_code] = (batch_name, self._clock())
+
+    def lookup(self, batch_code: str) -> Optional[Tuple[str, bool]]:
+        """Returns the cached name and whether it is older than the TTL."""
+        entry = self._entries.get(batch_code)
+        if entry is None:
+            return None
+        name, fetched = entry
+        return name, self._clock() - fetched > self._ttl
+
+    def refresh(self, batch_code: str) -> None:
+        if batch_code in self._refreshing:
+            return
+        self._refreshing.add(batch_code)
+        def on_name(name: 'Future[Optional[str]]') -> None:
+            self._refreshing.discard(batch_code)
+            if name.exception() is not None:
+                error(f"Refreshing batch name failed: {name.exception()!r}")
+                return
+            result = name.result()
+            if result is None:
+                self._entries.pop(batch_code, None)
+                result = ""
+            else:
+                self.put(batch_code, result)
+            for listener in self._refresh_listeners:
+                listener(batch_code, result)
+        self._server_connection.fetch_batch_name(batch_code) \
+            .add_done_callback(on_name)
+
+# vim: tw=80 sw=4 ts=4 expandtab:
@@ -0,0 +1,82 @@
+# Copyright (C) 2018 Metatavu Oy
+# 
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+# 
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Associates batch codes with batch names from a CSV file.
+
+    python batchimport.py tcp://server:5555 cards.csv
+
+Each row holds a card code and a batch name. A header row is skipped if
+its first cell is "code".
+"""
+
+import csv
+import sys
+from typing import Iterable, Iterator, List, TextIO, Tuple
+
+from serverconnection import ServerConnection
+
+CODE_LENGTH = 10
+
+# A large file takes a while to apply, and is not resent in case it was.
+IMPORT_TIMEOUT = 600.0
+
+
+class BatchImportError(Exception):
+    pass
+
+
+def read_batches(lines: Iterable[str]) -> Iterator[Tuple[str, str]]:
+    """Yields (code, name) pairs from CSV lines, one row at a time."""
+    for row_number, row in enumerate(csv.reader(lines, skipinitialspace=True), 1):
+        if not row or not "".join(row).strip():
+            continue
+        if row_number == 1 and row[0].strip().lower() == "code":
+            continue
+        if len(row) < 2:
+            raise BatchImportError(f"Row {row_number}: expected code and name")
+        code, name = row[0].strip(), row[1].strip()
+        if len(code) != CODE_LENGTH:
+            raise BatchImportError(
+                f"Row {row_number}: code {code!r} is not " +
+                f"{CODE_LENGTH} characters long")
+        if not name:
+            raise BatchImportError(f"Row {row_number}: empty batch name")
+        yield code, name
+
+
+def import_batches(server_connection: ServerConnection, stream: TextIO) -> int:
+    """Validates the whole file, then associates it in one transaction."""
+    batches: List[Tuple[str, str]] = list(read_batches(stream))
+    return server_connection.associate_batches(batches)
+
+
+def main() -> None:
+    server_connection = ServerConnection(sys.argv[1],
+                                         timeout=IMPORT_TIMEOUT, retries=0)
+    server_connection.connect()
+    try:
+        with open(sys.argv[2], newline='', encoding='utf-8-sig') as f:
+            count = import_batches(server_connection, f)
+        print(f"Associated {count} batches")
+    except BatchImportError as e:
+        sys.exit(f"Nothing imported: {e}")
+    finally:
+        server_connection.stop()
+
+
+if __name__ == '__main__':
+    main()
+
+# vim: tw=80 sw=4 ts=4 expandtab:
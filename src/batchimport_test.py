@@ -0,0 +1,36 @@
+# Copyright (C) 2018 Metatavu Oy
+# 
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+# 
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import io
+
+import pytest
+
+from batchimport import BatchImportError, read_batches
+
+
+def test_read_batches() -> None:
+    stream = io.StringIO("code,name\n0123456789,Tilaus 1\n\n" +
+                         "9876543210, \"Tilaus, 2\"\n")
+    assert list(read_batches(stream)) == [
+        ("0123456789", "Tilaus 1"),
+        ("9876543210", "Tilaus, 2")
+    ]
+
+
+def test_read_batches_rejects_bad_code() -> None:
+    with pytest.raises(BatchImportError):
+        list(read_batches(io.StringIO("0123456789,A\n12345,B\n")))
+
+# vim: tw=80 sw=4 ts=4 expandtab:
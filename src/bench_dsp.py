@@ -0,0 +1,62 @@
+# Copyright (C) 2018 Metatavu Oy
+# 
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+# 
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Compares the samples per second of the current sensor detection.
+
+    python bench_dsp.py [samples] [block_size]
+"""
+
+import sys
+import time
+from typing import Callable
+
+import numpy as np
+
+from dsp import amplitude_pipeline
+from sensors import QuickAmplitudeMeasurer
+
+
+def bench(name: str, samples: int, run: Callable[[], None]) -> None:
+    start = time.perf_counter()
+    run()
+    elapsed = time.perf_counter() - start
+    print("{:<24}{:>14.0f} samples/s".format(name, samples / elapsed))
+
+
+def main() -> None:
+    samples = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    block_size = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    signal = np.random.randint(0, 4096, samples)
+    raw = [int(value) for value in signal]
+
+    def measurer() -> None:
+        quick = QuickAmplitudeMeasurer(2048, 25, 256)
+        for value in raw:
+            quick.sample(value)
+            quick.over_threshold()
+
+    def pipeline() -> None:
+        stages = amplitude_pipeline(2048, 25, 256)
+        for i in range(0, samples, block_size):
+            stages.process(signal[i:i + block_size].astype(np.float64))
+
+    bench("QuickAmplitudeMeasurer", samples, measurer)
+    bench("pipeline ({} / block)".format(block_size), samples, pipeline)
+
+
+if __name__ == '__main__':
+    main()
+
+# vim: tw=80 sw=4 ts=4 expandtab:
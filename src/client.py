@@ -16,11 +16,18 @@
 # -*- coding: utf-8 -*-
 
 import os
-import sys
 from typing import (TYPE_CHECKING, Any, Callable, Dict, List, NamedTuple,
-                    Optional)
+                    Optional, Tuple)
+
+from runtime import Runtime, load_config
+
+if __name__ == '__main__':
+    # The UI only changes on model events, so there is no need to render at
+    # the default 60 frames per second. Kivy's Clock reads the cap when
+    # kivy.clock is first imported, so it is set before any Kivy import.
+    os.environ.setdefault("KCFG_GRAPHICS_MAXFPS",
+                          str(load_config().get("max_fps", 10)))
 
-import toml
 from kivy.app import App
 from kivy.clock import Clock
 from kivy.config import Config
@@ -30,10 +37,7 @@ from kivy.properties import (ListProperty, NumericProperty, ObjectProperty,
 from kivy.uix.textinput import TextInput
 from kivy.uix.widget import Widget
 
-from client_model import Device, Sensor, WorkstationState
-from sensors import SensorSystem
-from leddriver import LedDriver
-from serverconnection import ServerConnection
+from client_model import Sensor, WorkstationState
 
 
 class SensorStatus(NamedTuple):
@@ -42,19 +46,24 @@ class SensorStatus(NamedTuple):
     color: Color
 
 
-class ConfigurationException(Exception):
-    pass
+EMPTY_COLOR = Color(0, 0, 0, 0)
+ACTIVE_COLOR = Color(0, 0.67, 0.375, 1)
+INACTIVE_COLOR = Color(0.67, 0.125, 0, 1)
+EMPTY_SENSOR_STATUS = SensorStatus("", "", EMPTY_COLOR)
 
 
 class FocusingTextInput(TextInput):
     def on_parent(self, widget: Widget, parent: Widget) -> None:
         self.focus = True
-        # TODO: fix horrid hack
-        @Clock.schedule_once
-        # pylint: disable=W0612
-        def refocus(*args: Any) -> None:
-            self.focus = True
-            Clock.schedule_once(refocus)
+
+    def on_focus(self, instance: Widget, focused: bool) -> None:
+        # Keep the focus for the barcode reader, but only act when the focus
+        # is lost instead of polling on every frame.
+        if not focused:
+            Clock.schedule_once(self._refocus)
+
+    def _refocus(self, *args: Any) -> None:
+        self.focus = True
 
     def on_text_validate(self, *args: Any, **kwargs: Any) -> None:
         super().on_text_validate(*args, **kwargs)
@@ -65,35 +74,23 @@ class MonitorDeviceWidget(Widget):
     num_workers: NumericProperty = NumericProperty()
     batch_name: StringProperty = StringProperty('')
     batch_code: StringProperty = StringProperty('')
-    led_driver: LedDriver
+    runtime: Runtime
     workstation_color_r: NumericProperty = NumericProperty()
     workstation_color_g: NumericProperty = NumericProperty()
     workstation_color_b: NumericProperty = NumericProperty()
     workstation_color_a: NumericProperty = NumericProperty()
     workstation_state: StringProperty = StringProperty('')
-    sensor_statuses: ListProperty = ListProperty([
-        SensorStatus("", "", Color(0,0,0,0)),
-        SensorStatus("", "", Color(0,0,0,0)),
-        SensorStatus("", "", Color(0,0,0,0)),
-        SensorStatus("", "", Color(0,0,0,0)),
-        SensorStatus("", "", Color(0,0,0,0))
-    ])
+    _sensor_status_cache: Dict[Tuple[str, bool], SensorStatus]
+    sensor_statuses: ListProperty = ListProperty([EMPTY_SENSOR_STATUS] * 5)
 
     def __init__(self, **kwargs: Dict[str, Any]) -> None:
         super().__init__()
-        def schedule_sensor(f: Callable[..., None]) -> None:
-            Clock.schedule_once(f, 1e-3)
-        sensor_system = SensorSystem(schedule_sensor)
-        sensor_system.start()
-        self.led_driver = LedDriver()
-        self.led_driver.start()
-        self.led_driver.set_color(255, 0, 0)
-        config = self.make_config()
-        if "connect_url" not in config:
-            raise ConfigurationException("`connect_url` not set in configuration")
-        server_connection = ServerConnection(config["connect_url"])
-        server_connection.connect()
-        model = Device("WS", sensor_system, server_connection)
+        self._sensor_status_cache = {}
+        runtime = Runtime(self.make_config(),
+                          Clock.schedule_once,
+                          Clock.schedule_interval)
+        self.runtime = runtime
+        model = runtime.model
         self.num_workers = model.num_workers
         self.on_sensors_model_change(model.sensors)
         model.add_num_workers_changed_listener(self.on_num_workers_model_change)
@@ -101,50 +98,33 @@ class MonitorDeviceWidget(Widget):
         model.add_workstation_state_changed_listener(self.on_workstation_state_model_change)
         model.add_batch_name_changed_listener(self.on_batch_name_model_change)
         self.model = model
-        def refresh() -> None:
-            self.model.refresh()
-            Clock.schedule_once(lambda *args: refresh(), 15)
-        refresh()
         self.bind(num_workers=self.on_num_workers_change)
         self.on_workstation_state_model_change(model.workstation_state)
 
     def make_config(self) -> Dict[str, Any]:
-        if 'REIFER_MONITOR_CONFIG' in os.environ:
-            conf = toml.load(os.environ['REIFER_MONITOR_CONFIG'])
-            assert isinstance(conf, dict)
-            return conf
-        elif len(sys.argv) >= 2:
-            conf = toml.load(sys.argv[1])
-            assert isinstance(conf, dict)
-            return conf
-        else:
-            raise ConfigurationException(
-                "Configuration file location not set. " +
-                "Pass it as argv[1] or REIFER_MONITOR_CONFIG " +
-                "environment variable.")
+        return load_config()
 
     def stop(self) -> None:
-        pass
+        self.runtime.stop()
 
     def on_num_workers_change(self, instance: Widget, value: int) -> None:
         self.model.num_workers = value
 
     def on_batch_code_input(self, value: str) -> None:
-        if self.model.batch_code == value:
-            self.model.batch_code = ""
-            self.batch_code = ""
+        self.batch_code = self.runtime.scan_batch_code(value)
+        if not self.batch_code:
             self.batch_name = ""
-        else:
-            self.model.batch_code = value
-            self.batch_code = value
 
     def on_num_workers_model_change(self, num_workers: int) -> None:
         self.num_workers = num_workers
 
     def on_sensors_model_change(self, sensors: List[Sensor]) -> None:
         aux: List[Optional[Sensor]] = [None] * 5
-        aux[:len(sensors)] = sensors
-        self.sensor_statuses = [self._compute_sensor_status(x) for x in aux]
+        aux[:len(sensors)] = sensors[:5]
+        for index, sensor in enumerate(aux):
+            status = self._compute_sensor_status(sensor)
+            if self.sensor_statuses[index] != status:
+                self.sensor_statuses[index] = status
 
     def on_batch_name_model_change(self, batch_name: str) -> None:
         self.batch_name = batch_name
@@ -156,32 +136,31 @@ class MonitorDeviceWidget(Widget):
             self.workstation_color_b = 0
             self.workstation_color_a = 1
             self.workstation_state = "TYHJÄ"
-            self.led_driver.set_color(255, 0, 0)
         elif state == WorkstationState.IDLE:
             self.workstation_color_r = 0.5
             self.workstation_color_g = 0.5
             self.workstation_color_b = 0
             self.workstation_color_a = 1
             self.workstation_state = "EI KÄYTÖSSÄ"
-            self.led_driver.set_color(255, 255, 0)
         elif state == WorkstationState.ACTIVE:
             self.workstation_color_r = 0
             self.workstation_color_g = 0.67
             self.workstation_color_b = 0.375
             self.workstation_color_a = 1
             self.workstation_state = "KÄYTÖSSÄ"
-            self.led_driver.set_color(0, 255, 0)
 
     def _compute_sensor_status(self, sensor: Optional[Sensor]) -> SensorStatus:
         if sensor is None:
-            return SensorStatus("", "", Color(0, 0, 0, 0))
-        if sensor.active:
-            status = "AKTIIVINEN"
-            color = Color(0, 0.67, 0.375, 1)
-        else:
-            status = "EI AKTIIVINEN"
-            color = Color(0.67, 0.125, 0, 1)
-        return SensorStatus(sensor.name, status, color)
+            return EMPTY_SENSOR_STATUS
+        key = (sensor.name, sensor.active)
+        if key not in self._sensor_status_cache:
+            if sensor.active:
+                status = SensorStatus(sensor.name, "AKTIIVINEN", ACTIVE_COLOR)
+            else:
+                status = SensorStatus(sensor.name, "EI AKTIIVINEN",
+                                      INACTIVE_COLOR)
+            self._sensor_status_cache[key] = status
+        return self._sensor_status_cache[key]
 
 
 class MonitorApp(App):
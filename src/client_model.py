@@ -13,13 +13,31 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import time
+from collections import deque
+from concurrent.futures import Future
+from logging import error
+from typing import Any
+from typing import Deque
+from typing import Dict
+from typing import Iterable
 from typing import Callable
 from typing import List
 from typing import NamedTuple
+from typing import Optional
+from typing import Set
+from typing import Tuple
 from abc import ABCMeta
 from abc import abstractmethod
 from enum import Enum
+from batchcache import BatchNameCache
 from serverconnection import ServerConnection
+from stats import Stats
+
+
+VIBRATION_SENSOR = 1
+CURRENT_SENSOR = 2
+PROXIMITY_SENSOR = 3
 
 
 class Sensor(NamedTuple):
@@ -41,46 +59,344 @@ class SensorSystem(metaclass=ABCMeta):
         pass
 
 
+class SensorSubset(SensorSystem):
+    """The sensors of a shared sensor system that belong to one workstation."""
+    _sensor_system: SensorSystem
+    _identifiers: Set[int]
+
+    def __init__(self,
+                 sensor_system: SensorSystem,
+                 identifiers: Iterable[int]) -> None:
+        self._sensor_system = sensor_system
+        self._identifiers = set(identifiers)
+
+    @property
+    def sensors(self) -> List[Sensor]:
+        return [sensor for sensor in self._sensor_system.sensors
+                if sensor.identifier in self._identifiers]
+
+    def add_sensor_change_listener(
+            self,
+            listener: Callable[[Sensor], None]) -> None:
+        def on_change(sensor: Sensor) -> None:
+            if sensor.identifier in self._identifiers:
+                listener(sensor)
+        self._sensor_system.add_sensor_change_listener(on_change)
+
+
 class WorkstationState(Enum):
     EMPTY = 1
     IDLE = 2
     ACTIVE = 3
 
 
+class SensorRole(Enum):
+    PRESENCE = 1
+    ACTIVITY = 2
+    IGNORED = 3
+
+
+# The sensors of the original board, where the PIR sensor only tells
+# whether someone is at the workstation.
+DEFAULT_SENSOR_ROLES: Dict[int, SensorRole] = {
+    VIBRATION_SENSOR: SensorRole.ACTIVITY,
+    CURRENT_SENSOR: SensorRole.ACTIVITY,
+    PROXIMITY_SENSOR: SensorRole.PRESENCE
+}
+
+
+class WorkstationStateEngine:
+    """Derives the workstation state from sensor changes incrementally.
+
+    Sensors are given roles by identifier, by default those of the
+    original board; unlisted sensors count as machine activity. The
+    engine keeps the number of active sensors per role, so each change
+    and each state query takes constant time.
+    """
+    _roles: Dict[int, SensorRole]
+    _default_role: SensorRole
+    _active: Dict[int, bool]
+    _active_counts: Dict[SensorRole, int]
+
+    def __init__(
+            self,
+            roles: Optional[Dict[int, SensorRole]] = None,
+            default_role: SensorRole = SensorRole.ACTIVITY) -> None:
+        self._roles = dict(roles if roles is not None
+                           else DEFAULT_SENSOR_ROLES)
+        self._default_role = default_role
+        self._active = {}
+        self._active_counts = {role: 0 for role in SensorRole}
+
+    def role(self, identifier: int) -> SensorRole:
+        return self._roles.get(identifier, self._default_role)
+
+    def reset(self, sensors: Iterable[Sensor]) -> None:
+        self._active = {}
+        self._active_counts = {role: 0 for role in SensorRole}
+        for sensor in sensors:
+            self.update(sensor)
+
+    def update(self, sensor: Sensor) -> None:
+        was_active = self._active.get(sensor.identifier, False)
+        if sensor.active == was_active:
+            return
+        self._active[sensor.identifier] = sensor.active
+        self._active_counts[self.role(sensor.identifier)] += \
+            1 if sensor.active else -1
+
+    def active_count(self, role: SensorRole) -> int:
+        return self._active_counts[role]
+
+    def state(self, num_workers: int) -> WorkstationState:
+        if num_workers == 0:
+            return WorkstationState.EMPTY
+        elif self._active_counts[SensorRole.ACTIVITY] == 0:
+            return WorkstationState.IDLE
+        else:
+            return WorkstationState.ACTIVE
+
+
+class TransitionFilter:
+    """Passes on changes of an on/off signal only once they have settled.
+
+    A change to on is passed on after the signal has stayed on for
+    `on_delay` seconds and a change to off after it has stayed off for
+    `off_delay` seconds. A passed-on value is then held for at least
+    `min_dwell` seconds. If the raw signal changes more than `max_flaps`
+    times within `flap_window` seconds, the settled value is held until
+    the signal has been quiet for `flap_window` seconds.
+
+    Pending changes are re-evaluated through `schedule`, which takes a
+    callback and a delay in seconds like Kivy's `Clock.schedule_once`. With
+    all delays at zero every change is passed on at once.
+    """
+    _on_delay: float
+    _off_delay: float
+    _min_dwell: float
+    _flap_window: float
+    _max_flaps: int
+    _schedule: Tuple[Optional[Callable[[Callable[..., None], float], None]]]
+    _clock: Callable[[], float]
+    _raw: bool
+    _raw_changed: float
+    _value: bool
+    _value_changed: float
+    _flaps: Deque[float]
+    _generation: int
+    _listeners: List[Callable[[bool], None]]
+
+    def __init__(
+            self,
+            initial: bool = False,
+            on_delay: float = 0.0,
+            off_delay: float = 0.0,
+            min_dwell: float = 0.0,
+            flap_window: float = 0.0,
+            max_flaps: int = 0,
+            schedule: Optional[Callable[[Callable[..., None], float], None]] = None,
+            clock: Callable[[], float] = time.monotonic) -> None:
+        self._on_delay = on_delay
+        self._off_delay = off_delay
+        self._min_dwell = min_dwell
+        self._flap_window = flap_window
+        self._max_flaps = max_flaps
+        self._schedule = (schedule,)
+        self._clock = clock
+        now = clock()
+        self._raw = initial
+        self._raw_changed = now
+        self._value = initial
+        self._value_changed = now - min_dwell
+        self._flaps = deque()
+        self._generation = 0
+        self._listeners = []
+
+    @property
+    def value(self) -> bool:
+        return self._value
+
+    def add_listener(self, listener: Callable[[bool], None]) -> None:
+        self._listeners.append(listener)
+
+    def update(self, raw: bool) -> None:
+        if raw != self._raw:
+            now = self._clock()
+            self._raw = raw
+            self._raw_changed = now
+            if self._flap_window > 0:
+                self._flaps.append(now)
+        self._evaluate()
+
+    def _evaluate(self) -> None:
+        self._generation += 1
+        if self._raw == self._value:
+            return
+        now = self._clock()
+        delay = self._on_delay if self._raw else self._off_delay
+        due = max(self._raw_changed + delay,
+                  self._value_changed + self._min_dwell)
+        while self._flaps and self._flaps[0] <= now - self._flap_window:
+            self._flaps.popleft()
+        if len(self._flaps) > self._max_flaps:
+            due = max(due, self._flaps[-1] + self._flap_window)
+        if now < due:
+            generation = self._generation
+            def reevaluate(*args: Any) -> None:
+                if generation == self._generation:
+                    self._evaluate()
+            schedule, = self._schedule
+            assert schedule is not None, "delayed transitions need a schedule"
+            schedule(reevaluate, due - now)
+            return
+        self._value = self._raw
+        self._value_changed = now
+        for listener in self._listeners:
+            listener(self._value)
+
+
+class Heartbeat:
+    """Calls its listeners every `interval` seconds while started.
+
+    `touch` restarts the wait, so a beat is only due after `interval`
+    seconds without any other traffic. `negotiate` sets the interval to a
+    third of the server's work run timeout, so that two lost beats can be
+    tolerated before the server closes the work run.
+    """
+    interval: float
+    _schedule: Tuple[Callable[[Callable[..., None], float], None]]
+    _clock: Callable[[], float]
+    _running: bool
+    _last_sent: float
+    _generation: int
+    _listeners: List[Callable[[], None]]
+
+    def __init__(
+            self,
+            interval: float,
+            schedule: Callable[[Callable[..., None], float], None],
+            clock: Callable[[], float] = time.monotonic) -> None:
+        self.interval = interval
+        self._schedule = (schedule,)
+        self._clock = clock
+        self._running = False
+        self._last_sent = clock()
+        self._generation = 0
+        self._listeners = []
+
+    def add_listener(self, listener: Callable[[], None]) -> None:
+        self._listeners.append(listener)
+
+    def negotiate(self, server_connection: ServerConnection) -> None:
+        def on_timeout(timeout: 'Future[float]') -> None:
+            if timeout.exception() is not None:
+                error(f"Fetching work run timeout failed: {timeout.exception()!r}")
+                return
+            self.interval = timeout.result() / 3
+            if self._running:
+                self._arm(self.interval)
+        server_connection.fetch_work_run_timeout().add_done_callback(on_timeout)
+
+    def start(self) -> None:
+        self._running = True
+        self.touch()
+        self._arm(self.interval)
+
+    def stop(self) -> None:
+        self._running = False
+        self._generation += 1
+
+    def touch(self) -> None:
+        self._last_sent = self._clock()
+
+    def _arm(self, delay: float) -> None:
+        self._generation += 1
+        generation = self._generation
+        def beat(*args: Any) -> None:
+            if generation == self._generation:
+                self._beat()
+        schedule, = self._schedule
+        schedule(beat, delay)
+
+    def _beat(self) -> None:
+        if not self._running:
+            return
+        idle = self._clock() - self._last_sent
+        if idle >= self.interval:
+            self._last_sent = self._clock()
+            for listener in self._listeners:
+                listener()
+            self._arm(self.interval)
+        else:
+            self._arm(self.interval - idle)
+
+
 class Device:
     # dependencies
     _sensor_system: SensorSystem
     _server_connection: ServerConnection
+    _state_engine: WorkstationStateEngine
+    _batch_names: Optional[BatchNameCache]
+    _work_run_filter: TransitionFilter
+    _presence_filter: TransitionFilter
+    _heartbeat: Optional[Heartbeat]
+    _stats_source: Optional[Tuple[Callable[[], Dict[str, Any]]]]
 
     # state
     _workstation_code: str
     _batch_code: str
     _batch_name: str
-    _old_workstation_state: WorkstationState
     _num_workers: int
     _workstation_state_changed_listeners: List[Callable[[WorkstationState], None]]
     _num_workers_changed_listeners: List[Callable[[int], None]]
     _sensors_changed_listeners: List[Callable[[List[Sensor]], None]]
     _batch_name_changed_listeners: List[Callable[[str], None]]
+    stats: Stats
 
     def __init__(
             self,
             workstation_code: str,
             sensor_system: SensorSystem,
-            server_connection: ServerConnection) -> None:
+            server_connection: ServerConnection,
+            batch_names: Optional[BatchNameCache] = None,
+            work_run_filter: Optional[TransitionFilter] = None,
+            presence_filter: Optional[TransitionFilter] = None,
+            heartbeat: Optional[Heartbeat] = None,
+            state_engine: Optional[WorkstationStateEngine] = None,
+            stats_source: Optional[Callable[[], Dict[str, Any]]] = None) -> None:
         # dependencies
         self._sensor_system = sensor_system
         self._server_connection = server_connection
+        self._state_engine = (state_engine
+                              if state_engine is not None
+                              else WorkstationStateEngine())
+        self._state_engine.reset(sensor_system.sensors)
+        self._batch_names = batch_names
+        self._work_run_filter = (work_run_filter
+                                 if work_run_filter is not None
+                                 else TransitionFilter(False))
+        self._presence_filter = (presence_filter
+                                 if presence_filter is not None
+                                 else TransitionFilter(True))
+        self._heartbeat = heartbeat
+        self._stats_source = (stats_source,) if stats_source is not None else None
         # state
         self._workstation_code = workstation_code
-        self._old_workstation_state = WorkstationState.EMPTY
         self._num_workers = 0
         self._workstation_state_changed_listeners = []
         self._num_workers_changed_listeners = []
         self._sensors_changed_listeners = []
         self._batch_name_changed_listeners = []
         self._batch_code = ""
+        self._batch_name = ""
+        self.stats = Stats()
         sensor_system.add_sensor_change_listener(self._on_sensor_changed)
+        if batch_names is not None:
+            batch_names.add_refresh_listener(self._on_batch_name_refreshed)
+        self._work_run_filter.add_listener(self._on_work_run_settled)
+        self._presence_filter.add_listener(self._on_presence_settled)
+        if heartbeat is not None:
+            heartbeat.add_listener(self.refresh)
 
     def add_workstation_state_changed_listener(
             self,
@@ -103,23 +419,46 @@ class Device:
         self._batch_name_changed_listeners.append(listener)
 
     def _on_sensor_changed(self, new_sensor: Sensor) -> None:
-        sensors = self._sensor_system.sensors
-        for sensor_listener in self._sensors_changed_listeners:
-            sensor_listener(sensors)
+        began = time.perf_counter()
+        self._dispatch_sensor_change(new_sensor)
+        self.stats.observe("sensor_dispatch_seconds",
+                           time.perf_counter() - began)
+
+    def _dispatch_sensor_change(self, new_sensor: Sensor) -> None:
+        self._state_engine.update(new_sensor)
+        if self._sensors_changed_listeners:
+            sensors = self._sensor_system.sensors
+            for sensor_listener in self._sensors_changed_listeners:
+                sensor_listener(sensors)
         workstation_state = self.workstation_state
         self._notify_work_run(workstation_state)
         for workstation_listener in self._workstation_state_changed_listeners:
             workstation_listener(workstation_state)
-        if new_sensor.name == "PIR" and not new_sensor.active:
-            self.num_workers = 0
+        if self._state_engine.role(new_sensor.identifier) == SensorRole.PRESENCE:
+            self._presence_filter.update(
+                self._state_engine.active_count(SensorRole.PRESENCE) > 0)
 
     def _notify_work_run(self, workstation_state: WorkstationState) -> None:
-        if workstation_state != self._old_workstation_state:
-            if workstation_state == WorkstationState.ACTIVE:
-                self._server_connection.start_work_run(self._workstation_code)
-            elif self._old_workstation_state == WorkstationState.ACTIVE:
-                self._server_connection.stop_work_run(self._workstation_code)
-        self._old_workstation_state = workstation_state
+        self._work_run_filter.update(
+            workstation_state == WorkstationState.ACTIVE)
+
+    def _on_work_run_settled(self, active: bool) -> None:
+        if active:
+            self._server_connection.start_work_run(self._workstation_code)
+            if self._heartbeat is not None:
+                self._heartbeat.start()
+        else:
+            self._server_connection.stop_work_run(self._workstation_code)
+            if self._heartbeat is not None:
+                self._heartbeat.stop()
+
+    def _touch_heartbeat(self) -> None:
+        if self._heartbeat is not None:
+            self._heartbeat.touch()
+
+    def _on_presence_settled(self, present: bool) -> None:
+        if not present:
+            self.num_workers = 0
 
     @property
     def num_workers(self) -> int:
@@ -134,10 +473,13 @@ class Device:
         old_workers = self._num_workers
         self._num_workers = num_workers
         if num_workers != old_workers:
-            self._server_connection.stop_activity_period(self._workstation_code)
-            self._server_connection.start_activity_period(
-                self._workstation_code, 
+            operations = self._server_connection.multi()
+            operations.stop_activity_period(self._workstation_code)
+            operations.start_activity_period(
+                self._workstation_code,
                 num_workers)
+            operations.post()
+            self._touch_heartbeat()
             for num_listener in self._num_workers_changed_listeners:
                 num_listener(num_workers)
         workstation_state = self.workstation_state
@@ -145,17 +487,13 @@ class Device:
         for listener in self._workstation_state_changed_listeners:
             listener(workstation_state)
     
+    @property
+    def workstation_code(self) -> str:
+        return self._workstation_code
+
     @property
     def workstation_state(self) -> WorkstationState:
-        sensors_active = any(s.active
-                             for s in self._sensor_system.sensors
-                             if s.name != "PIR")
-        if self._num_workers == 0:
-            return WorkstationState.EMPTY
-        elif not sensors_active:
-            return WorkstationState.IDLE
-        else:
-            return WorkstationState.ACTIVE
+        return self._state_engine.state(self._num_workers)
 
     @property
     def sensors(self) -> List[Sensor]:
@@ -167,23 +505,56 @@ class Device:
 
     @batch_code.setter
     def batch_code(self, batch_code: str) -> None:
-        if batch_code != "" and batch_code != self._batch_code:
-            name = self._server_connection.get_batch_name(batch_code)
-            if name is None:
-                name = ""
-            self._batch_name = name
-            for listener in self._batch_name_changed_listeners:
-                listener(name)
-        if batch_code != self._batch_code:
-            self._server_connection.stop_work(self._workstation_code)
-            if batch_code != "":
-                self._server_connection.start_work(
-                    self._workstation_code,
-                    batch_code)
+        if batch_code == self._batch_code:
+            return
         self._batch_code = batch_code
+        self._touch_heartbeat()
+        operations = self._server_connection.multi()
+        if batch_code == "":
+            operations.stop_work(self._workstation_code)
+            operations.post()
+            return
+        cached = (self._batch_names.lookup(batch_code)
+                  if self._batch_names is not None else None)
+        if cached is not None:
+            cached_name, stale = cached
+            self._set_batch_name(cached_name)
+            operations.stop_work(self._workstation_code)
+            operations.start_work(self._workstation_code, batch_code)
+            operations.post()
+            if stale and self._batch_names is not None:
+                self._batch_names.refresh(batch_code)
+            return
+        name_index = operations.get_batch_name(batch_code)
+        operations.stop_work(self._workstation_code)
+        operations.start_work(self._workstation_code, batch_code)
+        def on_replies(replies: 'Future[List[Any]]') -> None:
+            if replies.exception() is not None:
+                error(f"Fetching batch name failed: {replies.exception()!r}")
+                return
+            name = replies.result()[name_index].batch_name
+            if name is not None and self._batch_names is not None:
+                self._batch_names.put(batch_code, name)
+            if self._batch_code != batch_code:
+                return
+            self._set_batch_name(name if name is not None else "")
+        operations.submit().add_done_callback(on_replies)
+
+    def _on_batch_name_refreshed(self, batch_code: str, name: str) -> None:
+        if batch_code == self._batch_code and name != self._batch_name:
+            self._set_batch_name(name)
+
+    def _set_batch_name(self, name: str) -> None:
+        self._batch_name = name
+        for listener in self._batch_name_changed_listeners:
+            listener(name)
 
     def refresh(self) -> None:
-        self._server_connection.refresh_work_run(self._workstation_code)
+        stats = None
+        if self._stats_source is not None:
+            stats_source, = self._stats_source
+            stats = stats_source()
+        self._server_connection.refresh_work_run(self._workstation_code, stats)
 
 
 # vim: tw=80 sw=4 ts=4 expandtab:
\ No newline at end of file
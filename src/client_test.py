@@ -13,12 +13,21 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+from typing import Any
+from typing import Optional
 from typing import Callable
 from typing import List
+from batchcache import BatchNameCache
 from client_model import Sensor
 from client_model import SensorSystem
 from client_model import Device
+from client_model import Heartbeat
+from client_model import SensorRole
+from client_model import SensorSubset
+from client_model import WorkstationStateEngine
+from client_model import TransitionFilter
 from client_model import WorkstationState
+from message import *
 from serverconnection import ServerConnection
 
 
@@ -50,8 +59,35 @@ class FakeSensorSystem(SensorSystem):
 
 
 class FakeServerConnection(ServerConnection):
+    messages: List[Any]
+
     def __init__(self) -> None:
-        raise NotImplementedError()
+        self.messages = []
+
+    def _communicate(self, message: Any, timeout: Optional[float] = None) -> Any:
+        self.messages.append(message)
+        return self._reply(message)
+
+    def _reply(self, message: Any) -> Any:
+        if isinstance(message, MultiOperationRequest):
+            return MultiOperationResponse(
+                [self._reply(x) for x in message.operations])
+        if isinstance(message, BatchNameQueryRequest):
+            return BatchNameQueryResponse("NAME")
+        if isinstance(message, ServerInfoRequest):
+            return ServerInfoResponse(30.0)
+        if isinstance(message, RecentBatchesQueryRequest):
+            return RecentBatchesQueryResponse([("CODE", "CACHED")])
+        replies = {
+            StartActivityPeriodRequest: StartActivityPeriodResponse,
+            StopActivityPeriodRequest: StopActivityPeriodResponse,
+            StartWorkRunRequest: StartWorkRunResponse,
+            StopWorkRunRequest: StopWorkRunResponse,
+            RefreshWorkRunRequest: RefreshWorkRunResponse,
+            StartWorkRequest: StartWorkResponse,
+            StopWorkRequest: StopWorkResponse,
+        }
+        return replies[type(message)]()
 
 
 def test_workstation_state_empty() -> None:
@@ -90,4 +126,239 @@ def test_sensor_change_notified() -> None:
     system.fake_sensor_change_listener(Sensor(1, "Sensor", True))
     assert sensors == [Sensor(1, "Sensor", True)]
 
+def test_state_engine_counts_by_role() -> None:
+    subject = WorkstationStateEngine({3: SensorRole.PRESENCE,
+                                      4: SensorRole.IGNORED})
+    subject.reset([Sensor(1, "A", False),
+                   Sensor(2, "B", True),
+                   Sensor(3, "C", True)])
+    assert subject.active_count(SensorRole.ACTIVITY) == 1
+    assert subject.active_count(SensorRole.PRESENCE) == 1
+    assert subject.state(1) == WorkstationState.ACTIVE
+    subject.update(Sensor(2, "B", False))
+    subject.update(Sensor(4, "D", True))
+    assert subject.state(1) == WorkstationState.IDLE
+    assert subject.state(0) == WorkstationState.EMPTY
+
+def test_presence_role_clears_workers() -> None:
+    system = FakeSensorSystem([Sensor(7, "Liike", True)], lambda _: None)
+    subject = Device("WS", system, FakeServerConnection(),
+                     state_engine=WorkstationStateEngine(
+                         {7: SensorRole.PRESENCE}))
+    subject.num_workers = 2
+    assert subject.workstation_state == WorkstationState.IDLE
+    system.fake_sensor_change_listener(Sensor(7, "Liike", False))
+    assert subject.num_workers == 0
+
+def test_pir_only_shows_presence_by_default() -> None:
+    system = FakeSensorSystem([Sensor(3, "PIR", True)], lambda _: None)
+    subject = Device("WS", system, FakeServerConnection())
+    subject.num_workers = 2
+    assert subject.workstation_state == WorkstationState.IDLE
+    system.fake_sensor_change_listener(Sensor(3, "PIR", False))
+    assert subject.num_workers == 0
+
+def test_num_workers_sent_in_one_round_trip() -> None:
+    connection = FakeServerConnection()
+    subject = Device("WS",
+                     FakeSensorSystem([], lambda _: None),
+                     connection)
+    subject.num_workers = 2
+    assert connection.messages == [
+        MultiOperationRequest([
+            StopActivityPeriodRequest("WS"),
+            StartActivityPeriodRequest("WS", 2)])]
+
+def test_batch_code_sent_in_one_round_trip() -> None:
+    connection = FakeServerConnection()
+    batch_names: List[str] = []
+    subject = Device("WS",
+                     FakeSensorSystem([], lambda _: None),
+                     connection)
+    subject.add_batch_name_changed_listener(batch_names.append)
+    subject.batch_code = "CODE"
+    assert connection.messages == [
+        MultiOperationRequest([
+            BatchNameQueryRequest("CODE"),
+            StopWorkRequest("WS"),
+            StartWorkRequest("WS", "CODE")])]
+    assert batch_names == ["NAME"]
+
+def test_batch_name_from_cache() -> None:
+    connection = FakeServerConnection()
+    batch_names: List[str] = []
+    now = 0.0
+    cache = BatchNameCache(connection, ttl=10, clock=lambda: now)
+    cache.warm(100)
+    subject = Device("WS",
+                     FakeSensorSystem([], lambda _: None),
+                     connection,
+                     cache)
+    subject.add_batch_name_changed_listener(batch_names.append)
+    connection.messages.clear()
+    subject.batch_code = "CODE"
+    assert batch_names == ["CACHED"]
+    assert connection.messages == [
+        MultiOperationRequest([
+            StopWorkRequest("WS"),
+            StartWorkRequest("WS", "CODE")])]
+
+def test_stale_batch_name_refreshed() -> None:
+    connection = FakeServerConnection()
+    batch_names: List[str] = []
+    now = 0.0
+    cache = BatchNameCache(connection, ttl=10, clock=lambda: now)
+    cache.put("CODE", "OLD")
+    subject = Device("WS",
+                     FakeSensorSystem([], lambda _: None),
+                     connection,
+                     cache)
+    subject.add_batch_name_changed_listener(batch_names.append)
+    now = 20.0
+    subject.batch_code = "CODE"
+    assert batch_names == ["OLD", "NAME"]
+    assert cache.lookup("CODE") == ("NAME", False)
+
+class FakeClock:
+    def __init__(self) -> None:
+        self.now = 0.0
+        self.scheduled: List[Any] = []
+
+    def __call__(self) -> float:
+        return self.now
+
+    def schedule(self, callback: Callable[..., None], delay: float) -> None:
+        self.scheduled.append((self.now + delay, callback))
+
+    def advance(self, seconds: float) -> None:
+        self.now += seconds
+        due = [x for x in self.scheduled if x[0] <= self.now]
+        self.scheduled = [x for x in self.scheduled if x[0] > self.now]
+        for _, callback in due:
+            callback(0)
+
+def test_transition_filter_delays() -> None:
+    clock = FakeClock()
+    values: List[bool] = []
+    subject = TransitionFilter(False, on_delay=5, off_delay=10,
+                               schedule=clock.schedule, clock=clock)
+    subject.add_listener(values.append)
+    subject.update(True)
+    clock.advance(4)
+    subject.update(False)
+    subject.update(True)
+    clock.advance(4)
+    assert values == []
+    clock.advance(1)
+    assert values == [True]
+    subject.update(False)
+    clock.advance(9)
+    assert values == [True]
+    clock.advance(1)
+    assert values == [True, False]
+
+def test_transition_filter_suppresses_flapping() -> None:
+    clock = FakeClock()
+    values: List[bool] = []
+    subject = TransitionFilter(False, flap_window=60, max_flaps=2,
+                               schedule=clock.schedule, clock=clock)
+    subject.add_listener(values.append)
+    subject.update(True)
+    subject.update(False)
+    clock.advance(1)
+    subject.update(True)
+    subject.update(False)
+    subject.update(True)
+    assert values == [True, False]
+    clock.advance(59)
+    assert values == [True, False]
+    clock.advance(1)
+    assert values == [True, False, True]
+
+def test_work_run_sent_when_settled() -> None:
+    clock = FakeClock()
+    connection = FakeServerConnection()
+    system = FakeSensorSystem([Sensor(1, "Sensor", True)], lambda _: None)
+    subject = Device("WS", system, connection,
+                     work_run_filter=TransitionFilter(
+                         False, on_delay=5,
+                         schedule=clock.schedule, clock=clock))
+    subject.num_workers = 1
+    assert StartWorkRunRequest("WS") not in connection.messages
+    clock.advance(5)
+    assert connection.messages[-1] == StartWorkRunRequest("WS")
+
+def test_heartbeat_only_while_work_run_open() -> None:
+    clock = FakeClock()
+    connection = FakeServerConnection()
+    system = FakeSensorSystem([Sensor(1, "Sensor", True)], lambda _: None)
+    heartbeat = Heartbeat(15, clock.schedule, clock)
+    heartbeat.negotiate(connection)
+    assert heartbeat.interval == 10
+    subject = Device("WS", system, connection, heartbeat=heartbeat)
+    clock.advance(30)
+    assert RefreshWorkRunRequest("WS") not in connection.messages
+    subject.num_workers = 1
+    clock.advance(6)
+    subject.num_workers = 2
+    connection.messages.clear()
+    clock.advance(6)
+    assert connection.messages == []
+    clock.advance(4)
+    assert connection.messages == [RefreshWorkRunRequest("WS")]
+    subject.num_workers = 0
+    connection.messages.clear()
+    clock.advance(60)
+    assert RefreshWorkRunRequest("WS") not in connection.messages
+
+
+class SharedSensorSystem(SensorSystem):
+    def __init__(self, sensors: List[Sensor]) -> None:
+        self._sensors = sensors
+        self.listeners: List[Callable[[Sensor], None]] = []
+
+    @property
+    def sensors(self) -> List[Sensor]:
+        return self._sensors
+
+    def add_sensor_change_listener(
+            self,
+            listener: Callable[[Sensor], None]) -> None:
+        self.listeners.append(listener)
+
+    def change(self, index: int, sensor: Sensor) -> None:
+        self._sensors[index] = sensor
+        for listener in self.listeners:
+            listener(sensor)
+
+
+def test_devices_share_sensor_system() -> None:
+    connection = FakeServerConnection()
+    system = SharedSensorSystem([Sensor(1, "A", False), Sensor(2, "B", False)])
+    first = Device("WS1", SensorSubset(system, [1]), connection)
+    second = Device("WS2", SensorSubset(system, [2]), connection)
+    first.num_workers = 1
+    second.num_workers = 1
+    system.change(1, Sensor(2, "B", True))
+    assert [x.identifier for x in first.sensors] == [1]
+    assert first.workstation_state == WorkstationState.IDLE
+    assert second.workstation_state == WorkstationState.ACTIVE
+
+
+def test_heartbeat_pushes_stats() -> None:
+    clock = FakeClock()
+    connection = FakeServerConnection()
+    system = FakeSensorSystem([Sensor(1, "Sensor", True)], lambda _: None)
+    heartbeat = Heartbeat(10, clock.schedule, clock)
+    subject = Device("WS", system, connection, heartbeat=heartbeat,
+                     stats_source=lambda: {"uptime": 1})
+    subject.num_workers = 1
+    system.fake_sensor_change_listener(Sensor(1, "Sensor", True))
+    connection.messages.clear()
+    clock.advance(10)
+    assert connection.messages == [
+        RefreshWorkRunRequest("WS", stats={"uptime": 1})]
+    dispatch = subject.stats.snapshot()["histograms"]["sensor_dispatch_seconds"]
+    assert dispatch["count"] == 1
+
 # vim: tw=80 sw=4 ts=4 expandtab:
\ No newline at end of file
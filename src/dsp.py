@@ -0,0 +1,183 @@
+# Copyright (C) 2018 Metatavu Oy
+# 
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+# 
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from abc import ABCMeta, abstractmethod
+from typing import List, Sequence
+
+import numpy as np
+
+
+class Stage(metaclass=ABCMeta):
+    """One step of a block-based signal pipeline.
+
+    A stage takes a block of samples and returns a block of the same
+    length. State needed to continue across block boundaries is kept in
+    the stage, so a signal can be fed in blocks of any size.
+    """
+    @abstractmethod
+    def process(self, block: np.ndarray) -> np.ndarray:
+        pass
+
+
+class RemoveBias(Stage):
+    def __init__(self, bias: float) -> None:
+        self._bias = bias
+
+    def process(self, block: np.ndarray) -> np.ndarray:
+        return block - self._bias
+
+
+class Rectify(Stage):
+    def process(self, block: np.ndarray) -> np.ndarray:
+        return np.asarray(np.abs(block))
+
+
+class MovingAverage(Stage):
+    """Mean of the last `window` samples.
+
+    Keeps a running sum and a ring of the last `window` samples: every
+    incoming sample is added to the sum and the sample leaving the window
+    subtracted from it. The sum is recomputed from the ring once every
+    `window` samples so rounding errors cannot build up.
+
+    Outputs NaN until `window` samples have been seen.
+    """
+    _window: int
+    _ring: np.ndarray
+    _oldest: int
+    _sum: float
+    _seen: int
+    _since_resum: int
+
+    def __init__(self, window: int) -> None:
+        self._window = window
+        self._ring = np.zeros(window)
+        self._oldest = 0
+        self._sum = 0.0
+        self._seen = 0
+        self._since_resum = 0
+
+    def process(self, block: np.ndarray) -> np.ndarray:
+        count = len(block)
+        if count == 0:
+            return np.zeros(0)
+        window = self._window
+        replaced = min(count, window)
+        slots = (self._oldest + np.arange(replaced)) % window
+        leaving = np.concatenate((self._ring[slots], block[:count - replaced]))
+        sums = self._sum + np.cumsum(block - leaving)
+        self._ring[slots] = block[count - replaced:]
+        self._oldest = (self._oldest + replaced) % window
+        self._since_resum += count
+        if self._since_resum >= window:
+            self._sum = float(np.sum(self._ring))
+            self._since_resum = 0
+        else:
+            self._sum = float(sums[-1])
+        out = sums / window
+        missing = window - 1 - self._seen
+        if missing > 0:
+            out[:missing] = np.nan
+        self._seen += count
+        return np.asarray(out)
+
+
+class RMS(Stage):
+    """Root mean square over the last `window` samples."""
+    _mean: MovingAverage
+
+    def __init__(self, window: int) -> None:
+        self._mean = MovingAverage(window)
+
+    def process(self, block: np.ndarray) -> np.ndarray:
+        squared = np.square(block, dtype=np.float64)
+        return np.asarray(np.sqrt(self._mean.process(squared)))
+
+
+class EnvelopeDetector(Stage):
+    """Peak envelope that follows rises at once and decays by `decay` per sample.
+
+    env[n] = max(|x[n]|, decay * env[n - 1]), evaluated for a whole block
+    at once in the log domain.
+    """
+    _log_decay: float
+    _envelope: float
+
+    def __init__(self, decay: float) -> None:
+        assert 0 < decay < 1
+        self._log_decay = float(np.log(decay))
+        self._envelope = 0.0
+
+    def process(self, block: np.ndarray) -> np.ndarray:
+        if len(block) == 0:
+            return np.zeros(0)
+        steps = np.arange(1, len(block) + 1) * self._log_decay
+        with np.errstate(divide='ignore'):
+            logs = np.log(np.abs(block))
+            carried = np.log(self._envelope)
+        peaks = np.maximum(np.maximum.accumulate(logs - steps), carried)
+        out = np.asarray(np.exp(peaks + steps))
+        self._envelope = float(out[-1])
+        return out
+
+
+class HysteresisThreshold(Stage):
+    """Turns on above `high` and off at or below `low`; NaN keeps the state."""
+    _high: float
+    _low: float
+    _state: bool
+
+    def __init__(self, high: float, low: float) -> None:
+        assert low <= high
+        self._high = high
+        self._low = low
+        self._state = False
+
+    def process(self, block: np.ndarray) -> np.ndarray:
+        decided = (block > self._high) | (block <= self._low)
+        indices = np.where(decided, np.arange(1, len(block) + 1), 0)
+        np.maximum.accumulate(indices, out=indices)
+        values = np.concatenate(([self._state], block > self._high))
+        out = values[indices]
+        if len(out) > 0:
+            self._state = bool(out[-1])
+        return out
+
+
+class Pipeline(Stage):
+    _stages: List[Stage]
+
+    def __init__(self, stages: Sequence[Stage]) -> None:
+        self._stages = list(stages)
+
+    def process(self, block: np.ndarray) -> np.ndarray:
+        for stage in self._stages:
+            block = stage.process(block)
+        return block
+
+
+def amplitude_pipeline(bias: float,
+                       threshold: float,
+                       averaging: int,
+                       hysteresis: float = 0.0) -> Pipeline:
+    """The current sensor detection of QuickAmplitudeMeasurer as a pipeline."""
+    return Pipeline([
+        RemoveBias(bias),
+        Rectify(),
+        MovingAverage(averaging),
+        HysteresisThreshold(threshold, threshold - hysteresis)
+    ])
+
+# vim: tw=80 sw=4 ts=4 expandtab:
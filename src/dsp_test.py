@@ -0,0 +1,80 @@
+# Copyright (C) 2018 Metatavu Oy
+# 
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+# 
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from typing import Any
+
+import numpy as np
+
+from dsp import (RMS, EnvelopeDetector, HysteresisThreshold, MovingAverage,
+                 amplitude_pipeline)
+from sensors import QuickAmplitudeMeasurer
+
+
+def process_in_blocks(stage: Any, signal: np.ndarray, size: int) -> np.ndarray:
+    return np.concatenate([stage.process(signal[i:i + size])
+                           for i in range(0, len(signal), size)])
+
+
+def test_moving_average_across_blocks() -> None:
+    out = process_in_blocks(MovingAverage(3), np.arange(7.0), 2)
+    assert np.isnan(out[:2]).all()
+    assert list(out[2:]) == [1.0, 2.0, 3.0, 4.0, 5.0]
+
+
+def test_moving_average_matches_convolution() -> None:
+    signal = np.random.RandomState(3).uniform(-1000, 1000, 5000)
+    for window in (1, 4, 256):
+        for size in (1, 3, window, 700):
+            out = process_in_blocks(MovingAverage(window), signal, size)
+            expected = np.convolve(signal, np.ones(window) / window, 'valid')
+            assert np.isnan(out[:window - 1]).all()
+            assert np.allclose(out[window - 1:], expected)
+
+
+def test_rms() -> None:
+    out = RMS(2).process(np.array([3.0, -4.0, 4.0]))
+    assert np.allclose(out[1:], [np.sqrt(12.5), 4.0])
+
+
+def test_envelope_matches_recurrence() -> None:
+    signal = np.random.RandomState(1).uniform(-1, 1, 100)
+    expected = []
+    envelope = 0.0
+    for value in signal:
+        envelope = max(abs(value), 0.9 * envelope)
+        expected.append(envelope)
+    out = process_in_blocks(EnvelopeDetector(0.9), signal, 7)
+    assert np.allclose(out, expected)
+
+
+def test_hysteresis_holds_between_thresholds() -> None:
+    stage = HysteresisThreshold(10, 5)
+    assert list(stage.process(np.array([7, 11, 7, np.nan]))) == \
+        [False, True, True, True]
+    assert list(stage.process(np.array([6, 5, 7]))) == [True, False, False]
+
+
+def test_amplitude_pipeline_matches_quick_measurer() -> None:
+    signal = np.random.RandomState(2).randint(1990, 2110, 2000)
+    quick = QuickAmplitudeMeasurer(2048, 25, 256)
+    expected = []
+    for value in signal:
+        quick.sample(int(value))
+        expected.append(quick.over_threshold())
+    pipeline = amplitude_pipeline(2048, 25, 256)
+    out = process_in_blocks(pipeline, signal.astype(np.float64), 50)
+    assert list(out) == expected
+
+# vim: tw=80 sw=4 ts=4 expandtab:
@@ -10,7 +10,7 @@ def pinMode(pin: int, mode: int) -> None:
 def digitalRead(pin: int) -> int:
     if pin == 1:
         return 1
-    if int(time.clock() % 10) < 5:
+    if int(time.monotonic() % 10) < 5:
         return 1
     else:
         return 0
@@ -19,4 +19,4 @@ def digitalWrite(pin: int, value: int) -> None:
     pass
     
 def analogRead(pin: int) -> int:
-    return int(512 + 128*sin(time.clock()))
+    return int(512 + 128*sin(time.monotonic()))
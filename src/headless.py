@@ -0,0 +1,207 @@
+# Copyright (C) 2018 Metatavu Oy
+# 
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+# 
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Runs a station without Kivy.
+
+    python headless.py config.toml
+
+Batch codes are read one per line from stdin, which is where a barcode or
+RFID reader in keyboard mode ends up when the station has no UI, or from
+the evdev input device set as `scanner_device`. A line of the form
+"<workstation code> <batch code>" is for the given workstation, any other
+line for the first one.
+"""
+
+import heapq
+import signal
+import sys
+import time
+from itertools import count
+from logging import error
+from threading import Condition, Thread
+from typing import Any, Callable, Iterator, List, Optional, TextIO, Tuple
+
+from runtime import Runtime, load_config
+
+
+class Event:
+    """A scheduled callback, cancelled with `cancel` like Kivy's ClockEvent."""
+    callback: Callable[..., None]
+    interval: Optional[float]
+    cancelled: bool
+
+    def __init__(self,
+                 callback: Callable[..., None],
+                 interval: Optional[float]) -> None:
+        self.callback = callback
+        self.interval = interval
+        self.cancelled = False
+
+    def cancel(self) -> None:
+        self.cancelled = True
+
+
+class Scheduler:
+    """Runs callbacks on the thread that calls `run`, like Kivy's Clock.
+
+    Callbacks may be scheduled from any thread and get the time elapsed
+    since they were scheduled as their argument.
+    """
+    _condition: Condition
+    _queue: List[Tuple[float, int, float, Event]]
+    _sequence: Iterator[int]
+    _clock: Callable[[], float]
+    _running: bool
+
+    def __init__(self, clock: Callable[[], float] = time.monotonic) -> None:
+        self._condition = Condition()
+        self._queue = []
+        self._sequence = count()
+        self._clock = clock
+        self._running = False
+
+    def schedule_once(self,
+                      callback: Callable[..., None],
+                      timeout: float = 0.0) -> Event:
+        event = Event(callback, None)
+        self._push(event, timeout)
+        return event
+
+    def schedule_interval(self,
+                          callback: Callable[..., None],
+                          interval: float) -> Event:
+        event = Event(callback, interval)
+        self._push(event, interval)
+        return event
+
+    def _push(self, event: Event, delay: float) -> None:
+        now = self._clock()
+        with self._condition:
+            heapq.heappush(self._queue,
+                           (now + max(0.0, delay), next(self._sequence), now,
+                            event))
+            self._condition.notify()
+
+    def run_pending(self) -> None:
+        """Runs the callbacks that are due."""
+        while True:
+            with self._condition:
+                if not self._queue or self._queue[0][0] > self._clock():
+                    return
+                _, _, scheduled, event = heapq.heappop(self._queue)
+            if event.cancelled:
+                continue
+            if event.interval is not None:
+                self._push(event, event.interval)
+            try:
+                event.callback(self._clock() - scheduled)
+            except Exception as e:
+                error(f"Scheduled callback failed: {e!r}")
+
+    def run(self) -> None:
+        """Runs callbacks as they fall due until `stop` is called."""
+        self._running = True
+        while self._running:
+            self.run_pending()
+            with self._condition:
+                if not self._running:
+                    break
+                timeout = (self._queue[0][0] - self._clock()
+                           if self._queue else None)
+                if timeout is None or timeout > 0:
+                    self._condition.wait(timeout)
+
+    def stop(self) -> None:
+        with self._condition:
+            self._running = False
+            self._condition.notify()
+
+
+def read_lines(stream: TextIO, on_line: Callable[[str], None]) -> None:
+    for line in stream:
+        line = line.strip()
+        if line:
+            on_line(line)
+
+
+def read_evdev(path: str, on_line: Callable[[str], None]) -> None:
+    """Reads lines typed by a scanner that shows up as an input device."""
+    # evdev is only installed on stations that use it.
+    from evdev import InputDevice, categorize, ecodes
+    device = InputDevice(path)
+    device.grab()
+    line: List[str] = []
+    for event in device.read_loop():
+        if event.type != ecodes.EV_KEY:
+            continue
+        key = categorize(event)
+        if key.keystate != key.key_down:
+            continue
+        name = key.keycode if isinstance(key.keycode, str) else key.keycode[0]
+        if name in ("KEY_ENTER", "KEY_KPENTER"):
+            if line:
+                on_line("".join(line))
+            line = []
+        elif name.startswith("KEY_") and len(name) == 5:
+            line.append(name[4])
+        elif name.startswith("KEY_KP") and len(name) == 7:
+            line.append(name[6])
+        elif name == "KEY_MINUS":
+            line.append("-")
+
+
+def main() -> None:
+    config = load_config()
+    scheduler = Scheduler()
+    runtime = Runtime(config,
+                      scheduler.schedule_once,
+                      scheduler.schedule_interval)
+
+    def on_line(line: str) -> None:
+        def scan(dt: float) -> None:
+            try:
+                runtime.scan_batch_code(batch_code, workstation_code)
+            except KeyError:
+                error(f"Unknown workstation: {workstation_code}")
+        workstation_code: Optional[str] = None
+        batch_code = line
+        if len(line.split()) == 2:
+            workstation_code, batch_code = line.split()
+        scheduler.schedule_once(scan)
+
+    if "scanner_device" in config:
+        reader = Thread(target=read_evdev,
+                        args=(config["scanner_device"], on_line),
+                        daemon=True)
+    else:
+        reader = Thread(target=read_lines, args=(sys.stdin, on_line),
+                        daemon=True)
+    reader.start()
+
+    def on_signal(signum: int, frame: Any) -> None:
+        scheduler.stop()
+
+    signal.signal(signal.SIGTERM, on_signal)
+    signal.signal(signal.SIGINT, on_signal)
+    try:
+        scheduler.run()
+    finally:
+        runtime.stop()
+
+
+if __name__ == '__main__':
+    main()
+
+# vim: tw=80 sw=4 ts=4 expandtab:
@@ -0,0 +1,53 @@
+# Copyright (C) 2018 Metatavu Oy
+# 
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+# 
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import io
+from typing import List
+
+from headless import Scheduler, read_lines
+
+
+class FakeClock:
+    def __init__(self) -> None:
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def test_scheduler_runs_due_callbacks_in_order() -> None:
+    clock = FakeClock()
+    subject = Scheduler(clock)
+    calls: List[str] = []
+    subject.schedule_once(lambda dt: calls.append("later"), 2.0)
+    subject.schedule_once(lambda dt: calls.append("now"))
+    ticks = subject.schedule_interval(lambda dt: calls.append("tick"), 1.0)
+    subject.run_pending()
+    assert calls == ["now"]
+    clock.now = 2.0
+    subject.run_pending()
+    assert calls == ["now", "tick", "later"]
+    ticks.cancel()
+    clock.now = 10.0
+    subject.run_pending()
+    assert calls == ["now", "tick", "later"]
+
+
+def test_read_lines_skips_blank_lines() -> None:
+    lines: List[str] = []
+    read_lines(io.StringIO("ABC123\n\n  X-1 \n"), lines.append)
+    assert lines == ["ABC123", "X-1"]
+
+# vim: tw=80 sw=4 ts=4 expandtab:
@@ -14,29 +14,156 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from typing import Iterator, TYPE_CHECKING, Callable, Tuple, Any, Optional
-from threading import Thread
-from time import sleep
-from serial import Serial
+import time
+from logging import log, DEBUG, ERROR, INFO
+from threading import Condition, Thread
+from typing import Any, Callable, Optional, Tuple
+
+from serial import Serial, SerialException
 from serial.tools.list_ports import comports
-from logging import log, ERROR
+
+from stats import Stats
+
+Color = Tuple[int, int, int]
+
 
 class LedDriver:
-    _serial: Optional[Serial]
+    """Sets the color of the status LED from a writer thread of its own.
 
-    def __init__(self) -> None:
+    `set_color` only records the wanted color, so a slow or wedged serial
+    adapter never blocks the caller. Colors set while a write is in
+    progress replace each other, and only the latest one is written.
+    Colors equal to the one last written are not written again. If the
+    port cannot be opened or a write fails, the port is reopened after
+    `reconnect_interval` seconds and the latest color is written.
+    `stop` writes a pending color once before returning.
+    """
+    _port: Optional[str]
+    _reconnect_interval: float
+    _write_timeout: float
+    _open_serial: Tuple[Callable[..., Any]]
+    _serial: Optional[Any]
+    _condition: Condition
+    _pending: Optional[Color]
+    _written: Optional[Color]
+    _unavailable: bool
+    _running: bool
+    _thread: Optional[Thread]
+    stats: Stats
+
+    def __init__(self,
+                 port: Optional[str] = None,
+                 reconnect_interval: float = 5.0,
+                 write_timeout: float = 1.0,
+                 open_serial: Callable[..., Any] = Serial) -> None:
+        self._port = port
+        self._reconnect_interval = reconnect_interval
+        self._write_timeout = write_timeout
+        self._open_serial = (open_serial,)
         self._serial = None
+        self._condition = Condition()
+        self._pending = None
+        self._written = None
+        self._unavailable = False
+        self._running = False
+        self._thread = None
+        self.stats = Stats()
 
     def start(self) -> None:
-        try:
-            (port, _, _), *_ = comports()
-        except ValueError:
-            log(ERROR, "No COM port found")
-            return
-        self._serial = Serial(port=port)
+        self._running = True
+        self._thread = Thread(target=self._write_loop, daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        with self._condition:
+            self._running = False
+            self._condition.notify()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._close()
 
     def set_color(self, r: int, g: int, b: int) -> None:
+        with self._condition:
+            if self._pending is None and self._written == (r, g, b):
+                self.stats.incr("skipped")
+                return
+            self._pending = (r, g, b)
+            self._condition.notify()
+
+    def _write_loop(self) -> None:
+        while True:
+            with self._condition:
+                while self._running and self._pending is None:
+                    self._condition.wait()
+                if self._pending is None:
+                    return
+                color = self._pending
+                self._pending = None
+            assert color is not None
+            if color == self._written:
+                self.stats.incr("skipped")
+            elif not self._write(color):
+                with self._condition:
+                    if not self._running:
+                        return
+                    if self._pending is None:
+                        self._pending = color
+                    self._condition.wait(self._reconnect_interval)
+
+    def _write(self, color: Color) -> bool:
+        serial = self._connect()
+        if serial is None:
+            return False
+        r, g, b = color
+        start = time.monotonic()
+        try:
+            serial.write(f"R{r}G{g}B{b}".encode('ascii'))
+        except SerialException as e:
+            log(ERROR, "Writing to LED failed: %s", e)
+            self.stats.incr("failures")
+            self._close()
+            return False
+        self.stats.observe("write_seconds", time.monotonic() - start)
+        self._written = color
+        return True
+
+    def _connect(self) -> Optional[Any]:
+        if self._serial is not None:
+            return self._serial
+        port = self._port
+        if port is None:
+            ports = comports()
+            if not ports:
+                self._log_unavailable("No COM port found")
+                return None
+            port = ports[0].device
+        open_serial, = self._open_serial
+        try:
+            self._serial = open_serial(port=port,
+                                       write_timeout=self._write_timeout)
+        except SerialException as e:
+            self._log_unavailable("Opening LED port %s failed: %s", port, e)
+            self.stats.incr("failures")
+            return None
+        if self._unavailable:
+            log(INFO, "LED port %s opened", port)
+            self._unavailable = False
+        self._written = None
+        return self._serial
+
+    def _log_unavailable(self, msg: str, *args: Any) -> None:
+        # Retried every reconnect interval while the controller is
+        # unplugged, so only the first failure is logged as an error.
+        log(DEBUG if self._unavailable else ERROR, msg, *args)
+        self._unavailable = True
+
+    def _close(self) -> None:
         if self._serial is not None:
-            self._serial.write(f"R{r}G{g}B{b}".encode('ascii'))
+            try:
+                self._serial.close()
+            except SerialException:
+                pass
+            self._serial = None
 
-# vim: tw=80 sw=4 ts=4 expandtab:
\ No newline at end of file
+# vim: tw=80 sw=4 ts=4 expandtab:
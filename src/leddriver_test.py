@@ -0,0 +1,98 @@
+# Copyright (C) 2018 Metatavu Oy
+# 
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+# 
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+from threading import Event
+from typing import Any, List
+
+import pytest
+from serial import SerialException
+
+from leddriver import LedDriver
+
+
+class FakeSerial:
+    writes: List[bytes]
+
+    def __init__(self, fail: bool = False) -> None:
+        self.writes = []
+        self.fail = fail
+        self.written = Event()
+        self.release = Event()
+        self.release.set()
+
+    def __call__(self, **kwargs: Any) -> 'FakeSerial':
+        return self
+
+    def write(self, data: bytes) -> None:
+        self.release.wait()
+        if self.fail:
+            self.fail = False
+            raise SerialException("unplugged")
+        self.writes.append(data)
+        self.written.set()
+
+    def close(self) -> None:
+        pass
+
+
+def test_coalesces_pending_colors_and_skips_repeats() -> None:
+    serial = FakeSerial()
+    serial.release.clear()
+    subject = LedDriver("port", open_serial=serial)
+    subject.start()
+    subject.set_color(255, 0, 0)
+    subject.set_color(0, 255, 0)
+    subject.set_color(255, 255, 0)
+    subject.set_color(0, 0, 255)
+    serial.release.set()
+    subject.stop()
+    subject.start()
+    subject.set_color(0, 0, 255)
+    subject.stop()
+    assert serial.writes[-1] == b"R0G0B255"
+    assert len(serial.writes) <= 2
+    stats = subject.stats.snapshot()
+    assert stats["counters"]["skipped"] == 1
+    assert stats["histograms"]["write_seconds"]["count"] == len(serial.writes)
+
+
+def test_rewrites_latest_color_after_failure() -> None:
+    serial = FakeSerial(fail=True)
+    subject = LedDriver("port", reconnect_interval=0.01, open_serial=serial)
+    subject.start()
+    subject.set_color(1, 2, 3)
+    assert serial.written.wait(5)
+    subject.stop()
+    assert serial.writes == [b"R1G2B3"]
+    assert subject.stats.snapshot()["counters"]["failures"] == 1
+
+
+def test_logs_unplugged_port_once(caplog: pytest.LogCaptureFixture) -> None:
+    attempts: List[int] = []
+    def open_serial(**kwargs: Any) -> FakeSerial:
+        attempts.append(1)
+        if len(attempts) <= 3:
+            raise SerialException("unplugged")
+        return FakeSerial()
+    subject = LedDriver("port", open_serial=open_serial)
+    with caplog.at_level(logging.DEBUG):
+        for _ in range(4):
+            subject._connect()
+    levels = [record.levelno for record in caplog.records]
+    assert levels == [logging.ERROR, logging.DEBUG, logging.DEBUG,
+                      logging.INFO]
+
+# vim: tw=80 sw=4 ts=4 expandtab:
@@ -29,6 +29,7 @@ from kivy.properties import (ListProperty, NumericProperty, ObjectProperty,
 from kivy.uix.widget import Widget
 from kivy.uix.textinput import TextInput
 
+import batchimport
 from client_model import Device, Sensor, WorkstationState
 from fakesensors import BlinkingSensorSystem
 from serverconnection import ServerConnection
@@ -75,6 +76,10 @@ class ManagerApp(App):
 
 
 if __name__ == '__main__':
-    Config.set('graphics', 'width', '800')
-    Config.set('graphics', 'height', '300')
-    ManagerApp().run()
+    if len(sys.argv) >= 3:
+        # manager.py <server url> <cards.csv> imports without the UI.
+        batchimport.main()
+    else:
+        Config.set('graphics', 'width', '800')
+        Config.set('graphics', 'height', '300')
+        ManagerApp().run()
@@ -1,6 +1,28 @@
+from datetime import datetime
 from traceback import StackSummary
-from typing import Any, NamedTuple, Optional
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
 
+# Roles of a server. Only the primary accepts changes.
+PRIMARY = "primary"
+STANDBY = "standby"
+FENCED = "fenced"
+
+
+class NotPrimaryError(Exception):
+    pass
+
+
+class RejectedError(Exception):
+    """The server refused a message and would refuse it again if resent."""
+    pass
+
+
+class ServerInfoRequest(NamedTuple):
+    pass
+
+class ServerInfoResponse(NamedTuple):
+    work_run_timeout: float
+    role: str = PRIMARY
 
 class BatchNameQueryRequest(NamedTuple):
     batch_code: str
@@ -8,40 +30,73 @@ class BatchNameQueryRequest(NamedTuple):
 class BatchNameQueryResponse(NamedTuple):
     batch_name: Optional[str]
 
+class RecentBatchesQueryRequest(NamedTuple):
+    limit: int
+
+class RecentBatchesQueryResponse(NamedTuple):
+    batches: List[Tuple[str, str]]
+
 class BatchAssociationRequest(NamedTuple):
     batch_code: str
     batch_name: str
+    # Set by the server, so that a standby records the same time.
+    created: Optional[datetime] = None
 
 class BatchAssociationResponse(NamedTuple):
     batch_id: int
 
+class BulkBatchAssociationRequest(NamedTuple):
+    batches: List[Tuple[str, str]]
+    created: Optional[datetime] = None
+
+class BulkBatchAssociationResponse(NamedTuple):
+    num_batches: int
+
+# Events carry the device time they happened at and the device time they
+# were last sent at, from which the server measures the device clock. The
+# server sets device_timestamp to the time as sent before correcting it,
+# so that a start sent again is recognised however the correction changed.
+
 class StartActivityPeriodRequest(NamedTuple):
     workstation_code: str
     num_workers: int
+    timestamp: Optional[datetime] = None
+    sent: Optional[datetime] = None
+    device_timestamp: Optional[datetime] = None
 
 class StartActivityPeriodResponse(NamedTuple):
     pass
 
 class StopActivityPeriodRequest(NamedTuple):
     workstation_code: str
+    timestamp: Optional[datetime] = None
+    sent: Optional[datetime] = None
 
 class StopActivityPeriodResponse(NamedTuple):
     pass
 
 class StartWorkRunRequest(NamedTuple):
     workstation_code: str
+    timestamp: Optional[datetime] = None
+    sent: Optional[datetime] = None
+    device_timestamp: Optional[datetime] = None
 
 class StartWorkRunResponse(NamedTuple):
     pass
 
 class RefreshWorkRunRequest(NamedTuple):
     workstation_code: str
+    timestamp: Optional[datetime] = None
+    stats: Optional[Dict[str, Any]] = None
+    sent: Optional[datetime] = None
 
 class RefreshWorkRunResponse(NamedTuple):
     pass
 
 class StopWorkRunRequest(NamedTuple):
     workstation_code: str
+    timestamp: Optional[datetime] = None
+    sent: Optional[datetime] = None
 
 class StopWorkRunResponse(NamedTuple):
     pass
@@ -49,16 +104,72 @@ class StopWorkRunResponse(NamedTuple):
 class StartWorkRequest(NamedTuple):
     workstation_code: str
     batch_code: str
+    timestamp: Optional[datetime] = None
+    sent: Optional[datetime] = None
+    device_timestamp: Optional[datetime] = None
 
 class StartWorkResponse(NamedTuple):
     pass
 
 class StopWorkRequest(NamedTuple):
     workstation_code: str
+    timestamp: Optional[datetime] = None
+    sent: Optional[datetime] = None
 
 class StopWorkResponse(NamedTuple):
     pass
 
+class MultiOperationRequest(NamedTuple):
+    operations: List[Any]
+    # Device time of sending, stamped anew on every attempt.
+    sent: Optional[datetime] = None
+
+class MultiOperationResponse(NamedTuple):
+    replies: List[Any]
+
+class WorkReportRequest(NamedTuple):
+    start: datetime
+    stop: datetime
+
+class WorkReportResponse(NamedTuple):
+    # (workstation code, batch name, seconds worked)
+    rows: List[Tuple[str, str, float]]
+
+class TerminateWorkRunsRequest(NamedTuple):
+    # Journaled by the primary's terminator with the time it ran at.
+    time: datetime
+    work_run_timeout: float
+
+class TerminateWorkRunsResponse(NamedTuple):
+    pass
+
+class StatsRequest(NamedTuple):
+    pass
+
+class StatsResponse(NamedTuple):
+    server: Dict[str, Any]
+    # Latest stats each workstation sent with its heartbeats.
+    devices: Dict[str, Dict[str, Any]]
+
+class JournalRequest(NamedTuple):
+    after: int
+    limit: int = 1000
+
+class JournalResponse(NamedTuple):
+    entries: List[Tuple[int, Any]]
+
+class PromoteRequest(NamedTuple):
+    pass
+
+class PromoteResponse(NamedTuple):
+    pass
+
+class FenceRequest(NamedTuple):
+    pass
+
+class FenceResponse(NamedTuple):
+    pass
+
 class ErrorResponse(NamedTuple):
     exception: Exception
     stack_summary: StackSummary
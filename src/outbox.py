@@ -0,0 +1,142 @@
+# Copyright (C) 2018 Metatavu Oy
+# 
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+# 
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import pickle
+import sqlite3
+import time
+from datetime import datetime
+from threading import Lock
+from typing import Any, List, Tuple
+
+from message import MultiOperationRequest
+
+
+def is_event(message: Any) -> bool:
+    """Tells whether a message records something that happened on the device."""
+    if isinstance(message, MultiOperationRequest):
+        return any(is_event(x) for x in message.operations)
+    return "timestamp" in getattr(message, "_fields", ())
+
+
+_WALL_ANCHOR = time.time()
+_MONOTONIC_ANCHOR = time.monotonic()
+
+
+def device_now() -> datetime:
+    """The wall clock time at startup advanced by the monotonic clock.
+
+    Unlike datetime.now(), this does not jump when the system clock is set,
+    so the times of events keep their order and spacing. The server
+    corrects for the remaining offset of the device clock.
+    """
+    return datetime.fromtimestamp(
+        _WALL_ANCHOR + (time.monotonic() - _MONOTONIC_ANCHOR))
+
+
+def timestamped(message: Any) -> Any:
+    """Stamps an event message with the device time if it has no time yet."""
+    if isinstance(message, MultiOperationRequest):
+        return MultiOperationRequest(
+            [timestamped(x) for x in message.operations])
+    if getattr(message, "timestamp", False) is None:
+        return message._replace(timestamp=device_now())
+    return message
+
+
+class Outbox:
+    """Append-only, persistent queue of messages waiting for the server.
+
+    Messages are kept in an SQLite file in the order they were appended and
+    survive restarts of the client until they are removed. Messages that
+    cannot be delivered are buried in a separate table with the error, to
+    be looked into by hand.
+    """
+    _lock: Lock
+    _db: sqlite3.Connection
+
+    def __init__(self, path: str) -> None:
+        self._lock = Lock()
+        self._db = sqlite3.connect(path,
+                                   check_same_thread=False,
+                                   isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("""CREATE TABLE IF NOT EXISTS "Outbox" (
+                                "id" INTEGER PRIMARY KEY AUTOINCREMENT,
+                                "message" BLOB NOT NULL)""")
+        self._db.execute("""CREATE TABLE IF NOT EXISTS "DeadLetter" (
+                                "id" INTEGER PRIMARY KEY,
+                                "message" BLOB NOT NULL,
+                                "error" TEXT NOT NULL)""")
+
+    def append(self, message: Any) -> int:
+        payload = pickle.dumps(message)
+        with self._lock:
+            cursor = self._db.execute(
+                """INSERT INTO "Outbox" ("message") VALUES (?)""",
+                (payload,))
+            entry_id = cursor.lastrowid
+        assert isinstance(entry_id, int)
+        return entry_id
+
+    def peek(self, limit: int) -> List[Tuple[int, Any]]:
+        with self._lock:
+            rows = self._db.execute(
+                """SELECT "id", "message" FROM "Outbox"
+                   ORDER BY "id" LIMIT ?""",
+                (limit,)).fetchall()
+        return [(entry_id, pickle.loads(payload))
+                for entry_id, payload in rows]
+
+    def remove(self, entry_ids: List[int]) -> None:
+        with self._lock:
+            self._db.execute("BEGIN")
+            self._db.executemany(
+                """DELETE FROM "Outbox" WHERE "id" = ?""",
+                [(entry_id,) for entry_id in entry_ids])
+            self._db.execute("COMMIT")
+
+    def bury(self, entry_id: int, reason: str) -> None:
+        """Moves a message out of the queue into the dead letters."""
+        with self._lock:
+            self._db.execute("BEGIN")
+            self._db.execute(
+                """INSERT INTO "DeadLetter" ("id", "message", "error")
+                   SELECT "id", "message", ? FROM "Outbox" WHERE "id" = ?""",
+                (reason, entry_id))
+            self._db.execute(
+                """DELETE FROM "Outbox" WHERE "id" = ?""", (entry_id,))
+            self._db.execute("COMMIT")
+
+    def dead_letters(self) -> List[Tuple[int, Any, str]]:
+        with self._lock:
+            rows = self._db.execute(
+                """SELECT "id", "message", "error" FROM "DeadLetter"
+                   ORDER BY "id" """).fetchall()
+        return [(entry_id, pickle.loads(payload), reason)
+                for entry_id, payload, reason in rows]
+
+    def __len__(self) -> int:
+        with self._lock:
+            count, = self._db.execute(
+                """SELECT COUNT(*) FROM "Outbox" """).fetchone()
+        assert isinstance(count, int)
+        return count
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
+
+# vim: tw=80 sw=4 ts=4 expandtab:
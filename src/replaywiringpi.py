@@ -0,0 +1,163 @@
+# Copyright (C) 2018 Metatavu Oy
+# 
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+# 
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""A wiringpi-compatible backend that replays sample traces.
+
+    python replaywiringpi.py config.toml samples/samples-*.bin
+
+runs recorded segments through `sensors.SensorSystem` on a virtual clock,
+as fast as the CPU allows, and prints the sensor changes it detected. The
+channels and sample rate are read from the device configuration the
+segments were recorded with.
+"""
+
+import sys
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+import toml
+
+from client_model import Sensor
+from sensors import (Channel, ChannelType, SensorSystem, configured_channels,
+                     default_channels, read_segment)
+
+
+class VirtualClock:
+    """A clock that only advances when slept on."""
+    _now: float
+
+    def __init__(self, start: float = 0.0) -> None:
+        self._now = start
+
+    def time(self) -> float:
+        return self._now
+
+    def sleep(self, seconds: float) -> None:
+        self._now += max(0.0, seconds)
+
+
+class Trace:
+    """Pin values over time; each value holds until the next timestamp."""
+    times: np.ndarray
+    digital: Dict[int, np.ndarray]
+    analog: Dict[int, np.ndarray]
+
+    def __init__(self,
+                 times: np.ndarray,
+                 digital: Dict[int, np.ndarray],
+                 analog: Dict[int, np.ndarray]) -> None:
+        self.times = np.asarray(times, dtype=np.float64)
+        self.digital = {pin: np.asarray(values)
+                        for pin, values in digital.items()}
+        self.analog = {pin: np.asarray(values)
+                       for pin, values in analog.items()}
+
+    @property
+    def start(self) -> float:
+        return float(self.times[0])
+
+    @property
+    def end(self) -> float:
+        return float(self.times[-1])
+
+    @classmethod
+    def from_segments(cls,
+                      paths: Sequence[str],
+                      channels: Optional[Sequence[Channel]] = None) -> 'Trace':
+        """Reads segments written by `sensors.SampleRecorder`, oldest first.
+
+        `channels` are the channels the segments were recorded with.
+        """
+        records = np.concatenate([read_segment(path) for path in paths])
+        values = records['values']
+        digital = {}
+        analog = {}
+        for index, channel in enumerate(channels or default_channels()):
+            if channel.type == ChannelType.AMPLITUDE:
+                analog[channel.pin] = values[:, index]
+            else:
+                digital[channel.pin] = values[:, index]
+        return cls(records['time'], digital, analog)
+
+
+class ReplayWiringPi:
+    """Answers reads with the trace value at the time of `clock`."""
+    _trace: Trace
+    _clock: VirtualClock
+    _cursor: int
+
+    def __init__(self, trace: Trace, clock: VirtualClock) -> None:
+        self._trace = trace
+        self._clock = clock
+        self._cursor = 0
+
+    def wiringPiSetup(self) -> None:
+        pass
+
+    def pinMode(self, pin: int, mode: int) -> None:
+        pass
+
+    def digitalWrite(self, pin: int, value: int) -> None:
+        pass
+
+    def digitalRead(self, pin: int) -> int:
+        return int(self._trace.digital[pin][self._index()])
+
+    def analogRead(self, pin: int) -> int:
+        return int(self._trace.analog[pin][self._index()])
+
+    def _index(self) -> int:
+        times = self._trace.times
+        now = self._clock.time()
+        while self._cursor + 1 < len(times) and times[self._cursor + 1] <= now:
+            self._cursor += 1
+        return self._cursor
+
+
+def replay(trace: Trace, **kwargs: Any) -> List[Tuple[float, Sensor]]:
+    """Runs `trace` through a SensorSystem built with `kwargs`.
+
+    Returns the sensor changes with the virtual time they were detected at.
+    """
+    clock = VirtualClock(trace.start)
+    events: List[Tuple[float, Sensor]] = []
+    system = SensorSystem(lambda callback: callback(0),
+                          backend=ReplayWiringPi(trace, clock),
+                          clock=clock.time,
+                          sleep=clock.sleep,
+                          **kwargs)
+    system.add_sensor_change_listener(
+        lambda sensor: events.append((clock.time(), sensor)))
+    system.run(trace.end)
+    return events
+
+
+def main() -> None:
+    config = toml.load(sys.argv[1])
+    channels = configured_channels(config)
+    trace = Trace.from_segments(sorted(sys.argv[2:]), channels)
+    events = replay(trace,
+                    sample_rate=config.get("sample_rate", 1000.0),
+                    block_size=config.get("sample_block_size", 50),
+                    channels=channels)
+    for timestamp, sensor in events:
+        print("{:14.3f} {} {}".format(
+            timestamp - trace.start, sensor.name, sensor.active))
+
+
+if __name__ == '__main__':
+    main()
+
+# vim: tw=80 sw=4 ts=4 expandtab:
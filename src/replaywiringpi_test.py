@@ -0,0 +1,69 @@
+# Copyright (C) 2018 Metatavu Oy
+# 
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+# 
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import sys
+from typing import Any
+
+import numpy as np
+
+from replaywiringpi import Trace, main, replay
+from sensors import SampleRecorder, default_channels
+
+
+def test_replay_reports_changes_on_virtual_clock() -> None:
+    times = np.arange(0.0, 600.0, 0.5)
+    current = np.where((times >= 100) & (times < 200),
+                       2048 + 100 * (-1) ** np.arange(len(times)), 2048)
+    trace = Trace(times,
+                  {0: np.zeros(len(times)), 1: (times >= 300) * 1},
+                  {0: current})
+    channels = default_channels(current_hold=60.0, current_window=1.0)
+    events = replay(trace, sample_rate=20.0, block_size=10, channels=channels)
+    changes = [(round(t), sensor.identifier, sensor.active)
+               for t, sensor in events]
+    assert changes == [(100, 2, True), (261, 2, False), (300, 3, True)]
+
+
+def test_replay_recorded_segments(tmpdir: Any) -> None:
+    recorder = SampleRecorder(str(tmpdir), 3)
+    recorder.write([10.0, 10.5, 11.0, 11.5],
+                   [[0, 1, 1, 1], [2048] * 4, [0, 0, 1, 1]])
+    recorder.close()
+    trace = Trace.from_segments(recorder.segments)
+    events = replay(trace, sample_rate=10.0, block_size=1)
+    assert [(sensor.identifier, sensor.active) for _, sensor in events] == \
+        [(1, True), (1, False), (3, True)]
+
+
+def test_main_uses_configured_channels(tmpdir: Any, monkeypatch: Any,
+                                       capsys: Any) -> None:
+    recorder = SampleRecorder(str(tmpdir), 1)
+    recorder.write([10.0, 10.5, 11.0], [[0, 1, 1]])
+    recorder.close()
+    config = tmpdir.join("config.toml")
+    config.write("""sample_rate=10.0
+sample_block_size=1
+[[channels]]
+id=7
+name="Ovi"
+pin=5
+type="level"
+""")
+    monkeypatch.setattr(sys, "argv",
+                        ["replaywiringpi.py", str(config)] + recorder.segments)
+    main()
+    assert capsys.readouterr().out.split()[1:] == ["Ovi", "True"]
+
+# vim: tw=80 sw=4 ts=4 expandtab:
@@ -0,0 +1,63 @@
+# Copyright (C) 2018 Metatavu Oy
+# 
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+# 
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Writes the time worked on each batch between two dates as CSV.
+
+    python report.py tcp://server:5555 2018-01-01 2018-02-01 > report.csv
+
+The report is read from the server's reporting snapshot, if it has one,
+so that it does not hold up the workstations.
+"""
+
+import csv
+import sys
+from datetime import datetime
+from typing import Iterable, TextIO, Tuple
+
+from serverconnection import ServerConnection
+
+
+def write_report(rows: Iterable[Tuple[str, str, float]],
+                 stream: TextIO) -> None:
+    writer = csv.writer(stream)
+    writer.writerow(["workstation", "batch", "hours"])
+    for workstation_code, batch_name, seconds in rows:
+        writer.writerow([workstation_code, batch_name,
+                         f"{seconds / 3600:.3f}"])
+
+
+DATE_FORMAT = "%Y-%m-%d"
+
+# A long report may take minutes, and is never worth running twice.
+REPORT_TIMEOUT = 600.0
+
+
+def main() -> None:
+    start = datetime.strptime(sys.argv[2], DATE_FORMAT)
+    stop = datetime.strptime(sys.argv[3], DATE_FORMAT)
+    server_connection = ServerConnection(sys.argv[1],
+                                         timeout=REPORT_TIMEOUT, retries=0)
+    server_connection.connect()
+    try:
+        write_report(server_connection.get_work_report(start, stop),
+                     sys.stdout)
+    finally:
+        server_connection.stop()
+
+
+if __name__ == '__main__':
+    main()
+
+# vim: tw=80 sw=4 ts=4 expandtab:
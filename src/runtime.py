@@ -0,0 +1,228 @@
+# Copyright (C) 2018 Metatavu Oy
+# 
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+# 
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+from typing import Any, Callable, Dict, List, Optional
+
+import toml
+
+from batchcache import BatchNameCache
+from client_model import SensorSystem as SensorSystemInterface
+from client_model import (Device, Heartbeat, SensorRole, SensorSubset,
+                          TransitionFilter, WorkstationState,
+                          WorkstationStateEngine)
+from leddriver import LedDriver
+from outbox import Outbox
+from sensors import SampleRecorder, SensorSystem, configured_channels
+from serverconnection import QueuedServerConnection, ServerConnection
+from stats import write_stats
+
+LED_COLORS = {
+    WorkstationState.EMPTY: (255, 0, 0),
+    WorkstationState.IDLE: (255, 255, 0),
+    WorkstationState.ACTIVE: (0, 255, 0),
+}
+
+
+class ConfigurationException(Exception):
+    pass
+
+
+def load_config() -> Dict[str, Any]:
+    if 'REIFER_MONITOR_CONFIG' in os.environ:
+        conf = toml.load(os.environ['REIFER_MONITOR_CONFIG'])
+        assert isinstance(conf, dict)
+        return conf
+    elif len(sys.argv) >= 2:
+        conf = toml.load(sys.argv[1])
+        assert isinstance(conf, dict)
+        return conf
+    else:
+        raise ConfigurationException(
+            "Configuration file location not set. " +
+            "Pass it as argv[1] or REIFER_MONITOR_CONFIG " +
+            "environment variable.")
+
+
+class Runtime:
+    """The sensors, LED, server connection and device of a station.
+
+    A `[[workstations]]` table in the config, each with a `code` and the
+    `channels` that belong to it, makes one Device per workstation. They
+    share the sensor system and the server connection. The LED and `model`
+    are those of the first workstation.
+
+    Everything runs its callbacks through `schedule_once` and
+    `schedule_interval`, which follow Kivy's Clock, so the same runtime
+    serves both the Kivy UI and the headless client.
+    """
+    sensor_system: SensorSystem
+    led_driver: LedDriver
+    server_connection: ServerConnection
+    models: List[Device]
+    model: Device
+
+    def __init__(
+            self,
+            config: Dict[str, Any],
+            schedule_once: Callable[..., Any],
+            schedule_interval: Callable[[Callable[..., None], float], Any]
+            ) -> None:
+        if "connect_url" not in config:
+            raise ConfigurationException("`connect_url` not set in configuration")
+        channels = configured_channels(config)
+        recorder = (SampleRecorder(config["record_path"], len(channels),
+                                   config.get("record_segment_size",
+                                              16 * 1024 * 1024),
+                                   config.get("record_max_size",
+                                              256 * 1024 * 1024))
+                    if "record_path" in config else None)
+        sensor_system = SensorSystem(schedule_once,
+                                     config.get("sample_rate", 1000.0),
+                                     config.get("sample_block_size", 50),
+                                     channels,
+                                     recorder)
+        sensor_system.start()
+        self.sensor_system = sensor_system
+        self.led_driver = LedDriver(config.get("led_port"),
+                                    config.get("led_reconnect_interval", 5.0),
+                                    config.get("led_write_timeout", 1.0))
+        self.led_driver.start()
+        self.led_driver.set_color(*LED_COLORS[WorkstationState.EMPTY])
+        server_connection: ServerConnection
+        if config.get("queue_server_calls", True):
+            outbox = (Outbox(config["outbox_path"])
+                      if "outbox_path" in config else None)
+            server_connection = QueuedServerConnection(
+                config["connect_url"],
+                schedule_once,
+                outbox,
+                config.get("outbox_batch_size", 50),
+                config.get("outbox_max_attempts", 10),
+                config.get("request_timeout", 5.0),
+                config.get("request_retries", 3),
+                config.get("retry_backoff", 0.5))
+        else:
+            server_connection = ServerConnection(
+                config["connect_url"],
+                config.get("request_timeout", 5.0),
+                config.get("request_retries", 3),
+                config.get("retry_backoff", 0.5))
+        server_connection.connect()
+        self.server_connection = server_connection
+        batch_names = BatchNameCache(server_connection,
+                                     config.get("batch_name_ttl", 300.0))
+        batch_names.warm(config.get("batch_name_prefetch", 500))
+        sensor_roles = {channel.identifier: channel.role
+                        for channel in channels}
+        if "sensor_roles" in config:
+            sensor_roles.update({int(identifier): SensorRole[role.upper()]
+                                 for identifier, role
+                                 in config["sensor_roles"].items()})
+        workstations = config.get("workstations", [{
+            "code": config.get("workstation_code", "WS"),
+            "channels": [channel.identifier for channel in channels]
+        }])
+        self.models = []
+        for workstation in workstations:
+            sensors = SensorSubset(sensor_system, workstation["channels"])
+            self.models.append(self._make_device(
+                config, schedule_once, workstation["code"], sensors,
+                batch_names, sensor_roles))
+        self.model = self.models[0]
+        self.model.add_workstation_state_changed_listener(
+            self._on_workstation_state_change)
+        self._on_workstation_state_change(self.model.workstation_state)
+        if "stats_path" in config:
+            stats_path = config["stats_path"]
+            schedule_interval(
+                lambda dt: write_stats(stats_path, self.collect_stats()),
+                config.get("stats_interval", 10.0))
+
+    def _make_device(self,
+                     config: Dict[str, Any],
+                     schedule_once: Callable[..., Any],
+                     workstation_code: str,
+                     sensors: SensorSystemInterface,
+                     batch_names: BatchNameCache,
+                     sensor_roles: Dict[int, SensorRole]) -> Device:
+        work_run_filter = TransitionFilter(
+            False,
+            on_delay=config.get("work_run_on_delay", 0.0),
+            off_delay=config.get("work_run_off_delay", 0.0),
+            min_dwell=config.get("work_run_min_dwell", 0.0),
+            flap_window=config.get("work_run_flap_window", 0.0),
+            max_flaps=config.get("work_run_max_flaps", 0),
+            schedule=schedule_once)
+        presence_filter = TransitionFilter(
+            True,
+            on_delay=0.0,
+            off_delay=config.get("presence_off_delay", 0.0),
+            schedule=schedule_once)
+        heartbeat = Heartbeat(config.get("heartbeat_interval", 15.0),
+                              schedule_once)
+        heartbeat.negotiate(self.server_connection)
+        return Device(workstation_code,
+                      sensors,
+                      self.server_connection,
+                      batch_names,
+                      work_run_filter,
+                      presence_filter,
+                      heartbeat,
+                      WorkstationStateEngine(sensor_roles),
+                      (self.collect_stats
+                       if config.get("stats_in_heartbeat", False) else None))
+
+    def _on_workstation_state_change(self, state: WorkstationState) -> None:
+        self.led_driver.set_color(*LED_COLORS[state])
+
+    def device(self, workstation_code: str) -> Device:
+        for model in self.models:
+            if model.workstation_code == workstation_code:
+                return model
+        raise KeyError(workstation_code)
+
+    def scan_batch_code(self,
+                        batch_code: str,
+                        workstation_code: Optional[str] = None) -> str:
+        """Starts work on a scanned batch, or ends it if it is scanned again.
+
+        Without `workstation_code`, the batch is for the first workstation.
+        Returns the batch code now in use on the workstation.
+        """
+        model = (self.model if workstation_code is None
+                 else self.device(workstation_code))
+        if model.batch_code == batch_code:
+            model.batch_code = ""
+        else:
+            model.batch_code = batch_code
+        return model.batch_code
+
+    def collect_stats(self) -> Dict[str, Any]:
+        return {
+            "sensors": self.sensor_system.stats.snapshot(),
+            "devices": {model.workstation_code: model.stats.snapshot()
+                        for model in self.models},
+            "server": self.server_connection.stats.snapshot(),
+            "led": self.led_driver.stats.snapshot()
+        }
+
+    def stop(self) -> None:
+        self.sensor_system.stop()
+        self.led_driver.stop()
+        self.server_connection.stop()
+
+# vim: tw=80 sw=4 ts=4 expandtab:
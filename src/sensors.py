@@ -13,13 +13,23 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from typing import TYPE_CHECKING, Callable, Dict, List, Tuple, Any
-from operator import itemgetter
+import math
+import os
+import time
+from array import array
+from functools import partial
+from threading import Thread
 from enum import Enum
-from sys import stderr
+from typing import (TYPE_CHECKING, Any, Callable, Dict, List, NamedTuple,
+                    Optional, Sequence, Tuple)
+
+import numpy as np
 
 from client_model import SensorSystem as SensorSystemInterface
-from client_model import Sensor
+from client_model import (CURRENT_SENSOR, PROXIMITY_SENSOR, VIBRATION_SENSOR,
+                          Sensor, SensorRole)
+from dsp import Stage, amplitude_pipeline
+from stats import Stats
 
 if TYPE_CHECKING:
     import fakewiringpi as wiringpi
@@ -30,7 +40,232 @@ else:
         import fakewiringpi as wiringpi
 
 
+class ChannelType(Enum):
+    EDGE = "edge"
+    LEVEL = "level"
+    AMPLITUDE = "amplitude"
+
+
+class Channel(NamedTuple):
+    """One input and how to detect activity on it.
+
+    EDGE and LEVEL channels are read with digitalRead, AMPLITUDE channels
+    with analogRead. `hold` applies to EDGE and AMPLITUDE channels, the
+    rest only to AMPLITUDE channels.
+    """
+    identifier: int
+    name: str
+    pin: int
+    type: ChannelType
+    role: SensorRole = SensorRole.ACTIVITY
+    hold: float = 0.3
+    window: float = 0.256
+    bias: float = 2048
+    threshold: float = 25
+    hysteresis: float = 0
+
+
+def default_channels(vibration_hold: float = 0.3,
+                     current_hold: float = 60.0,
+                     current_window: float = 0.256) -> List[Channel]:
+    """The vibration, current and PIR sensors of the original board."""
+    return [
+        Channel(VIBRATION_SENSOR, "Tärinä", 0, ChannelType.EDGE,
+                SensorRole.ACTIVITY, hold=vibration_hold),
+        Channel(CURRENT_SENSOR, "Virta", 0, ChannelType.AMPLITUDE,
+                SensorRole.ACTIVITY, hold=current_hold, window=current_window),
+        Channel(PROXIMITY_SENSOR, "PIR", 1, ChannelType.LEVEL,
+                SensorRole.PRESENCE)
+    ]
+
+
+def channels_from_config(table: List[Dict[str, Any]]) -> List[Channel]:
+    """Reads the `[[channels]]` tables of the device configuration."""
+    channels = []
+    for entry in table:
+        entry = dict(entry)
+        identifier = int(entry.pop("id"))
+        channels.append(Channel(
+            identifier,
+            entry.pop("name", str(identifier)),
+            int(entry.pop("pin")),
+            ChannelType(entry.pop("type")),
+            SensorRole[entry.pop("role", "activity").upper()],
+            **{key: float(value) for key, value in entry.items()}))
+    return channels
+
+
+def configured_channels(config: Dict[str, Any]) -> List[Channel]:
+    """The channel table of the device configuration, or the default one."""
+    if "channels" in config:
+        return channels_from_config(config["channels"])
+    return default_channels(config.get("vibration_hold", 0.3),
+                            config.get("current_hold", 60.0),
+                            config.get("current_window", 0.256))
+
+
+class RingBuffer:
+    """Preallocated buffer of the most recent timestamped samples.
+
+    There is a single writer, the acquisition thread. It fills a slot
+    before it advances `written`, so readers never need a lock. A reader
+    that falls more than `capacity` samples behind loses the samples that
+    were overwritten.
+    """
+    capacity: int
+    written: int
+    _times: array
+    _values: List[array]
+
+    def __init__(self, capacity: int, channels: int) -> None:
+        self.capacity = capacity
+        self.written = 0
+        self._times = array('d', bytes(8 * capacity))
+        self._values = [array('l', [0]) * capacity for _ in range(channels)]
+
+    def append(self, timestamp: float, values: Sequence[int]) -> None:
+        index = self.written % self.capacity
+        self._times[index] = timestamp
+        for channel, value in enumerate(values):
+            self._values[channel][index] = value
+        self.written += 1
+
+    def oldest(self) -> int:
+        return max(0, self.written - self.capacity)
+
+    def times(self, start: int, stop: int) -> array:
+        return self._read(self._times, start, stop)
+
+    def values(self, channel: int, start: int, stop: int) -> array:
+        return self._read(self._values[channel], start, stop)
+
+    def _read(self, data: array, start: int, stop: int) -> array:
+        start = max(start, self.oldest())
+        if stop <= start:
+            return data[0:0]
+        first = start % self.capacity
+        last = stop % self.capacity
+        if first < last:
+            return data[first:last]
+        return data[first:] + data[:last]
+
+
+RECORD_MAGIC = b'RFSM'
+
+RECORD_HEADER = np.dtype([
+    ('magic', 'S4'),
+    ('channels', '<u2'),
+    ('reserved', '<u2'),
+    ('count', '<u8')
+])
+
+
+def record_dtype(channels: int) -> np.dtype:
+    """Fixed-width record of a segment: a timestamp and one int16 per channel."""
+    return np.dtype([('time', '<f8'), ('values', '<i2', (channels,))])
+
+
+def read_segment(path: str) -> np.ndarray:
+    """Maps the records written to a segment file, read-only."""
+    header = np.memmap(path, RECORD_HEADER, 'r', shape=(1,))[0]
+    if header['magic'] != RECORD_MAGIC:
+        raise ValueError("not a sample segment: {}".format(path))
+    count = int(header['count'])
+    if count == 0:
+        return np.zeros(0, record_dtype(int(header['channels'])))
+    return np.memmap(path, record_dtype(int(header['channels'])), 'r',
+                     offset=RECORD_HEADER.itemsize, shape=(count,))
+
+
+class SampleRecorder:
+    """Writes raw samples into rotating, preallocated segment files.
+
+    Each segment is `segment_size` bytes: a header with the record count
+    followed by fixed-width records, written through a memory map. When a
+    segment is full the next one is started, and the oldest ones are
+    deleted so that at most `max_size` bytes are kept. Segments can be
+    read with `read_segment`.
+    """
+    _directory: str
+    _channels: int
+    _dtype: np.dtype
+    _capacity: int
+    _max_segments: int
+    _sequence: int
+    _segments: List[str]
+    _header: Optional[np.memmap]
+    _records: Optional[np.memmap]
+    _count: int
+
+    def __init__(self,
+                 directory: str,
+                 channels: int,
+                 segment_size: int = 16 * 1024 * 1024,
+                 max_size: int = 256 * 1024 * 1024) -> None:
+        self._directory = directory
+        self._channels = channels
+        self._dtype = record_dtype(channels)
+        self._capacity = max(
+            1, (segment_size - RECORD_HEADER.itemsize) // self._dtype.itemsize)
+        self._max_segments = max(1, max_size // segment_size)
+        os.makedirs(directory, exist_ok=True)
+        self._segments = sorted(
+            os.path.join(directory, name) for name in os.listdir(directory)
+            if name.startswith("samples-") and name.endswith(".bin"))
+        self._sequence = (int(self._segments[-1][-14:-4]) + 1
+                          if self._segments else 0)
+        self._header = None
+        self._records = None
+        self._count = 0
+
+    @property
+    def segments(self) -> List[str]:
+        return list(self._segments)
+
+    def write(self, times: Sequence[float], values: Sequence[Sequence[int]]) -> None:
+        """Appends a block of samples, `values` holding one sequence per channel."""
+        written = 0
+        while written < len(times):
+            if self._records is None or self._count == self._capacity:
+                self._rotate()
+            assert self._records is not None and self._header is not None
+            n = min(len(times) - written, self._capacity - self._count)
+            block = self._records[self._count:self._count + n]
+            block['time'] = times[written:written + n]
+            for channel in range(self._channels):
+                block['values'][:, channel] = \
+                    values[channel][written:written + n]
+            self._count += n
+            self._header['count'] = self._count
+            written += n
+
+    def _rotate(self) -> None:
+        self.close()
+        path = os.path.join(self._directory,
+                            "samples-{:010d}.bin".format(self._sequence))
+        self._sequence += 1
+        self._records = np.memmap(path, self._dtype, 'w+',
+                                  offset=RECORD_HEADER.itemsize,
+                                  shape=(self._capacity,))
+        self._header = np.memmap(path, RECORD_HEADER, 'r+', shape=(1,))
+        self._header['magic'] = RECORD_MAGIC
+        self._header['channels'] = self._channels
+        self._count = 0
+        self._segments.append(path)
+        while len(self._segments) > self._max_segments:
+            os.remove(self._segments.pop(0))
+
+    def close(self) -> None:
+        if self._records is not None:
+            self._records.flush()
+            self._records = None
+        if self._header is not None:
+            self._header.flush()
+            self._header = None
+
+
 class QuickAmplitudeMeasurer:
+    """Per-sample reference for `dsp.amplitude_pipeline`, kept for bench_dsp."""
     _bias: int
     _threshold: int
     _averaging: int
@@ -55,76 +290,275 @@ class QuickAmplitudeMeasurer:
             return (sum(self._values) / len(self._values)) > self._threshold
 
 
+class EdgeDetector:
+    """Active while the input has changed within the last `hold` seconds."""
+    _hold: float
+    _last: bool
+    _changed_at: float
+    _now: float
+
+    def __init__(self, hold: float) -> None:
+        self._hold = hold
+        self._last = False
+        self._changed_at = -math.inf
+        self._now = -math.inf
+
+    def process(self, times: Sequence[float], samples: Sequence[int]) -> bool:
+        for timestamp, sample in zip(times, samples):
+            value = bool(sample)
+            if value != self._last:
+                self._last = value
+                self._changed_at = timestamp
+        if len(times) > 0:
+            self._now = times[-1]
+        return self._now - self._changed_at < self._hold
+
+
+class AmplitudeDetector:
+    """Active until the amplitude has been under threshold for `hold` seconds.
+
+    `pipeline` turns a block of raw samples into one over-threshold flag per
+    sample, see `dsp.amplitude_pipeline`.
+    """
+    _pipeline: Stage
+    _hold: float
+    _over_at: float
+    _now: float
+
+    def __init__(self, pipeline: Stage, hold: float) -> None:
+        self._pipeline = pipeline
+        self._hold = hold
+        self._over_at = -math.inf
+        self._now = -math.inf
+
+    def process(self, times: Sequence[float], samples: Sequence[int]) -> bool:
+        over = self._pipeline.process(np.asarray(samples, dtype=np.float64))
+        hits = np.flatnonzero(over)
+        if len(hits) > 0:
+            self._over_at = times[int(hits[-1])]
+        if len(times) > 0:
+            self._now = times[-1]
+        return self._now - self._over_at < self._hold
+
+
+class LevelDetector:
+    """Active while the input is high."""
+    _last: bool
+
+    def __init__(self) -> None:
+        self._last = False
+
+    def process(self, times: Sequence[float], samples: Sequence[int]) -> bool:
+        if len(samples) > 0:
+            self._last = bool(samples[-1])
+        return self._last
+
+
 class SensorSystem(SensorSystemInterface):
-    _vibration_active: bool
-    _vibration_sample: bool
-    _time_since_vibration_change: int
-    _current_off_time: int
-    _current_active: bool
-    _current_measurer: QuickAmplitudeMeasurer
+    """Samples the sensors on a thread of its own at a fixed rate.
+
+    Samples go into a ring buffer, and detection runs on each block of
+    `block_size` samples. Hold times and the averaging window are given in
+    seconds and measured on the sample timestamps, so changing
+    `sample_rate` trades CPU time for resolution without changing what is
+    detected. Each of `channels` is read once per tick, in order, and
+    becomes a sensor of its own. Only the resulting sensor changes are handed to
+    `schedule`, which runs them on the UI thread, so the sampling rate
+    does not depend on the frame rate of the UI.
+    """
+    _sample_rate: float
+    _block_size: int
+    _ring: RingBuffer
+    _channels: List[Channel]
+    _detectors: List[Any]
+    _detected: List[bool]
     _sensor_change_listeners: List[Callable[[Sensor], None]]
     _schedule: Tuple[Callable[[Callable[..., None]], None]]
-    _proximity_active: bool
+    _sensors: List[Sensor]
+    _running: bool
+    _thread: Optional[Thread]
+    _backend: Any
+    _clock: Tuple[Callable[[], float]]
+    _sleep: Tuple[Callable[[float], None]]
+    _recorder: Optional[SampleRecorder]
+    _recorder_thread: Optional[Thread]
+    overruns: int
+    dropped: int
+    stats: Stats
 
     def __init__(self,
-            schedule: Callable[[Callable[..., None]], None]) -> None:
-        self._vibration_active = False
-        self._vibration_sample = False
-        self._time_since_vibration_change = 10000
-        self._current_off_time = 10000
-        self._current_active = False
-        self._proximity_active = False
+            schedule: Callable[[Callable[..., None]], None],
+            sample_rate: float = 1000.0,
+            block_size: int = 50,
+            channels: Optional[Sequence[Channel]] = None,
+            recorder: Optional[SampleRecorder] = None,
+            backend: Any = None,
+            clock: Callable[[], float] = time.monotonic,
+            sleep: Callable[[float], None] = time.sleep) -> None:
+        self._sample_rate = sample_rate
+        self._block_size = block_size
+        self._channels = list(default_channels() if channels is None
+                              else channels)
+        self._ring = RingBuffer(max(block_size, int(2 * sample_rate)),
+                                len(self._channels))
+        self._detectors = [self._new_detector(channel)
+                           for channel in self._channels]
+        self._detected = [False] * len(self._detectors)
         self._sensor_change_listeners = []
         self._schedule = (schedule,)
-        self._current_measurer = self._new_measurer()
+        self._sensors = [Sensor(channel.identifier, channel.name, False)
+                         for channel in self._channels]
+        self._running = False
+        self._thread = None
+        self._backend = wiringpi if backend is None else backend
+        self._clock = (clock,)
+        self._sleep = (sleep,)
+        self._recorder = recorder
+        self._recorder_thread = None
+        self.overruns = 0
+        self.dropped = 0
+        self.stats = Stats()
+
+    def _new_detector(self, channel: Channel) -> Any:
+        if channel.type == ChannelType.EDGE:
+            return EdgeDetector(channel.hold)
+        if channel.type == ChannelType.LEVEL:
+            return LevelDetector()
+        averaging = max(1, int(round(channel.window * self._sample_rate)))
+        pipeline = amplitude_pipeline(channel.bias, channel.threshold,
+                                      averaging, channel.hysteresis)
+        return AmplitudeDetector(pipeline, channel.hold)
+
+    @property
+    def channels(self) -> List[Channel]:
+        return list(self._channels)
 
-    def _new_measurer(self) -> QuickAmplitudeMeasurer:
-        return QuickAmplitudeMeasurer(2048, 25, 256)
+    @property
+    def ring(self) -> RingBuffer:
+        return self._ring
+
+    def _setup(self) -> None:
+        self._backend.wiringPiSetup()
+        for channel in self._channels:
+            if channel.type != ChannelType.AMPLITUDE:
+                self._backend.pinMode(channel.pin, 0)
 
     def start(self) -> None:
-        wiringpi.wiringPiSetup()
-        wiringpi.pinMode(0, 0)
-        wiringpi.pinMode(1, 0)
-        schedule, = self._schedule
-        schedule(self.update)
-
-    def update(self, *args: Any) -> None:
-        vibration_sample = bool(wiringpi.digitalRead(0))
-        if self._vibration_sample != vibration_sample:
-            self._vibration_sample = vibration_sample
-            self._time_since_vibration_change = 0
-        self._time_since_vibration_change += 1
-        vibration_active = self._time_since_vibration_change < 300
-        if self._vibration_active != vibration_active:
-            self._vibration_active = vibration_active
-            for listener in self._sensor_change_listeners:
-                listener(Sensor(1, "Tärinä", vibration_active))
-        current_sample = wiringpi.analogRead(0)
-        self._current_measurer.sample(current_sample)
-        if self._current_measurer.over_threshold():
-            self._current_off_time = 0
-        else:
-            self._current_off_time += 1
-        current_active = self._current_off_time < 60*1000
-        if self._current_active != current_active:
-            self._current_active = current_active
-            for listener in self._sensor_change_listeners:
-                listener(Sensor(2, "Virta", current_active))
-        proximity_active = bool(wiringpi.digitalRead(1))
-        if self._proximity_active != proximity_active:
-            self._proximity_active = proximity_active
-            for listener in self._sensor_change_listeners:
-                listener(Sensor(3, "PIR", proximity_active))
+        self._setup()
+        self._running = True
+        self._thread = Thread(target=self._acquire, daemon=True)
+        self._thread.start()
+        if self._recorder is not None:
+            self._recorder_thread = Thread(target=self._record, daemon=True)
+            self._recorder_thread.start()
+
+    def stop(self) -> None:
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._recorder_thread is not None:
+            self._recorder_thread.join()
+            self._recorder_thread = None
+
+    def run(self, until: float) -> None:
+        """Samples on the calling thread until `clock` reaches `until`."""
+        self._setup()
+        self._running = True
+        try:
+            self._acquire(until)
+        finally:
+            self._running = False
+
+    def _acquire(self, until: float = math.inf) -> None:
+        clock, = self._clock
+        sleep, = self._sleep
+        backend = self._backend
+        period = 1.0 / self._sample_rate
+        reads = [(backend.analogRead if channel.type == ChannelType.AMPLITUDE
+                  else backend.digitalRead, channel.pin)
+                 for channel in self._channels]
+        values = [0] * len(reads)
+        block_start = self._ring.written
+        next_tick = clock()
+        block_began = next_tick
+        lateness = 0.0
+        while self._running and next_tick < until:
+            now = clock()
+            lateness = max(lateness, now - next_tick)
+            for index, (read, pin) in enumerate(reads):
+                values[index] = read(pin)
+            self._ring.append(now, values)
+            if self._ring.written - block_start >= self._block_size:
+                self.detect(block_start, self._ring.written)
+                now = clock()
+                self.stats.observe("sample_period",
+                                   (now - block_began) / self._block_size)
+                self.stats.observe("tick_lateness", lateness)
+                block_start = self._ring.written
+                block_began = now
+                lateness = 0.0
+            next_tick += period
+            delay = next_tick - clock()
+            if delay > 0:
+                sleep(delay)
+            elif delay < -self._block_size * period:
+                # Fell a whole block behind; skip ahead instead of bursting.
+                self.overruns += 1
+                self.stats.incr("overruns")
+                next_tick = clock()
+        if self._ring.written > block_start:
+            self.detect(block_start, self._ring.written)
+
+    def _record(self) -> None:
+        assert self._recorder is not None
+        interval = self._block_size / self._sample_rate
+        recorded = self._ring.written
+        while True:
+            running = self._running
+            recorded = self.record(recorded, self._ring.written)
+            if not running:
+                break
+            time.sleep(interval)
+        self._recorder.close()
+
+    def record(self, start: int, stop: int) -> int:
+        """Copies samples [start, stop) of the ring buffer to the recorder.
+
+        Returns the index to continue from.
+        """
+        assert self._recorder is not None
+        oldest = self._ring.oldest()
+        if start < oldest:
+            self.dropped += oldest - start
+            start = oldest
+        self._recorder.write(
+            self._ring.times(start, stop),
+            [self._ring.values(channel, start, stop)
+             for channel in range(len(self._channels))])
+        return stop
+
+    def detect(self, start: int, stop: int) -> None:
+        """Runs detection on samples [start, stop) of the ring buffer."""
         schedule, = self._schedule
-        schedule(self.update)
+        began = time.perf_counter()
+        for index, detector in enumerate(self._detectors):
+            active = detector.process(self._ring.times(start, stop),
+                                      self._ring.values(index, start, stop))
+            if active != self._detected[index]:
+                self._detected[index] = active
+                schedule(partial(self._post_sensor, index, active))
+        self.stats.observe("detect_seconds", time.perf_counter() - began)
+
+    def _post_sensor(self, index: int, active: bool, *args: Any) -> None:
+        sensor = self._sensors[index]._replace(active=active)
+        self._sensors[index] = sensor
+        for listener in self._sensor_change_listeners:
+            listener(sensor)
 
     @property
     def sensors(self) -> List[Sensor]:
-        return [
-            Sensor(1, "Tärinä", self._vibration_active),
-            Sensor(2, "Virta", self._current_active),
-            Sensor(3, "PIR", self._proximity_active)
-        ]
+        return self._sensors
 
     def add_sensor_change_listener(
             self,
@@ -132,4 +566,4 @@ class SensorSystem(SensorSystemInterface):
         self._sensor_change_listeners.append(listener)
 
 
-# vim: tw=80 sw=4 ts=4 expandtab:
\ No newline at end of file
+# vim: tw=80 sw=4 ts=4 expandtab:
@@ -0,0 +1,144 @@
+# Copyright (C) 2018 Metatavu Oy
+# 
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+# 
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+from typing import Any, Callable, List
+
+from client_model import Sensor
+from dsp import amplitude_pipeline
+from client_model import SensorRole
+from sensors import (AmplitudeDetector, Channel, ChannelType, EdgeDetector,
+                     RingBuffer, SampleRecorder, SensorSystem,
+                     channels_from_config, read_segment)
+
+
+def test_ring_buffer_wraps() -> None:
+    ring = RingBuffer(4, 2)
+    for i in range(6):
+        ring.append(float(i), [i, -i])
+    assert list(ring.times(2, 6)) == [2.0, 3.0, 4.0, 5.0]
+    assert list(ring.values(1, 3, 6)) == [-3, -4, -5]
+    assert list(ring.values(0, 0, 6)) == [2, 3, 4, 5]
+
+
+def test_edge_detector_holds() -> None:
+    detector = EdgeDetector(0.3)
+    assert detector.process([0.0, 0.1], [0, 0]) is False
+    assert detector.process([0.2], [1]) is True
+    assert detector.process([0.4], [1]) is True
+    assert detector.process([0.5, 0.6], [1, 1]) is False
+
+
+def test_amplitude_detector_holds() -> None:
+    detector = AmplitudeDetector(amplitude_pipeline(0, 5, 2), 0.3)
+    assert detector.process([0.0, 0.1], [0, 0]) is False
+    assert detector.process([0.2, 0.3, 0.4], [10, 10, 0]) is True
+    assert detector.process([0.5], [0]) is True
+    assert detector.process([0.6], [0]) is False
+
+
+def test_hold_is_independent_of_sample_rate() -> None:
+    for rate in (200.0, 2000.0):
+        subject = SensorSystem(lambda x: None, sample_rate=rate)
+        for i in range(int(0.5 * rate)):
+            subject.ring.append(i / rate, [1, 2048, 0])
+        subject.detect(0, int(0.25 * rate))
+        assert subject._detected[0]
+        subject.detect(int(0.25 * rate), int(0.35 * rate))
+        assert not subject._detected[0]
+
+
+def test_detect_posts_changes_to_schedule() -> None:
+    scheduled: List[Callable[..., None]] = []
+    changes: List[Sensor] = []
+    subject = SensorSystem(scheduled.append, sample_rate=100, block_size=4)
+    subject.add_sensor_change_listener(changes.append)
+    for _ in range(4):
+        subject.ring.append(0.0, [1, 2048, 1])
+    subject.detect(0, 4)
+    assert changes == []
+    assert len(scheduled) == 2
+    for callback in scheduled:
+        callback(0)
+    assert [(x.identifier, x.active) for x in changes] == [(1, True), (3, True)]
+    assert subject.sensors[2].active
+
+
+def test_channels_from_config() -> None:
+    channels = channels_from_config([
+        {"id": 7, "pin": 3, "type": "amplitude", "role": "ignored",
+         "threshold": 40, "hold": 5}
+    ])
+    assert channels == [Channel(7, "7", 3, ChannelType.AMPLITUDE,
+                                SensorRole.IGNORED, hold=5.0, threshold=40.0)]
+
+
+def test_reads_every_configured_channel() -> None:
+    class Backend:
+        def wiringPiSetup(self) -> None:
+            pass
+
+        def pinMode(self, pin: int, mode: int) -> None:
+            pass
+
+        def analogRead(self, pin: int) -> int:
+            return 2048 + 100 * (pin % 2)
+
+    clamps = [Channel(10 + pin, "clamp", pin, ChannelType.AMPLITUDE,
+                      window=0.01)
+              for pin in range(8)]
+    now = [0.0]
+
+    def sleep(seconds: float) -> None:
+        now[0] += seconds
+
+    changes: List[Sensor] = []
+    subject = SensorSystem(lambda callback: callback(0), 1000, 10, clamps,
+                           backend=Backend(), clock=lambda: now[0],
+                           sleep=sleep)
+    subject.add_sensor_change_listener(changes.append)
+    subject.run(0.1)
+    assert [x.identifier for x in subject.sensors] == list(range(10, 18))
+    assert sorted(x.identifier for x in changes) == [11, 13, 15, 17]
+
+
+def test_recorder_rotates_and_bounds_segments(tmpdir: Any) -> None:
+    header = 16
+    record = 8 + 2 * 2
+    recorder = SampleRecorder(str(tmpdir), 2, header + 4 * record,
+                              2 * (header + 4 * record))
+    for i in range(0, 10, 5):
+        recorder.write([float(x) for x in range(i, i + 5)],
+                       [list(range(i, i + 5)), [1] * 5])
+    recorder.close()
+    assert len(os.listdir(str(tmpdir))) == 2
+    records = [read_segment(path) for path in recorder.segments]
+    assert list(records[0]['time']) == [4.0, 5.0, 6.0, 7.0]
+    assert list(records[1]['values'][:, 0]) == [8, 9]
+    assert SampleRecorder(str(tmpdir), 2).segments == recorder.segments
+
+
+def test_record_counts_overwritten_samples(tmpdir: Any) -> None:
+    recorder = SampleRecorder(str(tmpdir), 3)
+    subject = SensorSystem(lambda x: None, sample_rate=2, block_size=1,
+                           recorder=recorder)
+    for i in range(6):
+        subject.ring.append(float(i), [0, i, 0])
+    assert subject.record(0, 6) == 6
+    recorder.close()
+    assert subject.dropped == 2
+    assert list(read_segment(recorder.segments[0])['time']) == [2, 3, 4, 5]
+
+# vim: tw=80 sw=4 ts=4 expandtab:
@@ -15,29 +15,40 @@
 # pylint: disable=E1101,E0601,W0614
 # THIS IS FOR PROTOTYPE USE ONLY, NO SECURITY WHATSOEVER
 
+import asyncio
+import json
 import logging
 import logging.config
 import os
+import pickle
 import re
 import sys
 from abc import ABCMeta, abstractmethod
+from collections import deque
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime, timedelta
+from logging import error
 import time
-from threading import Thread
+from threading import Lock, Thread
 from traceback import extract_tb
-from typing import TYPE_CHECKING, Any, Callable, Dict, Optional, Tuple, List
+from typing import (TYPE_CHECKING, Any, Callable, Deque, Dict, Iterable,
+                    Iterator, List, Optional, Set, Tuple)
 
 import toml
 import yoyo
 import zmq
-from sqlalchemy import (Column, DateTime, ForeignKey, Integer, String,
-                        create_engine, desc)
+import zmq.asyncio
+from sqlalchemy import (Column, DateTime, ForeignKey, Integer, LargeBinary,
+                        String, create_engine, desc, func)
 from sqlalchemy.engine import Engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import Session, relationship, sessionmaker
-from sqlalchemy.exc import DBAPIError
+from sqlalchemy.exc import DBAPIError, IntegrityError
 
 from message import *
+from snapshot import Snapshot
+from writer import Writer
 
 
 class ConfigurationException(Exception):
@@ -47,16 +58,46 @@ class ConfigurationException(Exception):
 if TYPE_CHECKING:
     class BaseEntity:
         metadata: Any
+        __table__: Any
         def __init__(self, **kwargs: Any) -> None:
             pass
 else:
     BaseEntity = declarative_base()
 
 
+# Number of recent heartbeats the device clock offset is estimated from.
+CLOCK_OFFSET_SAMPLES = 16
+
+# Older SQLite versions allow at most 999 parameters per statement.
+BULK_CHUNK_SIZE = 500
+
+# Messages that only read, and so are not written to the journal.
+QUERY_MESSAGES = (ServerInfoRequest, BatchNameQueryRequest,
+                  RecentBatchesQueryRequest, WorkReportRequest, JournalRequest,
+                  StatsRequest)
+
+# Messages that are answered from the reporting snapshot, if there is one.
+REPORT_MESSAGES = (WorkReportRequest,)
+
+# Messages that change the role of the server and are accepted in any role.
+CONTROL_MESSAGES = (PromoteRequest, FenceRequest)
+
+# Errors raised again whenever the same message is sent. Clients are told
+# of them as a RejectedError, so that they need not know the ORM exceptions.
+REJECTIONS = (ValueError, IntegrityError)
+
+
 def now() -> datetime:
     return datetime.now()
 
 
+def error_response(e: Exception) -> ErrorResponse:
+    tb = extract_tb(e.__traceback__)
+    if isinstance(e, REJECTIONS):
+        e = RejectedError(f"{type(e).__name__}: {e}")
+    return ErrorResponse(e, tb)
+
+
 class Workstation(BaseEntity):
     __tablename__: str = "Workstation"
     id: int = Column(Integer, primary_key=True)
@@ -73,10 +114,13 @@ class Batch(BaseEntity):
     name: str = Column(String(255), nullable=False)
     created: datetime = Column(DateTime, nullable=False)
 
-    def __init__(self, code: Optional[str], name: str) -> None:
+    def __init__(self,
+                 code: Optional[str],
+                 name: str,
+                 created: Optional[datetime] = None) -> None:
         super().__init__(code=code,
                          name=name,
-                         created=now())
+                         created=created if created is not None else now())
 
 
 class ActivityPeriod(BaseEntity):
@@ -87,15 +131,19 @@ class ActivityPeriod(BaseEntity):
     num_workers: int = Column(Integer, nullable=False)
     start: datetime = Column(DateTime, nullable=False)
     stop: Optional[datetime] = Column(DateTime, nullable=True)
+    device_start: Optional[datetime] = Column(DateTime, nullable=True)
 
     def __init__(self,
                  workstation: Workstation,
-                 num_workers: int) -> None:
+                 num_workers: int,
+                 start: Optional[datetime] = None,
+                 device_start: Optional[datetime] = None) -> None:
         super().__init__(
             workstation_id=workstation.id,
             num_workers=num_workers,
-            start=now(),
-            stop=None)
+            start=start if start is not None else now(),
+            stop=None,
+            device_start=device_start)
 
 
 class WorkRun(BaseEntity):
@@ -108,16 +156,21 @@ class WorkRun(BaseEntity):
     start: datetime = Column(DateTime, nullable=False)
     last_active: datetime = Column(DateTime, nullable=False)
     stop: Optional[datetime] = Column(DateTime, nullable=True)
+    device_start: Optional[datetime] = Column(DateTime, nullable=True)
 
     def __init__(self,
                  workstation: Workstation,
-                 batch: Optional[Batch]) -> None:
+                 batch: Optional[Batch],
+                 start: Optional[datetime] = None,
+                 device_start: Optional[datetime] = None) -> None:
+        start = start if start is not None else now()
         super().__init__(
             workstation_id=workstation.id,
             batch_id=batch.id if batch is not None else None,
-            start=now(),
-            last_active=now(),
-            stop=None)
+            start=start,
+            last_active=start,
+            stop=None,
+            device_start=device_start)
 
 
 class Work(BaseEntity):
@@ -129,15 +182,28 @@ class Work(BaseEntity):
     batch: Batch = relationship("Batch")
     start: datetime = Column(DateTime, nullable=False)
     stop: Optional[datetime] = Column(DateTime, nullable=True)
+    device_start: Optional[datetime] = Column(DateTime, nullable=True)
 
     def __init__(self,
                  workstation: Workstation,
-                 batch: Batch) -> None:
+                 batch: Batch,
+                 start: Optional[datetime] = None,
+                 device_start: Optional[datetime] = None) -> None:
         super().__init__(
             workstation_id=workstation.id,
             batch_id=batch.id,
-            start=now(),
-            stop=None)
+            start=start if start is not None else now(),
+            stop=None,
+            device_start=device_start)
+
+
+class JournalEntry(BaseEntity):
+    __tablename__: str = "Journal"
+    id: int = Column(Integer, primary_key=True)
+    message: bytes = Column(LargeBinary, nullable=False)
+
+    def __init__(self, message: Any, id: Optional[int] = None) -> None:
+        super().__init__(id=id, message=pickle.dumps(message))
 
 
 def bind_tables(engine: Engine) -> None:
@@ -146,53 +212,174 @@ def bind_tables(engine: Engine) -> None:
     WorkRun.metadata.bind = engine
     Work.metadata.bind = engine
     Batch.metadata.bind = engine
+    JournalEntry.metadata.bind = engine
 
 
 class Server:
     engine: Engine
     sessionmaker: Callable[[], Session]
 
-    def __init__(self, engine: Engine) -> None:
+    def __init__(self,
+                 engine: Engine,
+                 work_run_timeout: float = 60.0,
+                 clock_skew_tolerance: float = 5.0,
+                 journal_retention: int = 100000,
+                 snapshot: Optional[Snapshot] = None,
+                 write_batch_size: int = 100) -> None:
         self.engine = engine
+        self.snapshot = snapshot
+        self.role = PRIMARY
+        self._role_lock = Lock()
+        self._follower: Optional[Thread] = None
+        self._fencer: Optional[Thread] = None
+        self._primary_address: Optional[str] = None
+        self._promoted = False
+        self.work_run_timeout = work_run_timeout
+        self.clock_skew_tolerance = clock_skew_tolerance
+        self.journal_retention = journal_retention
         self.make_session = sessionmaker(bind=engine)
+        # Every change to the database is applied by the writer, while
+        # queries use connections of their own.
+        self.writer = Writer(self.make_session, write_batch_size)
         self._work_run_terminator: Optional[Thread] = None
+        # Latest instrumentation pushed by each workstation in its heartbeats.
+        self.device_stats: Dict[str, Dict[str, Any]] = {}
+        self._clock_offsets: Dict[str, Deque[float]] = {}
 
     def session(self) -> Session:
         return self.make_session()
 
-    def find_batch_by_code(self, code: str) -> Optional[Batch]:
+    def report_session(self) -> Session:
+        """A session for reports, reading the snapshot if there is one."""
+        if self.snapshot is not None:
+            return self.snapshot.session()
+        return self.session()
+
+    @contextmanager
+    def transaction(self) -> Iterator[Session]:
         sess = self.session()
         try:
-            batch = sess.query(Batch).filter_by(code=code).first()
-            assert isinstance(batch, (Batch, type(None)))
-            return batch
+            yield sess
+            sess.commit()
+        except Exception:
+            sess.rollback()
+            raise
         finally:
             sess.close()
 
-    def associate_batch(self, code: str, name: str) -> Batch:
+    def find_batch_by_code(self, code: str) -> Optional[Batch]:
         sess = self.session()
         try:
-            old_batch = sess.query(Batch).filter_by(code=code).first()
-            if isinstance(old_batch, Batch):
-                old_batch.code = None
-            new_batch = Batch(code, name)
-            sess.add(new_batch)
-            sess.commit()
-            sess.refresh(new_batch)
-            return new_batch
+            return self._find_batch_by_code(sess, code)
         finally:
             sess.close()
 
-    def ensure_workstation(self, workstation_code: str) -> None:
-        sess = self.session()
-        try:
+    def _find_batch_by_code(self, sess: Session, code: str) -> Optional[Batch]:
+        batch = sess.query(Batch).filter_by(code=code).first()
+        assert isinstance(batch, (Batch, type(None)))
+        return batch
+
+    def _find_recent_batches(self,
+                             sess: Session,
+                             limit: int) -> List[Tuple[str, str]]:
+        last_used = func.max(func.coalesce(Work.start, Batch.created))
+        rows = (sess.query(Batch.code, Batch.name)
+                    .outerjoin(Work, Work.batch_id == Batch.id)
+                    .filter(Batch.code != None)
+                    .group_by(Batch.id)
+                    .order_by(desc(last_used))
+                    .limit(limit)
+                    .all())
+        return [(code, name) for code, name in rows]
+
+    def _work_report(self,
+                     sess: Session,
+                     start: datetime,
+                     stop: datetime) -> List[Tuple[str, str, float]]:
+        """Sums the time worked on each batch at each workstation.
+
+        Only the part of each work between `start` and `stop` is counted,
+        and work still going on counts up to the present.
+        """
+        works = (sess.query(Workstation.code, Batch.id, Batch.name,
+                            Work.start, Work.stop)
+                     .select_from(Work)
+                     .join(Workstation, Work.workstation_id == Workstation.id)
+                     .join(Batch, Work.batch_id == Batch.id)
+                     .filter(Work.start < stop)
+                     .filter(func.coalesce(Work.stop, stop) > start)
+                     .all())
+        current = now()
+        totals: Dict[Tuple[str, int], Tuple[str, float]] = {}
+        for ws_code, batch_id, batch_name, work_start, work_stop in works:
+            end = min(work_stop if work_stop is not None else current, stop)
+            seconds = (end - max(work_start, start)).total_seconds()
+            _, total = totals.get((ws_code, batch_id), (batch_name, 0.0))
+            totals[ws_code, batch_id] = (batch_name, total + max(seconds, 0.0))
+        return sorted((ws_code, batch_name, seconds)
+                      for (ws_code, _), (batch_name, seconds)
+                      in totals.items())
+
+    def associate_batch(self, code: str, name: str) -> Batch:
+        new_batch = self.writer.write(
+            lambda sess: self._associate_batch(sess, code, name))
+        assert isinstance(new_batch, Batch)
+        return new_batch
+
+    def _associate_batch(self,
+                         sess: Session,
+                         code: str,
+                         name: str,
+                         created: Optional[datetime] = None) -> Batch:
+        old_batch = sess.query(Batch).filter_by(code=code).first()
+        if isinstance(old_batch, Batch):
+            old_batch.code = None
+            sess.flush()
+        new_batch = Batch(code, name, created)
+        sess.add(new_batch)
+        sess.flush()
+        return new_batch
+
+    def associate_batches(self, batches: Iterable[Tuple[str, str]]) -> int:
+        count = self.writer.write(
+            lambda sess: self._associate_batches(sess, batches))
+        assert isinstance(count, int)
+        return count
+
+    def _associate_batches(self,
+                           sess: Session,
+                           batches: Iterable[Tuple[str, str]],
+                           created: Optional[datetime] = None) -> int:
+        """Associates (code, name) pairs like _associate_batch, set at a time.
+
+        The last name given for a code wins.
+        """
+        names = dict(batches)
+        codes = list(names)
+        table = Batch.__table__
+        for i in range(0, len(codes), BULK_CHUNK_SIZE):
+            sess.execute(table.update()
+                              .where(table.c.code.in_(
+                                  codes[i:i + BULK_CHUNK_SIZE]))
+                              .values(code=None))
+        if names:
+            if created is None:
+                created = now()
+            sess.execute(table.insert(),
+                         [dict(code=code, name=name, created=created)
+                          for code, name in names.items()])
+        return len(names)
+
+    def ensure_workstation(self,
+                           sess: Session,
+                           workstation_code: str) -> Workstation:
+        ws = sess.query(Workstation).filter_by(code=workstation_code).first()
+        if ws is None:
             ws = Workstation(workstation_code)
             sess.add(ws)
-            sess.commit()
-        except DBAPIError:
-            pass
-        finally:
-            sess.close()
+            sess.flush()
+        assert isinstance(ws, Workstation)
+        return ws
 
     def find_workstation_by_code(self,
                                  sess: Session,
@@ -201,163 +388,230 @@ class Server:
         assert isinstance(ws, Workstation)
         return ws
 
+    def _already_started(self,
+                         sess: Session,
+                         entity: Any,
+                         ws: Workstation,
+                         device_timestamp: Optional[datetime]) -> bool:
+        # Devices retry requests whose reply was lost, so an event with the
+        # same device timestamp as an existing row has been applied already.
+        # The time as the device sent it is compared, since the corrected
+        # time depends on the clock offset measured when it arrived.
+        if device_timestamp is None:
+            return False
+        existing = (sess.query(entity)
+                        .filter_by(workstation_id=ws.id,
+                                   device_start=device_timestamp)
+                        .first())
+        return existing is not None
+
     def start_activity_period(self,
                               workstation_code: str,
                               num_workers: int) -> None:
-        self.ensure_workstation(workstation_code)
+        self.writer.write(
+            lambda sess: self._start_activity_period(sess, workstation_code, num_workers))
+
+    def _start_activity_period(self,
+                               sess: Session,
+                               workstation_code: str,
+                               num_workers: int,
+                               timestamp: Optional[datetime] = None,
+                               device_timestamp: Optional[datetime] = None) -> None:
         print(f"Starting activity period on {workstation_code} " +
               f"with {num_workers} workers")
-        sess = self.session()
-        try:
-            ws = self.find_workstation_by_code(sess, workstation_code)
-            ap = ActivityPeriod(ws, num_workers)
-            sess.add(ap)
-            sess.commit()
-        finally:
-            sess.close()
+        ws = self.ensure_workstation(sess, workstation_code)
+        if self._already_started(sess, ActivityPeriod, ws, device_timestamp):
+            return
+        ap = ActivityPeriod(ws, num_workers, timestamp, device_timestamp)
+        sess.add(ap)
+        self._touch_work_run(sess, ws, timestamp)
 
     def stop_activity_period(self,
                              workstation_code: str) -> None:
-        self.ensure_workstation(workstation_code)
+        self.writer.write(
+            lambda sess: self._stop_activity_period(sess, workstation_code))
+
+    def _stop_activity_period(self,
+                              sess: Session,
+                              workstation_code: str,
+                              timestamp: Optional[datetime] = None) -> None:
         print(f"Stopping activity period on {workstation_code}")
-        sess = self.session()
-        try:
-            ws = self.find_workstation_by_code(sess, workstation_code)
-            ap = (sess.query(ActivityPeriod)
-                      .filter_by(workstation_id=ws.id)
-                      .order_by(desc(ActivityPeriod.start))
-                      .first())
-            if ap is None:
-                return
-            assert isinstance(ap, ActivityPeriod)
-            ap.stop = now()
-            sess.add(ap)
-            sess.commit()
-        finally:
-            sess.close()
+        ws = self.ensure_workstation(sess, workstation_code)
+        self._touch_work_run(sess, ws, timestamp)
+        ap = (sess.query(ActivityPeriod)
+                  .filter_by(workstation_id=ws.id)
+                  .order_by(desc(ActivityPeriod.start))
+                  .first())
+        if ap is None:
+            return
+        assert isinstance(ap, ActivityPeriod)
+        ap.stop = timestamp if timestamp is not None else now()
+        sess.add(ap)
 
     def start_work_run(self,
                        workstation_code: str) -> None:
-        self.ensure_workstation(workstation_code)
+        self.writer.write(
+            lambda sess: self._start_work_run(sess, workstation_code))
+
+    def _start_work_run(self,
+                        sess: Session,
+                        workstation_code: str,
+                        timestamp: Optional[datetime] = None,
+                        device_timestamp: Optional[datetime] = None) -> None:
         print(f"Starting work run on {workstation_code}")
-        sess = self.session()
-        try:
-            ws = self.find_workstation_by_code(sess, workstation_code)
-            work = (sess.query(Work)
-                      .filter_by(workstation_id=ws.id)
-                      .order_by(desc(Work.start))
-                      .first())
-            if work is None:
-                run = WorkRun(ws, None)
-            else:
-                run = WorkRun(ws, work.batch)
-            sess.add(run)
-            sess.commit()
-        finally:
-            sess.close()
+        ws = self.ensure_workstation(sess, workstation_code)
+        if self._already_started(sess, WorkRun, ws, device_timestamp):
+            return
+        work = (sess.query(Work)
+                  .filter_by(workstation_id=ws.id)
+                  .order_by(desc(Work.start))
+                  .first())
+        if work is None:
+            run = WorkRun(ws, None, timestamp, device_timestamp)
+        else:
+            run = WorkRun(ws, work.batch, timestamp, device_timestamp)
+        sess.add(run)
 
     def refresh_work_run(self,
                          workstation_code: str) -> None:
-        self.ensure_workstation(workstation_code)
+        self.writer.write(
+            lambda sess: self._refresh_work_run(sess, workstation_code))
+
+    def _refresh_work_run(self,
+                          sess: Session,
+                          workstation_code: str,
+                          timestamp: Optional[datetime] = None) -> None:
         print(f"Refreshing work run on {workstation_code}")
-        sess = self.session()
-        try:
-            ws = self.find_workstation_by_code(sess, workstation_code)
-            run = (sess.query(WorkRun)
-                      .filter_by(workstation_id=ws.id)
-                      .order_by(desc(WorkRun.start))
-                      .first())
-            if run is None:
-                return
-            if run.stop is not None:
-                return
-            assert isinstance(run, WorkRun)
-            run.last_active = now()
-            sess.add(run)
-            sess.commit()
-        finally:
-            sess.close()
+        ws = self.ensure_workstation(sess, workstation_code)
+        self._touch_work_run(sess, ws, timestamp)
+
+    def _touch_work_run(self,
+                        sess: Session,
+                        ws: Workstation,
+                        timestamp: Optional[datetime]) -> None:
+        # Every message from a workstation shows that it is alive, so it
+        # keeps the open work run from being terminated like a heartbeat.
+        run = (sess.query(WorkRun)
+                  .filter_by(workstation_id=ws.id)
+                  .order_by(desc(WorkRun.start))
+                  .first())
+        if run is None:
+            return
+        if run.stop is not None:
+            return
+        assert isinstance(run, WorkRun)
+        last_active = timestamp if timestamp is not None else now()
+        run.last_active = max(run.last_active, last_active)
+        sess.add(run)
 
     def stop_work_run(self,
                       workstation_code: str) -> None:
-        self.ensure_workstation(workstation_code)
+        self.writer.write(
+            lambda sess: self._stop_work_run(sess, workstation_code))
+
+    def _stop_work_run(self,
+                       sess: Session,
+                       workstation_code: str,
+                       timestamp: Optional[datetime] = None) -> None:
         print(f"Stopping work run on {workstation_code}")
-        sess = self.session()
-        try:
-            ws = self.find_workstation_by_code(sess, workstation_code)
-            run = (sess.query(WorkRun)
-                      .filter_by(workstation_id=ws.id)
-                      .order_by(desc(WorkRun.start))
-                      .first())
-            if run is None:
-                return
-            assert isinstance(run, WorkRun)
-            run.stop = now()
-            sess.add(run)
-            sess.commit()
-        finally:
-            sess.close()
+        ws = self.ensure_workstation(sess, workstation_code)
+        run = (sess.query(WorkRun)
+                  .filter_by(workstation_id=ws.id)
+                  .order_by(desc(WorkRun.start))
+                  .first())
+        if run is None:
+            return
+        assert isinstance(run, WorkRun)
+        run.stop = timestamp if timestamp is not None else now()
+        sess.add(run)
 
     def start_work(self,
                    workstation_code: str,
                    batch_code: str) -> None:
-        self.ensure_workstation(workstation_code)
-        batch = self.find_batch_by_code(batch_code)
+        self.writer.write(
+            lambda sess: self._start_work(sess, workstation_code, batch_code))
+
+    def _start_work(self,
+                    sess: Session,
+                    workstation_code: str,
+                    batch_code: str,
+                    timestamp: Optional[datetime] = None,
+                    device_timestamp: Optional[datetime] = None) -> None:
+        ws = self.ensure_workstation(sess, workstation_code)
+        self._touch_work_run(sess, ws, timestamp)
+        batch = self._find_batch_by_code(sess, batch_code)
         if batch is None:
             return
+        if self._already_started(sess, Work, ws, device_timestamp):
+            return
         print(f"Starting work on {workstation_code} for {batch_code}")
-        sess = self.session()
-        try:
-            ws = self.find_workstation_by_code(sess, workstation_code)
-            work = Work(ws, batch)
-            sess.add(work)
-            sess.commit()
-        finally:
-            sess.close()
+        work = Work(ws, batch, timestamp, device_timestamp)
+        sess.add(work)
 
     def stop_work(self,
                   workstation_code: str) -> None:
-        self.ensure_workstation(workstation_code)
+        self.writer.write(
+            lambda sess: self._stop_work(sess, workstation_code))
+
+    def _stop_work(self,
+                   sess: Session,
+                   workstation_code: str,
+                   timestamp: Optional[datetime] = None) -> None:
         print(f"Stopping work on {workstation_code}")
-        sess = self.session()
-        try:
-            ws = self.find_workstation_by_code(sess, workstation_code)
-            work = (sess.query(Work)
-                      .filter_by(workstation_id=ws.id)
-                      .order_by(desc(Work.start))
-                      .first())
-            if work is None:
-                return
-            assert isinstance(work, Work)
-            work.stop = now()
-            sess.add(work)
-            sess.commit()
-        finally:
-            sess.close()
+        ws = self.ensure_workstation(sess, workstation_code)
+        self._touch_work_run(sess, ws, timestamp)
+        work = (sess.query(Work)
+                  .filter_by(workstation_id=ws.id)
+                  .order_by(desc(Work.start))
+                  .first())
+        if work is None:
+            return
+        assert isinstance(work, Work)
+        work.stop = timestamp if timestamp is not None else now()
+        sess.add(work)
+
+    def _terminate_work_runs(self,
+                             sess: Session,
+                             current: datetime,
+                             work_run_timeout: float) -> None:
+        timeout = timedelta(seconds=work_run_timeout)
+        threshold = current - timeout
+        runs = (sess.query(WorkRun)
+                    .filter(WorkRun.last_active < threshold)
+                    .filter_by(stop=None)
+                    .all())
+        for run in runs:
+            run.stop = run.last_active + timeout
+            sess.add(run)
+        self._prune_journal(sess)
+
+    def terminate_work_runs(self) -> None:
+        """Stops the work runs that have been idle for too long."""
+        self.submit(TerminateWorkRunsRequest(
+            now(), self.work_run_timeout)).result()
 
     def terminate_work_runs_process(self) -> None:
         while True:
-            threshold = now() - timedelta(seconds=60)
-            sess = self.session()
-            runs = (sess.query(WorkRun)
-                        .filter(WorkRun.last_active < threshold)
-                        .filter_by(stop=None)
-                        .all())
-            for run in runs:
-                run.stop = run.last_active + timedelta(seconds=60)
-                sess.add(run)
-            sess.commit()
-            time.sleep(60)
+            if self.role == PRIMARY:
+                try:
+                    self.terminate_work_runs()
+                except NotPrimaryError:
+                    pass
+            time.sleep(self.work_run_timeout)
+
+    def _start_work_run_terminator(self) -> None:
+        self._work_run_terminator = Thread(
+            target=self.terminate_work_runs_process,
+            daemon=True)
+        self._work_run_terminator.start()
 
     def run_server(self, bind_address: str) -> None:
         context = zmq.Context()
         socket = context.socket(zmq.REP)
         socket.bind(bind_address)
 
-        self._work_run_terminator = Thread(
-            target=self.terminate_work_runs_process,
-            daemon=True)
-        self._work_run_terminator.start()
+        self.writer.start()
+        self._start_work_run_terminator()
 
         print("server started")
         
@@ -366,69 +620,501 @@ class Server:
             try:
                 reply = self.execute(message)
             except Exception as e:
-                tb = extract_tb(sys.exc_info()[2])
-                socket.send_pyobj(ErrorResponse(e, tb))
+                socket.send_pyobj(error_response(e))
             else:
                 socket.send_pyobj(reply)
 
-    def handle_batch_name_query(self, message: BatchNameQueryRequest) -> BatchNameQueryResponse:
-        batch = self.find_batch_by_code(message.batch_code)
+    def run_server_async(self,
+                         bind_address: str,
+                         max_concurrent_requests: int = 16) -> None:
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(
+                self.serve_async(bind_address, max_concurrent_requests))
+        finally:
+            loop.close()
+
+    async def serve_async(self,
+                          bind_address: str,
+                          max_concurrent_requests: int = 16) -> None:
+        # A ROUTER socket talks to the same REQ clients as the REP socket in
+        # run_server, but lets us keep several requests in flight at once.
+        context = zmq.asyncio.Context()
+        socket = context.socket(zmq.ROUTER)
+        socket.bind(bind_address)
+        limit = asyncio.Semaphore(max_concurrent_requests)
+        executor = ThreadPoolExecutor(max_workers=max_concurrent_requests)
+        # The loop keeps only weak references to tasks, so they are held
+        # here until done.
+        tasks: Set['asyncio.Future[None]'] = set()
+
+        def finished(task: 'asyncio.Future[None]') -> None:
+            tasks.discard(task)
+            if not task.cancelled() and task.exception() is not None:
+                error(f"Answering a request failed: {task.exception()!r}")
+
+        self.writer.start()
+        self._start_work_run_terminator()
+
+        print("async server started")
+
+        async def handle(envelope: List[bytes], payload: bytes) -> None:
+            try:
+                message = pickle.loads(payload)
+                reply = await self.execute_async(message, executor)
+            except Exception as e:
+                reply = error_response(e)
+            try:
+                await socket.send_multipart(envelope + [pickle.dumps(reply)])
+            finally:
+                limit.release()
+
+        try:
+            while True:
+                await limit.acquire()
+                frames = await socket.recv_multipart()
+                task = asyncio.ensure_future(handle(frames[:-1], frames[-1]))
+                tasks.add(task)
+                task.add_done_callback(finished)
+        finally:
+            executor.shutdown(wait=False)
+            socket.close()
+
+    def observe_device_clock(self,
+                             workstation_code: str,
+                             timestamp: datetime) -> None:
+        """Records the offset of the device clock seen in a send time.
+
+        The offset includes the time the message spent on its way, so the
+        smallest recent offset is the best estimate.
+        """
+        offsets = self._clock_offsets.setdefault(
+            workstation_code, deque(maxlen=CLOCK_OFFSET_SAMPLES))
+        offsets.append((now() - timestamp).total_seconds())
+
+    def clock_offset(self, workstation_code: str) -> float:
+        """Seconds to add to the device time to get the server time."""
+        offsets = self._clock_offsets.get(workstation_code)
+        if not offsets:
+            return 0.0
+        return min(offsets)
+
+    def device_time(self,
+                    workstation_code: str,
+                    timestamp: Optional[datetime]) -> Optional[datetime]:
+        """Maps a device timestamp to server time.
+
+        Timestamps are used as they are while the device clock is within
+        `clock_skew_tolerance` seconds of the server, and corrected by the
+        device's clock offset otherwise. Events carry the time they were
+        sent, so the offset is measured before their own time is mapped.
+        Times in the future are clamped to the present.
+        """
+        if timestamp is None:
+            return None
+        offset = self.clock_offset(workstation_code)
+        if abs(offset) > self.clock_skew_tolerance:
+            timestamp += timedelta(seconds=offset)
+        return min(timestamp, now())
+
+    def observe_send_time(self, message: Any) -> None:
+        """Samples the device clocks from the time a message was sent.
+
+        Event timestamps are not used for this: events drained from an
+        outbox carry the time they were queued, which can be long past.
+        """
+        sent = getattr(message, "sent", None)
+        if sent is None:
+            return
+        if isinstance(message, MultiOperationRequest):
+            codes = {x.workstation_code for x in message.operations
+                     if hasattr(x, "workstation_code")}
+        else:
+            codes = {message.workstation_code}
+        for code in codes:
+            self.observe_device_clock(code, sent)
+
+    def take_device_stats(self, message: Any) -> Any:
+        """Keeps the stats of heartbeats and returns the message without them.
+
+        Stats are only of interest while current, so they are kept in
+        memory rather than journaled with every heartbeat.
+        """
+        if isinstance(message, MultiOperationRequest):
+            return message._replace(
+                operations=[self.take_device_stats(x)
+                            for x in message.operations])
+        if (isinstance(message, RefreshWorkRunRequest) and
+                message.stats is not None):
+            self.device_stats[message.workstation_code] = message.stats
+            return message._replace(stats=None)
+        return message
+
+    def resolve(self, message: Any) -> Any:
+        """Maps the device timestamps of a message to server time.
+
+        Times the message leaves to the server are set to the present.
+        Messages are resolved once, before they are applied and journaled,
+        so that a standby replaying the journal records the same times.
+        """
+        if isinstance(message, MultiOperationRequest):
+            return message._replace(
+                operations=[self.resolve(x) for x in message.operations])
+        fields = getattr(message, "_fields", ())
+        if "created" in fields and message.created is None:
+            return message._replace(created=now())
+        if "timestamp" not in fields:
+            return message
+        if message.timestamp is None:
+            return message._replace(timestamp=now())
+        if "device_timestamp" in fields:
+            message = message._replace(device_timestamp=message.timestamp)
+        return message._replace(timestamp=self.device_time(
+            message.workstation_code, message.timestamp))
+
+    def _journal_position(self, sess: Session) -> int:
+        position = sess.query(func.max(JournalEntry.id)).scalar()
+        return position if position is not None else 0
+
+    def journal_position(self) -> int:
+        """The sequence number of the last journal entry in the database."""
+        sess = self.session()
+        try:
+            return self._journal_position(sess)
+        finally:
+            sess.close()
+
+    def _prune_journal(self, sess: Session) -> None:
+        oldest = self._journal_position(sess) - self.journal_retention
+        if oldest > 0:
+            (sess.query(JournalEntry)
+                 .filter(JournalEntry.id <= oldest)
+                 .delete(synchronize_session=False))
+
+    def apply_journal(self, entries: List[Tuple[int, Any]]) -> int:
+        """Applies entries of the primary's journal in one transaction.
+
+        The entries are journaled here under the same sequence numbers, so
+        the position survives restarts and carries over on promotion.
+        Entries up to the current position are skipped. Returns the new
+        position.
+        """
+        def apply_entries(sess: Session) -> int:
+            position = self._journal_position(sess)
+            if self._promoted:
+                # The writer applies this after any change accepted since
+                # promotion, so entries still arriving from the old primary
+                # are dropped rather than mixed in.
+                return position
+            for sequence, message in entries:
+                if sequence <= position:
+                    continue
+                self.apply(sess, message)
+                sess.add(JournalEntry(message, sequence))
+                position = sequence
+            return position
+        position = self.writer.write(apply_entries)
+        assert isinstance(position, int)
+        return position
+
+    def start_standby(self,
+                      primary_address: str,
+                      poll_interval: float = 0.5,
+                      poll_timeout: float = 2.0,
+                      promote_after_failures: int = 3) -> None:
+        """Follows the primary from a thread of its own, see `follow`."""
+        self.role = STANDBY
+        self.writer.start()
+        self._follower = Thread(
+            target=self.follow,
+            args=(primary_address, poll_interval, poll_timeout,
+                  promote_after_failures),
+            daemon=True)
+        self._follower.start()
+
+    def follow(self,
+               primary_address: str,
+               poll_interval: float = 0.5,
+               poll_timeout: float = 2.0,
+               promote_after_failures: int = 3,
+               batch_size: int = 1000) -> None:
+        """Runs as a hot standby of the server at `primary_address`.
+
+        The journal of the primary is applied as it grows, polling every
+        `poll_interval` seconds once caught up. While following, the
+        server refuses changes and tells clients it is a standby.
+
+        Returns once promoted, either by a PromoteRequest or when
+        `promote_after_failures` polls in a row got no reply within
+        `poll_timeout` seconds; zero promotes only on request. After that
+        the old primary is fenced, see `promote`.
+
+        Work runs are terminated only by the primary's terminator, whose
+        runs are journaled with the time they ran at like any other change,
+        so the standby stops the same runs at the same point in the
+        journal. Once promoted, its own terminator takes over.
+        """
+        self.role = STANDBY
+        self._primary_address = primary_address
+        context = zmq.Context()
+        socket = context.socket(zmq.REQ)
+        socket.connect(primary_address)
+        position = self.journal_position()
+        failures = 0
+        print(f"following {primary_address} from journal entry {position}")
+        try:
+            while self.role == STANDBY:
+                socket.send_pyobj(JournalRequest(position, batch_size))
+                if not socket.poll(int(poll_timeout * 1000), zmq.POLLIN):
+                    socket.setsockopt(zmq.LINGER, 0)
+                    socket.close()
+                    socket = context.socket(zmq.REQ)
+                    socket.connect(primary_address)
+                    failures += 1
+                    print(f"no reply from {primary_address} " +
+                          f"in {poll_timeout} s ({failures} in a row)")
+                    if 0 < promote_after_failures <= failures:
+                        self.promote()
+                    continue
+                reply = socket.recv_pyobj()
+                failures = 0
+                if isinstance(reply, ErrorResponse):
+                    raise reply.exception
+                assert isinstance(reply, JournalResponse)
+                position = self.apply_journal(reply.entries)
+                if len(reply.entries) < batch_size:
+                    time.sleep(poll_interval)
+        finally:
+            socket.setsockopt(zmq.LINGER, 0)
+            socket.close()
+
+    def promote(self,
+                fence_interval: float = 1.0,
+                fence_timeout: float = 2.0) -> None:
+        """Makes a standby the primary and fences the old primary.
+
+        The old primary is sent a FenceRequest every `fence_interval`
+        seconds for as long as this server runs, so that it refuses
+        changes whenever it answers, even after a restart. It must be
+        restarted as a standby of this one to serve again.
+        """
+        with self._role_lock:
+            if self.role != STANDBY:
+                return
+            self._promoted = True
+            self.role = PRIMARY
+        print("promoted to primary")
+        if self._primary_address is not None:
+            self._fencer = Thread(
+                target=self._fence_process,
+                args=(self._primary_address, fence_interval, fence_timeout),
+                daemon=True)
+            self._fencer.start()
+
+    def _fence_process(self,
+                       address: str,
+                       interval: float,
+                       timeout: float) -> None:
+        context = zmq.Context()
+        while True:
+            socket = context.socket(zmq.REQ)
+            socket.setsockopt(zmq.LINGER, 0)
+            socket.connect(address)
+            try:
+                socket.send_pyobj(FenceRequest())
+                if socket.poll(int(timeout * 1000), zmq.POLLIN):
+                    socket.recv_pyobj()
+            finally:
+                socket.close()
+            time.sleep(interval)
+
+    def fence(self) -> None:
+        """Stops a primary that a standby has taken over from."""
+        with self._role_lock:
+            if self.role != PRIMARY:
+                return
+            self.role = FENCED
+        print("fenced by a promoted standby, refusing changes")
+
+    def _check_primary(self) -> None:
+        if self.role != PRIMARY:
+            raise NotPrimaryError(f"this server is {self.role}, " +
+                                  "send changes to the primary")
+
+    def handle_server_info(self, sess: Session, message: ServerInfoRequest) -> ServerInfoResponse:
+        return ServerInfoResponse(self.work_run_timeout, self.role)
+
+    def handle_batch_name_query(self, sess: Session, message: BatchNameQueryRequest) -> BatchNameQueryResponse:
+        batch = self._find_batch_by_code(sess, message.batch_code)
         return BatchNameQueryResponse(batch.name if batch is not None else None)
 
-    def handle_batch_association(self, message: BatchAssociationRequest) -> BatchAssociationResponse:
-        batch = self.associate_batch(message.batch_code, message.batch_name)
+    def handle_recent_batches_query(self, sess: Session, message: RecentBatchesQueryRequest) -> RecentBatchesQueryResponse:
+        return RecentBatchesQueryResponse(
+            self._find_recent_batches(sess, message.limit))
+
+    def handle_work_report(self, sess: Session, message: WorkReportRequest) -> WorkReportResponse:
+        return WorkReportResponse(
+            self._work_report(sess, message.start, message.stop))
+
+    def handle_batch_association(self, sess: Session, message: BatchAssociationRequest) -> BatchAssociationResponse:
+        batch = self._associate_batch(sess, message.batch_code, message.batch_name, message.created)
         return BatchAssociationResponse(batch.id)
 
-    def handle_start_activity_period(self, message: StartActivityPeriodRequest) -> StartActivityPeriodResponse:
-        self.start_activity_period(message.workstation_code, message.num_workers)
+    def handle_bulk_batch_association(self, sess: Session, message: BulkBatchAssociationRequest) -> BulkBatchAssociationResponse:
+        return BulkBatchAssociationResponse(
+            self._associate_batches(sess, message.batches, message.created))
+
+    def handle_start_activity_period(self, sess: Session, message: StartActivityPeriodRequest) -> StartActivityPeriodResponse:
+        self._start_activity_period(sess, message.workstation_code, message.num_workers, message.timestamp, message.device_timestamp)
         return StartActivityPeriodResponse()
 
-    def handle_stop_activity_period(self, message: StopActivityPeriodRequest) -> StopActivityPeriodResponse:
-        self.stop_activity_period(message.workstation_code)
+    def handle_stop_activity_period(self, sess: Session, message: StopActivityPeriodRequest) -> StopActivityPeriodResponse:
+        self._stop_activity_period(sess, message.workstation_code, message.timestamp)
         return StopActivityPeriodResponse()
 
-    def handle_start_work_run(self, message: StartWorkRunRequest) -> StartWorkRunResponse:
-        self.start_work_run(message.workstation_code)
+    def handle_start_work_run(self, sess: Session, message: StartWorkRunRequest) -> StartWorkRunResponse:
+        self._start_work_run(sess, message.workstation_code, message.timestamp, message.device_timestamp)
         return StartWorkRunResponse()
 
-    def handle_refresh_work_run(self, message: RefreshWorkRunRequest) -> RefreshWorkRunResponse:
-        self.refresh_work_run(message.workstation_code)
+    def handle_refresh_work_run(self, sess: Session, message: RefreshWorkRunRequest) -> RefreshWorkRunResponse:
+        self._refresh_work_run(sess, message.workstation_code, message.timestamp)
         return RefreshWorkRunResponse()
 
-    def handle_stop_work_run(self, message: StopWorkRunRequest) -> StopWorkRunResponse:
-        self.stop_work_run(message.workstation_code)
+    def handle_stop_work_run(self, sess: Session, message: StopWorkRunRequest) -> StopWorkRunResponse:
+        self._stop_work_run(sess, message.workstation_code, message.timestamp)
         return StopWorkRunResponse()
 
-    def handle_start_work(self, message: StartWorkRequest) -> StartWorkResponse:
-        self.start_work(message.workstation_code, message.batch_code)
+    def handle_start_work(self, sess: Session, message: StartWorkRequest) -> StartWorkResponse:
+        self._start_work(sess, message.workstation_code, message.batch_code, message.timestamp, message.device_timestamp)
         return StartWorkResponse()
 
-    def handle_stop_work(self, message: StopWorkRequest) -> StopWorkResponse:
-        self.stop_work(message.workstation_code)
+    def handle_stop_work(self, sess: Session, message: StopWorkRequest) -> StopWorkResponse:
+        self._stop_work(sess, message.workstation_code, message.timestamp)
         return StopWorkResponse()
 
+    def handle_terminate_work_runs(self, sess: Session, message: TerminateWorkRunsRequest) -> TerminateWorkRunsResponse:
+        self._terminate_work_runs(sess, message.time, message.work_run_timeout)
+        return TerminateWorkRunsResponse()
+
+    def handle_stats(self, sess: Session, message: StatsRequest) -> StatsResponse:
+        stats = {"writer": self.writer.stats.snapshot()}
+        if self.snapshot is not None:
+            stats["snapshot"] = self.snapshot.stats.snapshot()
+        return StatsResponse(stats, dict(self.device_stats))
+
+    def handle_journal(self, sess: Session, message: JournalRequest) -> JournalResponse:
+        first = sess.query(func.min(JournalEntry.id)).scalar()
+        if first is not None and message.after < first - 1:
+            raise ValueError(
+                f"journal entries after {message.after} are no longer " +
+                "kept; reseed the standby from a copy of this database")
+        entries = (sess.query(JournalEntry)
+                       .filter(JournalEntry.id > message.after)
+                       .order_by(JournalEntry.id)
+                       .limit(message.limit)
+                       .all())
+        return JournalResponse(
+            [(entry.id, pickle.loads(entry.message)) for entry in entries])
+
+    def handle_multi_operation(self, sess: Session, message: MultiOperationRequest) -> MultiOperationResponse:
+        replies = []
+        for operation in message.operations:
+            if isinstance(operation, MultiOperationRequest):
+                raise ValueError("multi-operation requests cannot be nested")
+            replies.append(self.apply(sess, operation))
+        return MultiOperationResponse(replies)
+
+    def _apply_journaled(self, sess: Session, message: Any) -> Any:
+        reply = self.apply(sess, message)
+        # Journaled in the same transaction, so a standby sees exactly the
+        # changes that were committed.
+        sess.add(JournalEntry(message))
+        return reply
+
+    def _query(self, message: Any) -> Any:
+        if isinstance(message, REPORT_MESSAGES):
+            sess = self.report_session()
+            try:
+                return self.apply(sess, message)
+            finally:
+                sess.close()
+        with self.transaction() as sess:
+            return self.apply(sess, message)
+
+    def submit(self, message: Any) -> 'Future[Any]':
+        """Queues a change for the writer and returns a future for the reply."""
+        self._check_primary()
+        self.observe_send_time(message)
+        message = self.take_device_stats(message)
+        message = self.resolve(message)
+        return self.writer.submit(
+            lambda sess: self._apply_journaled(sess, message))
+
+    def _control(self, message: Any) -> Any:
+        if isinstance(message, PromoteRequest):
+            self.promote()
+            return PromoteResponse()
+        self.fence()
+        return FenceResponse()
+
     def execute(self, message: Any) -> Any:
+        if isinstance(message, CONTROL_MESSAGES):
+            return self._control(message)
+        if isinstance(message, QUERY_MESSAGES):
+            return self._query(message)
+        return self.submit(message).result()
+
+    def apply(self, sess: Session, message: Any) -> Any:
+        if isinstance(message, ServerInfoRequest):
+            return self.handle_server_info(sess, message)
         if isinstance(message, BatchNameQueryRequest):
-            return self.handle_batch_name_query(message)
+            return self.handle_batch_name_query(sess, message)
+        if isinstance(message, RecentBatchesQueryRequest):
+            return self.handle_recent_batches_query(sess, message)
+        if isinstance(message, WorkReportRequest):
+            return self.handle_work_report(sess, message)
         if isinstance(message, BatchAssociationRequest):
-            return self.handle_batch_association(message)
+            return self.handle_batch_association(sess, message)
+        if isinstance(message, BulkBatchAssociationRequest):
+            return self.handle_bulk_batch_association(sess, message)
         if isinstance(message, StartActivityPeriodRequest):
-            return self.handle_start_activity_period(message)
+            return self.handle_start_activity_period(sess, message)
         if isinstance(message, StopActivityPeriodRequest):
-            return self.handle_stop_activity_period(message)
+            return self.handle_stop_activity_period(sess, message)
         if isinstance(message, StartWorkRunRequest):
-            return self.handle_start_work_run(message)
+            return self.handle_start_work_run(sess, message)
         if isinstance(message, RefreshWorkRunRequest):
-            return self.handle_refresh_work_run(message)
+            return self.handle_refresh_work_run(sess, message)
         if isinstance(message, StopWorkRunRequest):
-            return self.handle_stop_work_run(message)
+            return self.handle_stop_work_run(sess, message)
         if isinstance(message, StartWorkRequest):
-            return self.handle_start_work(message)
+            return self.handle_start_work(sess, message)
         if isinstance(message, StopWorkRequest):
-            return self.handle_stop_work(message)
+            return self.handle_stop_work(sess, message)
+        if isinstance(message, TerminateWorkRunsRequest):
+            return self.handle_terminate_work_runs(sess, message)
+        if isinstance(message, JournalRequest):
+            return self.handle_journal(sess, message)
+        if isinstance(message, StatsRequest):
+            return self.handle_stats(sess, message)
+        if isinstance(message, MultiOperationRequest):
+            return self.handle_multi_operation(sess, message)
         else:
             raise ValueError("invalid message")
 
+    async def execute_async(self,
+                            message: Any,
+                            executor: Optional[Executor] = None) -> Any:
+        # SQLAlchemy 1.2 has no asyncio engine, so queries are awaited on an
+        # executor bounded by the caller. Changes need no thread of their
+        # own while they wait for the writer.
+        if isinstance(message, CONTROL_MESSAGES):
+            return self._control(message)
+        if not isinstance(message, QUERY_MESSAGES):
+            return await asyncio.wrap_future(self.submit(message))
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(executor, self._query, message)
+
 
 def make_config() -> Dict[str, Any]:
     if 'REIFER_MONITOR_CONFIG' in os.environ:
@@ -446,6 +1132,29 @@ def make_config() -> Dict[str, Any]:
             "environment variable.")
 
 
+def request(address: str, message: Any, timeout: float = 5.0) -> Any:
+    """Sends a message to the server at `address` and returns the reply."""
+    context = zmq.Context()
+    socket = context.socket(zmq.REQ)
+    socket.setsockopt(zmq.LINGER, 0)
+    socket.connect(address)
+    try:
+        socket.send_pyobj(message)
+        if not socket.poll(int(timeout * 1000), zmq.POLLIN):
+            raise ConfigurationException(f"No reply from {address}")
+        reply = socket.recv_pyobj()
+        if isinstance(reply, ErrorResponse):
+            raise reply.exception
+        return reply
+    finally:
+        socket.close()
+
+
+def request_promotion(address: str, timeout: float = 5.0) -> None:
+    """Asks the standby at `address` to take over as the primary."""
+    request(address, PromoteRequest(), timeout)
+
+
 def init_lite(url: str) -> Engine:
     engine = create_engine(url)
     BaseEntity.metadata.create_all(engine)
@@ -478,10 +1187,41 @@ def init(config: Dict[str, Any]) -> Engine:
     return engine
 
 
-if __name__ == "__main__":
+if __name__ == "__main__" and sys.argv[1:2] == ["promote"]:
+    # python server.py promote tcp://standby:5556
+    request_promotion(sys.argv[2])
+    print(f"promoted {sys.argv[2]}")
+elif __name__ == "__main__" and sys.argv[1:2] == ["stats"]:
+    # python server.py stats tcp://server:5555
+    stats = request(sys.argv[2], StatsRequest())
+    print(json.dumps(stats._asdict(), indent=1, sort_keys=True))
+elif __name__ == "__main__":
     print("starting server...")
     config = make_config()
     engine = init(config)
-    Server(engine).run_server(config["bind_url"])
+    snapshot = (Snapshot(engine,
+                         config["report_snapshot_path"],
+                         config.get("report_refresh_interval", 60.0),
+                         config.get("report_max_staleness", 300.0))
+                if "report_snapshot_path" in config else None)
+    server = Server(engine,
+                    config.get("work_run_timeout", 60.0),
+                    config.get("clock_skew_tolerance", 5.0),
+                    config.get("journal_retention", 100000),
+                    snapshot,
+                    config.get("write_batch_size", 100))
+    if "primary_url" in config:
+        server.start_standby(config["primary_url"],
+                             config.get("standby_poll_interval", 0.5),
+                             config.get("standby_poll_timeout", 2.0),
+                             config.get("standby_promote_after_failures", 3))
+    if snapshot is not None:
+        snapshot.start()
+    if config.get("server_async", False):
+        server.run_server_async(
+            config["bind_url"],
+            config.get("max_concurrent_requests", 16))
+    else:
+        server.run_server(config["bind_url"])
 
 # vim: tw=80 sw=4 ts=4 expandtab:
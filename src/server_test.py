@@ -13,13 +13,21 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import asyncio
+import pickle
 import server as server_module
 import sys
-from server import Batch, Server, init_lite
+import zmq
+from pathlib import Path
+from threading import Thread
+from message import *
+from server import (CLOCK_OFFSET_SAMPLES, Batch, Server, error_response,
+                    init_lite)
 from sqlalchemy.orm import Session, sessionmaker
 from sqlalchemy.sql import text
 from sqlalchemy.engine import Engine
-from datetime import datetime
+from datetime import datetime, timedelta
+from typing import Any, List
 
 
 def session(engine: Engine) -> Session:
@@ -94,6 +102,23 @@ def test_associate_batch_twice() -> None:
     assert rows[0]["created"] == '2000-01-01 00:00:00.000000'
 
 
+def test_recent_batches() -> None:
+    engine = init_lite("sqlite:///:memory:")
+    server_module.now = lambda: datetime(2000, 1, 1)
+    server = Server(engine)
+    server.associate_batch("OLD", "Old")
+    server_module.now = lambda: datetime(2000, 1, 2)
+    server.associate_batch("NEW", "New")
+    server.associate_batch("UNUSED", "Replaced")
+    server.associate_batch("UNUSED", "Unused")
+    server_module.now = lambda: datetime(2000, 1, 3)
+    server.start_work("WS1", "OLD")
+    reply = server.execute(RecentBatchesQueryRequest(2))
+    assert reply.batches[0] == ("OLD", "Old")
+    assert len(reply.batches) == 2
+    assert ("UNUSED", "Replaced") not in reply.batches
+
+
 def test_start_activity_period() -> None:
     engine = init_lite("sqlite:///:memory:")
     started = datetime(2000, 1, 1)
@@ -141,4 +166,446 @@ def test_start_stop_activity_period() -> None:
     assert rows[0]["stop"] == '2000-01-02 00:00:00.000000'
 
 
-# vim: tw=80 sw=4 ts=4 expandtab:
\ No newline at end of file
+def test_execute_async(tmp_path: Path) -> None:
+    engine = init_lite(f"sqlite:///{tmp_path / 'reifer.db'}")
+    server_module.now = lambda: datetime(2000, 1, 1)
+    server = Server(engine)
+    server.associate_batch("CODE", "NAME")
+    loop = asyncio.new_event_loop()
+    try:
+        reply = loop.run_until_complete(
+            server.execute_async(BatchNameQueryRequest("CODE")))
+    finally:
+        loop.close()
+    assert reply == BatchNameQueryResponse("NAME")
+
+
+def test_serve_async_bounds_concurrent_requests(tmp_path: Path) -> None:
+    server = Server(init_lite(f"sqlite:///{tmp_path / 'reifer.db'}"))
+    running = [0, 0]
+    async def execute_async(message: Any, executor: Any = None) -> Any:
+        running[0] += 1
+        running[1] = max(running)
+        await asyncio.sleep(0.05)
+        running[0] -= 1
+        return ServerInfoResponse(60.0)
+    server.execute_async = execute_async  # type: ignore
+    address = f"ipc://{tmp_path / 'server'}"
+    loop = asyncio.new_event_loop()
+    serving = loop.create_task(server.serve_async(address, 2))
+    def serve() -> None:
+        try:
+            loop.run_until_complete(serving)
+        except asyncio.CancelledError:
+            pass
+    thread = Thread(target=serve)
+    thread.start()
+    replies: List[Any] = []
+    context = zmq.Context()
+    def ask() -> None:
+        # pylint: disable=E1101
+        client = context.socket(zmq.REQ)
+        client.connect(address)
+        client.send_pyobj(ServerInfoRequest())
+        if client.poll(5000, zmq.POLLIN):
+            replies.append(client.recv_pyobj())
+        client.close(linger=0)
+    clients = [Thread(target=ask) for _ in range(6)]
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    loop.call_soon_threadsafe(serving.cancel)
+    thread.join()
+    loop.close()
+    server.writer.stop()
+    assert replies == [ServerInfoResponse(60.0)] * 6
+    assert running[1] == 2
+
+
+def test_event_timestamps_from_device() -> None:
+    engine = init_lite("sqlite:///:memory:")
+    server_module.now = lambda: datetime(2000, 1, 3)
+    server = Server(engine)
+    server.execute(StartWorkRunRequest("WS1", datetime(2000, 1, 1)))
+    server.execute(StopWorkRunRequest("WS1", datetime(2000, 1, 2)))
+    sess = session(engine)
+    try:
+        rows = sess.execute(
+            text("""SELECT "start", "last_active", "stop" FROM "WorkRun" """)
+            ).fetchall()
+    finally:
+        sess.close()
+    assert len(rows) == 1
+    assert rows[0]["start"] == '2000-01-01 00:00:00.000000'
+    assert rows[0]["last_active"] == '2000-01-01 00:00:00.000000'
+    assert rows[0]["stop"] == '2000-01-02 00:00:00.000000'
+
+
+def test_any_event_keeps_work_run_alive() -> None:
+    engine = init_lite("sqlite:///:memory:")
+    server = Server(engine, work_run_timeout=30.0)
+    assert server.execute(ServerInfoRequest()) == ServerInfoResponse(30.0)
+    server.execute(StartWorkRunRequest("WS1", datetime(2000, 1, 1)))
+    server.execute(StopActivityPeriodRequest("WS1", datetime(2000, 1, 2)))
+    sess = session(engine)
+    try:
+        rows = sess.execute(
+            text("""SELECT "last_active" FROM "WorkRun" """)
+            ).fetchall()
+    finally:
+        sess.close()
+    assert rows[0]["last_active"] == '2000-01-02 00:00:00.000000'
+
+
+def test_associate_batches_in_bulk() -> None:
+    engine = init_lite("sqlite:///:memory:")
+    server = Server(engine)
+    server.associate_batch("CODE1", "OLD")
+    batches = [(f"CODE{i}", f"NAME{i}") for i in range(1200)]
+    batches.append(("CODE2", "LAST"))
+    reply = server.execute(BulkBatchAssociationRequest(batches))
+    assert reply == BulkBatchAssociationResponse(1200)
+    assert server.execute(BatchNameQueryRequest("CODE1")) == \
+        BatchNameQueryResponse("NAME1")
+    assert server.execute(BatchNameQueryRequest("CODE2")) == \
+        BatchNameQueryResponse("LAST")
+    sess = session(engine)
+    try:
+        rows = sess.execute(text("""SELECT count(*) FROM "Batch" """)).scalar()
+    finally:
+        sess.close()
+    assert rows == 1201
+
+
+def test_device_time_corrected_beyond_skew_tolerance() -> None:
+    engine = init_lite("sqlite:///:memory:")
+    server_module.now = lambda: datetime(2000, 1, 1, 12, 0, 0)
+    server = Server(engine, clock_skew_tolerance=5.0)
+    slow = datetime(2000, 1, 1, 11, 0, 0)
+    server.execute(RefreshWorkRunRequest("SLOW", slow, sent=slow))
+    server.execute(RefreshWorkRunRequest("SLOW", sent=slow.replace(second=30)))
+    server.execute(RefreshWorkRunRequest(
+        "OK", sent=datetime(2000, 1, 1, 12, 0, 2)))
+    assert server.clock_offset("SLOW") == 3570.0
+    assert server.device_time("SLOW", datetime(2000, 1, 1, 10, 59, 0)) == \
+        datetime(2000, 1, 1, 11, 58, 30)
+    assert server.device_time("OK", datetime(2000, 1, 1, 11, 59, 0)) == \
+        datetime(2000, 1, 1, 11, 59, 0)
+    assert server.device_time("OK", datetime(2000, 1, 1, 12, 0, 1)) == \
+        datetime(2000, 1, 1, 12, 0, 0)
+
+
+def test_drained_backlog_does_not_shift_event_times() -> None:
+    engine = init_lite("sqlite:///:memory:")
+    server_module.now = lambda: datetime(2000, 1, 1, 12, 0, 0)
+    server = Server(engine, clock_skew_tolerance=5.0)
+    server.execute(StartWorkRunRequest("WS", datetime(2000, 1, 1, 11, 0, 0)))
+    # Heartbeats queued during an outage, each 20 s older than the next.
+    backlog: List[Any] = [
+        RefreshWorkRunRequest("WS", datetime(2000, 1, 1, 11, 50, 0) +
+                              timedelta(seconds=20 * i))
+        for i in range(CLOCK_OFFSET_SAMPLES + 4)]
+    backlog.append(StopWorkRunRequest("WS", datetime(2000, 1, 1, 11, 57, 0)))
+    server.execute(MultiOperationRequest(
+        backlog, sent=datetime(2000, 1, 1, 12, 0, 0)))
+    assert server.clock_offset("WS") == 0.0
+    sess = session(engine)
+    try:
+        rows = sess.execute(
+            text("""SELECT "last_active", "stop" FROM "WorkRun" """)
+            ).fetchall()
+    finally:
+        sess.close()
+    assert rows == [('2000-01-01 11:56:20.000000',
+                     '2000-01-01 11:57:00.000000')]
+
+
+def test_heartbeat_stats_kept_per_workstation() -> None:
+    engine = init_lite("sqlite:///:memory:")
+    server = Server(engine)
+    server.execute(RefreshWorkRunRequest("WS1", stats={"led": {}}))
+    server.execute(RefreshWorkRunRequest("WS2"))
+    reply = server.execute(StatsRequest())
+    assert reply.devices == {"WS1": {"led": {}}}
+    assert reply.server["writer"]["counters"]["commands"] == 2
+    journal = server.execute(JournalRequest(0)).entries
+    assert [message.stats for _, message in journal] == [None, None]
+
+
+def test_retried_start_applied_once() -> None:
+    engine = init_lite("sqlite:///:memory:")
+    server = Server(engine)
+    server.execute(StartWorkRunRequest("WS1", datetime(2000, 1, 1)))
+    server.execute(StartWorkRunRequest("WS1", datetime(2000, 1, 1)))
+    sess = session(engine)
+    try:
+        rows = sess.execute(
+            text("""SELECT "id" FROM "WorkRun" """)
+            ).fetchall()
+    finally:
+        sess.close()
+    assert len(rows) == 1
+
+
+def test_first_event_corrected_by_its_send_time() -> None:
+    engine = init_lite("sqlite:///:memory:")
+    server_module.now = lambda: datetime(2000, 1, 1, 12, 0, 0)
+    server = Server(engine, clock_skew_tolerance=5.0)
+    slow = datetime(2000, 1, 1, 11, 0, 0)
+    server.execute(StartWorkRunRequest("WS", slow, sent=slow))
+    sess = session(engine)
+    try:
+        rows = sess.execute(
+            text("""SELECT "start" FROM "WorkRun" """)
+            ).fetchall()
+    finally:
+        sess.close()
+    assert rows == [('2000-01-01 12:00:00.000000',)]
+
+
+def test_start_retried_after_offset_changed_applied_once() -> None:
+    engine = init_lite("sqlite:///:memory:")
+    server_module.now = lambda: datetime(2000, 1, 1, 12, 0, 0)
+    server = Server(engine, clock_skew_tolerance=5.0)
+    start = datetime(2000, 1, 1, 10, 59, 0)
+    server.execute(StartWorkRunRequest(
+        "WS", start, sent=datetime(2000, 1, 1, 11, 0, 0)))
+    # A faster round trip lowers the estimated offset before the retry.
+    server.execute(StartWorkRunRequest(
+        "WS", start, sent=datetime(2000, 1, 1, 11, 0, 30)))
+    assert server.clock_offset("WS") == 3570.0
+    sess = session(engine)
+    try:
+        rows = sess.execute(
+            text("""SELECT "start", "device_start" FROM "WorkRun" """)
+            ).fetchall()
+    finally:
+        sess.close()
+    assert rows == [('2000-01-01 11:59:00.000000',
+                     '2000-01-01 10:59:00.000000')]
+
+
+def test_multi_operation() -> None:
+    engine = init_lite("sqlite:///:memory:")
+    server_module.now = lambda: datetime(2000, 1, 1)
+    server = Server(engine)
+    server.start_activity_period("WS1", 1)
+    server_module.now = lambda: datetime(2000, 1, 2)
+    reply = server.execute(MultiOperationRequest([
+        StopActivityPeriodRequest("WS1"),
+        StartActivityPeriodRequest("WS1", 2)]))
+    assert reply == MultiOperationResponse([
+        StopActivityPeriodResponse(),
+        StartActivityPeriodResponse()])
+    sess = session(engine)
+    try:
+        rows = sess.execute(
+            text("""SELECT "num_workers", "start", "stop"
+                    FROM "ActivityPeriod" ORDER BY "id" """)
+            ).fetchall()
+    finally:
+        sess.close()
+    assert len(rows) == 2
+    assert rows[0]["stop"] == '2000-01-02 00:00:00.000000'
+    assert rows[1]["num_workers"] == 2
+    assert rows[1]["stop"] == None
+
+
+def test_multi_operation_rolled_back_on_error() -> None:
+    engine = init_lite("sqlite:///:memory:")
+    server = Server(engine)
+    try:
+        server.execute(MultiOperationRequest([
+            StartActivityPeriodRequest("WS1", 1),
+            "invalid"]))
+    except ValueError:
+        pass
+    else:
+        assert False, "expected ValueError"
+    sess = session(engine)
+    try:
+        rows = sess.execute(
+            text("""SELECT "id" FROM "ActivityPeriod" """)
+            ).fetchall()
+    finally:
+        sess.close()
+    assert rows == []
+
+
+def test_rejections_reported_without_orm_exceptions() -> None:
+    server = Server(init_lite("sqlite:///:memory:"))
+    try:
+        server.execute(MultiOperationRequest(["invalid"]))
+    except ValueError as e:
+        reply = error_response(e)
+    assert isinstance(reply.exception, RejectedError)
+    assert not isinstance(error_response(RuntimeError()).exception,
+                          RejectedError)
+
+
+def test_work_report_clips_work_to_period() -> None:
+    server_module.now = lambda: datetime(2000, 1, 2, 6, 0, 0)
+    server = Server(init_lite("sqlite:///:memory:"))
+    server.execute(BatchAssociationRequest("A", "FIRST"))
+    server.execute(BatchAssociationRequest("B", "SECOND"))
+    for ws, code, start, stop in [
+            ("WS1", "A", datetime(1999, 12, 31, 23), datetime(2000, 1, 1, 1)),
+            ("WS1", "A", datetime(2000, 1, 1, 10), datetime(2000, 1, 1, 11)),
+            ("WS2", "B", datetime(1999, 12, 30), datetime(1999, 12, 31)),
+            ("WS2", "B", datetime(2000, 1, 1, 22), None)]:
+        server.execute(StartWorkRequest(ws, code, start))
+        if stop is not None:
+            server.execute(StopWorkRequest(ws, stop))
+    reply = server.execute(
+        WorkReportRequest(datetime(2000, 1, 1), datetime(2000, 1, 3)))
+    assert reply.rows == [("WS1", "FIRST", 2 * 3600.0),
+                          ("WS2", "SECOND", 8 * 3600.0)]
+
+def test_concurrent_changes_go_through_writer(tmp_path: Path) -> None:
+    server_module.now = lambda: datetime(2000, 1, 1, 12, 0, 0)
+    server = Server(init_lite(f"sqlite:///{tmp_path / 'reifer.db'}"))
+    server.writer.start()
+    def start_periods(ws: str) -> None:
+        for hour in range(10):
+            server.execute(StartActivityPeriodRequest(
+                ws, 1, datetime(2000, 1, 1, hour)))
+    threads = [Thread(target=start_periods, args=(f"WS{i}",))
+               for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    server.writer.stop()
+    assert server.journal_position() == 40
+    assert server.writer.stats.snapshot()["counters"]["commands"] == 40
+
+def test_standby_applies_journal() -> None:
+    server_module.now = lambda: datetime(2000, 1, 1)
+    primary = Server(init_lite("sqlite:///:memory:"))
+    primary.execute(BatchAssociationRequest("CODE", "NAME"))
+    primary.execute(BatchNameQueryRequest("CODE"))
+    started = datetime(1999, 12, 31, 23, 0, 0)
+    primary.execute(StartWorkRunRequest("WS", started))
+    reply = primary.execute(JournalRequest(0))
+    assert [(sequence, type(message))
+            for sequence, message in reply.entries] == [
+        (1, BatchAssociationRequest), (2, StartWorkRunRequest)]
+    standby_engine = init_lite("sqlite:///:memory:")
+    standby = Server(standby_engine)
+    assert standby.apply_journal(reply.entries[:1]) == 1
+    assert standby.apply_journal(reply.entries) == 2
+    assert standby.journal_position() == 2
+    batch = standby.find_batch_by_code("CODE")
+    assert batch is not None and batch.name == "NAME"
+    sess = session(standby_engine)
+    try:
+        rows = sess.execute(
+            text("""SELECT "start" FROM "WorkRun" """)).fetchall()
+    finally:
+        sess.close()
+    assert rows == [('1999-12-31 23:00:00.000000',)]
+
+
+def test_standby_ends_up_with_primary_rows() -> None:
+    clock = [datetime(2000, 1, 1, 8, 0, 0)]
+    server_module.now = lambda: clock[0]
+    primary_engine = init_lite("sqlite:///:memory:")
+    primary = Server(primary_engine, work_run_timeout=60.0)
+    primary.execute(BatchAssociationRequest("CODE", "NAME"))
+    primary.execute(BulkBatchAssociationRequest([("BULK", "BULK")]))
+    primary.execute(StartActivityPeriodRequest("WS", 1))
+    primary.execute(StartWorkRunRequest("WS"))
+    primary.execute(StartWorkRequest("WS", "CODE"))
+    clock[0] += timedelta(minutes=5)
+    primary.terminate_work_runs()
+    primary.execute(StopWorkRequest("WS"))
+    entries = primary.execute(JournalRequest(0)).entries
+    # The standby replays the journal much later than it was written.
+    clock[0] += timedelta(hours=1)
+    standby_engine = init_lite("sqlite:///:memory:")
+    standby = Server(standby_engine, work_run_timeout=1.0)
+    standby.role = STANDBY
+    standby.apply_journal(entries)
+    standby.promote()
+    assert standby.role == PRIMARY
+    for table in ["Batch", "ActivityPeriod", "WorkRun", "Work"]:
+        query = f"""SELECT * FROM "{table}" ORDER BY "id" """
+        rows = [session(engine).execute(text(query)).fetchall()
+                for engine in [primary_engine, standby_engine]]
+        assert rows[0] and rows[0] == rows[1]
+
+
+def test_pruned_journal_cannot_be_followed() -> None:
+    server = Server(init_lite("sqlite:///:memory:"), journal_retention=1)
+    for code in ["A", "B", "C"]:
+        server.execute(BatchAssociationRequest(code, "NAME"))
+    with server.transaction() as sess:
+        server._prune_journal(sess)
+    reply = server.execute(JournalRequest(2))
+    assert [sequence for sequence, _ in reply.entries] == [3]
+    try:
+        server.execute(JournalRequest(1))
+    except ValueError:
+        pass
+    else:
+        assert False, "expected ValueError"
+
+
+def test_standby_promotes_when_primary_stops_answering(tmp_path: Path) -> None:
+    primary = Server(init_lite(f"sqlite:///{tmp_path / 'primary.db'}"))
+    primary.execute(BatchAssociationRequest("CODE", "NAME"))
+    context = zmq.Context()
+    # pylint: disable=E1101
+    router = context.socket(zmq.ROUTER)
+    port = router.bind_to_random_port("tcp://127.0.0.1")
+    polls: List[Any] = []
+    def serve_then_hang() -> None:
+        # Answers the first poll, then ignores polls until it is fenced.
+        while True:
+            *envelope, payload = router.recv_multipart()
+            message = pickle.loads(payload)
+            polls.append(message)
+            if len(polls) == 1 or isinstance(message, FenceRequest):
+                reply = primary.execute(message)
+                router.send_multipart(envelope + [pickle.dumps(reply)])
+            if isinstance(message, FenceRequest):
+                return
+    thread = Thread(target=serve_then_hang)
+    thread.start()
+    standby = Server(init_lite(f"sqlite:///{tmp_path / 'standby.db'}"))
+    standby.follow(f"tcp://127.0.0.1:{port}", poll_interval=0.01,
+                   poll_timeout=0.05, promote_after_failures=3)
+    thread.join()
+    router.close(linger=0)
+    assert [type(x) for x in polls] == [JournalRequest] * 4 + [FenceRequest]
+    assert standby.role == PRIMARY
+    assert primary.role == FENCED
+    batch = standby.find_batch_by_code("CODE")
+    assert batch is not None and batch.name == "NAME"
+    assert standby.journal_position() == 1
+
+
+def test_only_primary_accepts_changes() -> None:
+    server = Server(init_lite("sqlite:///:memory:"))
+    server.role = STANDBY
+    assert server.execute(ServerInfoRequest()).role == STANDBY
+    try:
+        server.execute(StartWorkRunRequest("WS"))
+    except NotPrimaryError:
+        pass
+    else:
+        assert False, "expected NotPrimaryError"
+    assert server.execute(PromoteRequest()) == PromoteResponse()
+    server.execute(StartWorkRunRequest("WS"))
+    server.execute(FenceRequest())
+    assert server.execute(ServerInfoRequest()).role == FENCED
+    try:
+        server.execute(StopWorkRunRequest("WS"))
+    except NotPrimaryError:
+        pass
+    else:
+        assert False, "expected NotPrimaryError"
+
+
+# vim: tw=80 sw=4 ts=4 expandtab:
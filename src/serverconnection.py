@@ -13,12 +13,20 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 # pylint: disable=W0614
-from logging import error
-from typing import Any, Optional
+import time
+from concurrent.futures import Future
+from datetime import datetime
+from logging import error, warning
+from queue import Empty, Queue
+from threading import Lock, Thread
+from typing import (Any, Callable, Dict, List, NamedTuple, Optional, Tuple,
+                    Type, Union)
 
 import zmq
 
 from message import *
+from outbox import Outbox, device_now, is_event, timestamped
+from stats import Stats
 
 
 class ServerError(Exception):
@@ -26,16 +34,270 @@ class ServerError(Exception):
         super().__init__(msg)
 
 
+class ServerTimeoutError(ServerError):
+    pass
+
+
+# Messages that are cheap and safe to send again when their reply is lost.
+# Events are safe as well, since the server recognises a repeated event by
+# its device time. Anything else may have been applied already and is sent
+# only once.
+RETRIED_MESSAGES = (ServerInfoRequest, BatchNameQueryRequest,
+                    RecentBatchesQueryRequest)
+
+
+def is_retried(message: Any) -> bool:
+    if isinstance(message, MultiOperationRequest):
+        return all(is_retried(x) for x in message.operations)
+    return isinstance(message, RETRIED_MESSAGES) or is_event(message)
+
+
+def _expect(response_type: Type[Any]) -> Callable[[Any], Any]:
+    def unpack(resp: Any) -> Any:
+        assert isinstance(resp, response_type)
+        return resp
+    return unpack
+
+
+def _unpack_work_run_timeout(resp: Any) -> float:
+    assert isinstance(resp, ServerInfoResponse)
+    return resp.work_run_timeout
+
+
+def _unpack_batch_name(resp: Any) -> Optional[str]:
+    assert isinstance(resp, BatchNameQueryResponse)
+    return resp.batch_name
+
+
+def _unpack_recent_batches(resp: Any) -> List[Tuple[str, str]]:
+    assert isinstance(resp, RecentBatchesQueryResponse)
+    return resp.batches
+
+
+def _unpack_work_report(resp: Any) -> List[Tuple[str, str, float]]:
+    assert isinstance(resp, WorkReportResponse)
+    return resp.rows
+
+
+def _unpack_batch_id(resp: Any) -> int:
+    assert isinstance(resp, BatchAssociationResponse)
+    return resp.batch_id
+
+
+def _unpack_num_batches(resp: Any) -> int:
+    assert isinstance(resp, BulkBatchAssociationResponse)
+    return resp.num_batches
+
+
+class MultiOperation:
+    """Collects operations to be sent to the server in a single round trip.
+
+    The server applies the operations in order in one transaction. Each
+    method returns the position of its reply in the list of replies.
+    """
+    _connection: 'ServerConnection'
+    _operations: List[Any]
+    _response_types: List[Type[Any]]
+
+    def __init__(self, connection: 'ServerConnection') -> None:
+        self._connection = connection
+        self._operations = []
+        self._response_types = []
+
+    def _add(self, message: Any, response_type: Type[Any]) -> int:
+        self._operations.append(message)
+        self._response_types.append(response_type)
+        return len(self._operations) - 1
+
+    def _unpack(self, resp: Any) -> List[Any]:
+        assert isinstance(resp, MultiOperationResponse)
+        assert len(resp.replies) == len(self._response_types)
+        for reply, response_type in zip(resp.replies, self._response_types):
+            assert isinstance(reply, response_type)
+        return resp.replies
+
+    def __len__(self) -> int:
+        return len(self._operations)
+
+    def get_batch_name(self, batch_code: str) -> int:
+        return self._add(BatchNameQueryRequest(batch_code),
+                         BatchNameQueryResponse)
+
+    def associate_batch(self, batch_code: str, batch_name: str) -> int:
+        return self._add(BatchAssociationRequest(batch_code, batch_name),
+                         BatchAssociationResponse)
+
+    def start_activity_period(self, workstation_code: str, num_workers: int) -> int:
+        return self._add(StartActivityPeriodRequest(workstation_code, num_workers),
+                         StartActivityPeriodResponse)
+
+    def stop_activity_period(self, workstation_code: str) -> int:
+        return self._add(StopActivityPeriodRequest(workstation_code),
+                         StopActivityPeriodResponse)
+
+    def start_work_run(self, workstation_code: str) -> int:
+        return self._add(StartWorkRunRequest(workstation_code),
+                         StartWorkRunResponse)
+
+    def refresh_work_run(
+            self,
+            workstation_code: str,
+            stats: Optional[Dict[str, Any]] = None) -> int:
+        return self._add(RefreshWorkRunRequest(workstation_code, stats=stats),
+                         RefreshWorkRunResponse)
+
+    def stop_work_run(self, workstation_code: str) -> int:
+        return self._add(StopWorkRunRequest(workstation_code),
+                         StopWorkRunResponse)
+
+    def start_work(self, workstation_code: str, batch_code: str) -> int:
+        return self._add(StartWorkRequest(workstation_code, batch_code),
+                         StartWorkResponse)
+
+    def stop_work(self, workstation_code: str) -> int:
+        return self._add(StopWorkRequest(workstation_code),
+                         StopWorkResponse)
+
+    def send(self) -> List[Any]:
+        """Sends the operations and waits for the replies."""
+        if not self._operations:
+            return []
+        replies = self._connection._call(
+            MultiOperationRequest(self._operations), self._unpack)
+        assert isinstance(replies, list)
+        return replies
+
+    def submit(self) -> 'Future[List[Any]]':
+        """Sends the operations and returns a future for the replies."""
+        return self._connection._request(
+            MultiOperationRequest(self._operations), self._unpack)
+
+    def post(self) -> None:
+        """Sends the operations without waiting for the replies."""
+        if self._operations:
+            self._connection._post(
+                MultiOperationRequest(self._operations), self._unpack)
+
+
 class ServerConnection:
-    def __init__(self, address: str) -> None:
-        self.address = address
+    """Request-reply connection to the server.
+
+    Each attempt waits at most `timeout` seconds for the reply. After a
+    timeout the socket is recreated, since a REQ socket that lost a reply
+    cannot send again, and the request is retried up to `retries` times with
+    exponential backoff starting from `backoff` seconds. A call therefore
+    fails with ServerTimeoutError after at most
+    (retries + 1) * timeout + backoff * (2 ** retries - 1) seconds. Only
+    queries and events are retried, see is_retried; other messages fail
+    after the first timeout, as the server may have applied them.
+
+    Given several addresses, such as a primary server and its standby, a
+    timeout or a NotPrimaryError makes the connection ask the other servers
+    for their role, waiting up to `timeout` seconds for each, and switch
+    to the one that answers it is the primary. A standby only says so once
+    promoted, so a primary that is merely slow keeps its clients.
+    """
+    timeouts: int
+    reconnects: int
+    failovers: int
+    stats: Stats
+
+    def __init__(self,
+                 address: Union[str, List[str]],
+                 timeout: float = 5.0,
+                 retries: int = 3,
+                 backoff: float = 0.5) -> None:
+        self.addresses = [address] if isinstance(address, str) else address
+        assert self.addresses, "no server addresses"
+        self.address = self.addresses[0]
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.timeouts = 0
+        self.reconnects = 0
+        self.failovers = 0
+        self.stats = Stats()
         self.context = zmq.Context()
         # pylint: disable=E1101
         self.socket = self.context.socket(zmq.REQ)
 
-    def _communicate(self, message: Any) -> Any:
-        self.socket.send_pyobj(message)
-        result = self.socket.recv_pyobj()
+    def _reconnect(self) -> None:
+        # pylint: disable=E1101
+        self.socket.setsockopt(zmq.LINGER, 0)
+        self.socket.close()
+        self.socket = self.context.socket(zmq.REQ)
+        self.socket.connect(self.address)
+        self.reconnects += 1
+        self.stats.incr("reconnects")
+
+    def _role(self, address: str) -> Optional[str]:
+        # pylint: disable=E1101
+        socket = self.context.socket(zmq.REQ)
+        socket.setsockopt(zmq.LINGER, 0)
+        socket.connect(address)
+        try:
+            socket.send_pyobj(ServerInfoRequest())
+            if not socket.poll(int(self.timeout * 1000), zmq.POLLIN):
+                return None
+            reply = socket.recv_pyobj()
+        finally:
+            socket.close()
+        if not isinstance(reply, ServerInfoResponse):
+            return None
+        return reply.role
+
+    def _fail_over(self) -> bool:
+        """Switches to another server if it has become the primary."""
+        for address in self.addresses:
+            if address == self.address:
+                continue
+            if self._role(address) == PRIMARY:
+                warning(f"Failing over from {self.address} to {address}")
+                self.address = address
+                self.failovers += 1
+                self.stats.incr("failovers")
+                return True
+        return False
+
+    def _communicate(self, message: Any, timeout: Optional[float] = None) -> Any:
+        if timeout is None:
+            timeout = self.timeout
+        # Events are stamped once, so retries carry the time they happened.
+        message = timestamped(message)
+        retries = self.retries if is_retried(message) else 0
+        attempt = 0
+        began = time.perf_counter()
+        while True:
+            if "sent" in getattr(message, "_fields", ()):
+                # Unlike the event times, this lets the server measure the
+                # device clock however long the message waited.
+                message = message._replace(sent=device_now())
+            self.socket.send_pyobj(message)
+            # pylint: disable=E1101
+            if self.socket.poll(int(timeout * 1000), zmq.POLLIN):
+                result = self.socket.recv_pyobj()
+                if (isinstance(result, ErrorResponse) and
+                        isinstance(result.exception, NotPrimaryError) and
+                        attempt < self.retries and self._fail_over()):
+                    self._reconnect()
+                    attempt += 1
+                    continue
+                break
+            self.timeouts += 1
+            self.stats.incr("timeouts")
+            warning(f"No reply to {type(message).__name__} " +
+                    f"in {timeout} s from {self.address}")
+            if len(self.addresses) > 1:
+                self._fail_over()
+            self._reconnect()
+            if attempt >= retries:
+                raise ServerTimeoutError(
+                    f"No reply from {', '.join(self.addresses)} " +
+                    f"after {attempt + 1} attempts")
+            time.sleep(self.backoff * 2 ** attempt)
+            attempt += 1
+        self.stats.observe(f"round_trip.{type(message).__name__}",
+                           time.perf_counter() - began)
         if isinstance(result, ErrorResponse):
             tb = '\n'.join(result.stack_summary.format())
             args = result.exception.args
@@ -47,45 +309,356 @@ class ServerConnection:
             raise result.exception
         return result
 
+    def _call(self, message: Any, unpack: Callable[[Any], Any]) -> Any:
+        return unpack(self._communicate(message))
+
+    def _post(self, message: Any, unpack: Callable[[Any], Any]) -> None:
+        self._call(message, unpack)
+
+    def _request(self,
+                 message: Any,
+                 unpack: Callable[[Any], Any]) -> 'Future[Any]':
+        future: 'Future[Any]' = Future()
+        try:
+            future.set_result(self._call(message, unpack))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
     def connect(self) -> None:
         self.socket.connect(self.address)
 
+    def stop(self) -> None:
+        pass
+
+    def multi(self) -> MultiOperation:
+        return MultiOperation(self)
+
+    def fetch_work_run_timeout(self) -> 'Future[float]':
+        return self._request(ServerInfoRequest(), _unpack_work_run_timeout)
+
     def get_batch_name(self, batch_code: str) -> Optional[str]:
-        resp = self._communicate(BatchNameQueryRequest(batch_code))
-        assert isinstance(resp, BatchNameQueryResponse)
-        return resp.batch_name
+        name = self._call(BatchNameQueryRequest(batch_code),
+                          _unpack_batch_name)
+        assert isinstance(name, (str, type(None)))
+        return name
+
+    def fetch_batch_name(self, batch_code: str) -> 'Future[Optional[str]]':
+        return self._request(BatchNameQueryRequest(batch_code),
+                             _unpack_batch_name)
+
+    def fetch_recent_batches(self,
+                             limit: int) -> 'Future[List[Tuple[str, str]]]':
+        return self._request(RecentBatchesQueryRequest(limit),
+                             _unpack_recent_batches)
+
+    def get_work_report(self,
+                        start: datetime,
+                        stop: datetime) -> List[Tuple[str, str, float]]:
+        rows = self._call(WorkReportRequest(start, stop), _unpack_work_report)
+        assert isinstance(rows, list)
+        return rows
 
     def associate_batch(self, batch_code: str, batch_name: str) -> int:
-        resp = self._communicate(BatchAssociationRequest(batch_code, batch_name))
-        assert isinstance(resp, BatchAssociationResponse)
-        return resp.batch_id
+        batch_id = self._call(BatchAssociationRequest(batch_code, batch_name),
+                              _unpack_batch_id)
+        assert isinstance(batch_id, int)
+        return batch_id
+
+    def associate_batches(self, batches: List[Tuple[str, str]]) -> int:
+        """Associates many (code, name) pairs in one server transaction."""
+        count = self._call(BulkBatchAssociationRequest(batches),
+                           _unpack_num_batches)
+        assert isinstance(count, int)
+        return count
 
     def start_activity_period(self, workstation_code: str, num_workers: int) -> None:
-        resp = self._communicate(
-            StartActivityPeriodRequest(workstation_code, num_workers))
-        assert isinstance(resp, StartActivityPeriodResponse)
+        self._post(StartActivityPeriodRequest(workstation_code, num_workers),
+                   _expect(StartActivityPeriodResponse))
 
     def stop_activity_period(self, workstation_code: str) -> None:
-        resp = self._communicate(
-            StopActivityPeriodRequest(workstation_code))
-        assert isinstance(resp, StopActivityPeriodResponse)
+        self._post(StopActivityPeriodRequest(workstation_code),
+                   _expect(StopActivityPeriodResponse))
 
     def start_work_run(self, workstation_code: str) -> None:
-        resp = self._communicate(StartWorkRunRequest(workstation_code))
-        assert isinstance(resp, StartWorkRunResponse)
+        self._post(StartWorkRunRequest(workstation_code),
+                   _expect(StartWorkRunResponse))
 
-    def refresh_work_run(self, workstation_code: str) -> None:
-        resp = self._communicate(RefreshWorkRunRequest(workstation_code))
-        assert isinstance(resp, RefreshWorkRunResponse)
+    def refresh_work_run(
+            self,
+            workstation_code: str,
+            stats: Optional[Dict[str, Any]] = None) -> None:
+        self._post(RefreshWorkRunRequest(workstation_code, stats=stats),
+                   _expect(RefreshWorkRunResponse))
 
     def stop_work_run(self, workstation_code: str) -> None:
-        resp = self._communicate(StopWorkRunRequest(workstation_code))
-        assert isinstance(resp, StopWorkRunResponse)
+        self._post(StopWorkRunRequest(workstation_code),
+                   _expect(StopWorkRunResponse))
 
     def start_work(self, workstation_code: str, batch_code: str) -> None:
-        resp = self._communicate(StartWorkRequest(workstation_code, batch_code))
-        assert isinstance(resp, StartWorkResponse)
+        self._post(StartWorkRequest(workstation_code, batch_code),
+                   _expect(StartWorkResponse))
 
     def stop_work(self, workstation_code: str) -> None:
-        resp = self._communicate(StopWorkRequest(workstation_code))
-        assert isinstance(resp, StopWorkResponse)
+        self._post(StopWorkRequest(workstation_code),
+                   _expect(StopWorkResponse))
+
+
+class _Outbound(NamedTuple):
+    message: Any
+    unpack: Callable[[Any], Any]
+    future: Optional['Future[Any]']
+    on_clock: bool
+
+
+_DRAIN = _Outbound(None, lambda resp: resp, None, False)
+
+
+class QueuedServerConnection(ServerConnection):
+    """A ServerConnection that never blocks the calling thread on the network.
+
+    Messages are sent in order by a background sender thread, which is the
+    only thread touching the socket. Fire-and-forget calls return at once;
+    calls that need a reply return a future that is resolved through
+    `schedule`, i.e. on the Kivy clock in the client. Blocking calls are
+    still available and wait for the sender thread.
+
+    With an outbox, event messages are stamped with the device time and
+    stored before they are sent, and are delivered in order in batches of
+    up to `batch_size` once the server can be reached. While the server
+    cannot be reached, delivery is retried every `timeout` seconds. An
+    entry the server rejects is dropped, and one that fails with any other
+    server error `max_attempts` times is moved to the dead letters of the
+    outbox, so that neither holds up the entries behind it.
+    """
+    _schedule: Tuple[Callable[[Callable[..., None]], None]]
+    _outbound: 'Queue[Optional[_Outbound]]'
+    _sender: Optional[Thread]
+    _outbox: Optional[Outbox]
+    _batch_size: int
+    _max_attempts: int
+    _attempts: Dict[int, int]
+    _pending: Dict[int, _Outbound]
+    _pending_lock: Lock
+    _drain_queued: bool
+    _backlog: bool
+    _retry_at: float
+
+    def __init__(self,
+                 address: Union[str, List[str]],
+                 schedule: Callable[[Callable[..., None]], None],
+                 outbox: Optional[Outbox] = None,
+                 batch_size: int = 50,
+                 max_attempts: int = 10,
+                 timeout: float = 5.0,
+                 retries: int = 3,
+                 backoff: float = 0.5) -> None:
+        super().__init__(address, timeout, retries, backoff)
+        assert max_attempts >= 1
+        self._schedule = (schedule,)
+        self._outbound = Queue()
+        self._sender = None
+        self._outbox = outbox
+        self._batch_size = batch_size
+        self._max_attempts = max_attempts
+        self._attempts = {}
+        self._pending = {}
+        self._pending_lock = Lock()
+        self._drain_queued = False
+        self._backlog = False
+        self._retry_at = 0.0
+
+    def connect(self) -> None:
+        super().connect()
+        self._sender = Thread(target=self._send_outbound, daemon=True)
+        self._sender.start()
+        if self._outbox is not None:
+            self._request_drain()
+
+    def stop(self) -> None:
+        if self._sender is not None:
+            self._outbound.put(None)
+            self._sender.join()
+            self._sender = None
+
+    def _enqueue(self, outbound: _Outbound) -> None:
+        # Stamp events now rather than when the sender gets to them.
+        outbound = outbound._replace(message=timestamped(outbound.message))
+        if self._outbox is None or not is_event(outbound.message):
+            self._outbound.put(outbound)
+            return
+        with self._pending_lock:
+            entry_id = self._outbox.append(outbound.message)
+            if outbound.future is not None:
+                self._pending[entry_id] = outbound
+        self._request_drain()
+
+    def _request_drain(self) -> None:
+        # A single marker in the queue drains every entry appended before
+        # the sender takes it, so there is never a need for more.
+        with self._pending_lock:
+            if self._drain_queued:
+                return
+            self._drain_queued = True
+        self._outbound.put(_DRAIN)
+
+    def _call(self, message: Any, unpack: Callable[[Any], Any]) -> Any:
+        future: 'Future[Any]' = Future()
+        self._enqueue(_Outbound(message, unpack, future, False))
+        return future.result()
+
+    def _post(self, message: Any, unpack: Callable[[Any], Any]) -> None:
+        self._enqueue(_Outbound(message, unpack, None, False))
+
+    def _request(self,
+                 message: Any,
+                 unpack: Callable[[Any], Any]) -> 'Future[Any]':
+        future: 'Future[Any]' = Future()
+        self._enqueue(_Outbound(message, unpack, future, True))
+        return future
+
+    def _send_outbound(self) -> None:
+        while True:
+            wait = None
+            if self._backlog:
+                wait = max(0.0, self._retry_at - time.monotonic())
+            try:
+                outbound = self._outbound.get(timeout=wait)
+            except Empty:
+                outbound = _DRAIN
+            if outbound is None:
+                return
+            if outbound is _DRAIN:
+                with self._pending_lock:
+                    self._drain_queued = False
+                # After a failure, wait for the retry time however many
+                # events arrive meanwhile, and serve the queries instead.
+                if not self._backlog or time.monotonic() >= self._retry_at:
+                    self._drain_outbox()
+                continue
+            try:
+                result = outbound.unpack(self._communicate(outbound.message))
+            except Exception as e:
+                if outbound.future is None:
+                    error(f"Sending {type(outbound.message).__name__} " +
+                          f"failed: {e!r}")
+                self._resolve(outbound, None, e)
+            else:
+                self._resolve(outbound, result, None)
+
+    def _drain_outbox(self) -> None:
+        assert self._outbox is not None
+        self._backlog = True
+        while True:
+            entries = self._outbox.peek(self._batch_size)
+            if not entries:
+                self._backlog = False
+                return
+            try:
+                self._send_entries(entries)
+                continue
+            except Exception as e:
+                if len(entries) == 1 or isinstance(e, ServerTimeoutError):
+                    if not self._discard(entries[0], e):
+                        return
+                    continue
+            # One bad entry rolls back the whole batch on the server, so
+            # find it by sending the entries one at a time.
+            for entry in entries:
+                try:
+                    self._send_entries([entry])
+                except Exception as e:
+                    if not self._discard(entry, e):
+                        return
+
+    def _discard(self, entry: Tuple[int, Any], exception: Exception) -> bool:
+        """Drops an entry that failed, or schedules another attempt.
+
+        A rejected entry is dropped at once. Timeouts say nothing about the
+        entry and never count as attempts. Returns whether it was dropped.
+        """
+        assert self._outbox is not None
+        entry_id, message = entry
+        name = type(message).__name__
+        if isinstance(exception, RejectedError):
+            error(f"Server rejected {name}: {exception!r}")
+            self._outbox.remove([entry_id])
+        else:
+            attempts = self._attempts.get(entry_id, 0)
+            if not isinstance(exception, ServerTimeoutError):
+                attempts += 1
+            if attempts < self._max_attempts:
+                self._attempts[entry_id] = attempts
+                self._retry_at = time.monotonic() + self.timeout
+                error(f"Sending outbox failed, retrying: {exception!r}")
+                return False
+            error(f"Giving up on {name} after {attempts} attempts, " +
+                  f"moved to dead letters: {exception!r}")
+            self._outbox.bury(entry_id, repr(exception))
+        self._attempts.pop(entry_id, None)
+        self._complete(entry_id, None, exception)
+        return True
+
+    def _send_entries(self, entries: List[Tuple[int, Any]]) -> None:
+        assert self._outbox is not None
+        operations: List[Any] = []
+        for _, message in entries:
+            if isinstance(message, MultiOperationRequest):
+                operations.extend(message.operations)
+            else:
+                operations.append(message)
+        resp = self._communicate(MultiOperationRequest(operations))
+        assert isinstance(resp, MultiOperationResponse)
+        replies: List[Tuple[int, Any]] = []
+        position = 0
+        for entry_id, message in entries:
+            if isinstance(message, MultiOperationRequest):
+                count = len(message.operations)
+                reply = MultiOperationResponse(
+                    resp.replies[position:position + count])
+            else:
+                count = 1
+                reply = resp.replies[position]
+            position += count
+            replies.append((entry_id, reply))
+        self._outbox.remove([entry_id for entry_id, _ in entries])
+        for entry_id, reply in replies:
+            self._attempts.pop(entry_id, None)
+            self._complete(entry_id, reply, None)
+
+    def _complete(self,
+                  entry_id: int,
+                  reply: Any,
+                  exception: Optional[Exception]) -> None:
+        with self._pending_lock:
+            outbound = self._pending.pop(entry_id, None)
+        if outbound is None:
+            return
+        if exception is not None:
+            self._resolve(outbound, None, exception)
+            return
+        try:
+            result = outbound.unpack(reply)
+        except Exception as e:
+            self._resolve(outbound, None, e)
+        else:
+            self._resolve(outbound, result, None)
+
+    def _resolve(self,
+                 outbound: _Outbound,
+                 result: Any,
+                 exception: Optional[Exception]) -> None:
+        future = outbound.future
+        if future is None:
+            return
+        def resolve(*args: Any) -> None:
+            assert future is not None
+            if exception is not None:
+                future.set_exception(exception)
+            else:
+                future.set_result(result)
+        if outbound.on_clock:
+            schedule, = self._schedule
+            schedule(resolve)
+        else:
+            resolve()
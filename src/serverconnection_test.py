@@ -0,0 +1,313 @@
+# Copyright (C) 2018 Metatavu Oy
+# 
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+# 
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import pickle
+import time
+from datetime import datetime
+from threading import Event, Thread
+from typing import Any, Callable, List, Optional
+
+import zmq
+from sqlalchemy.exc import OperationalError
+
+from message import *
+from outbox import Outbox
+from serverconnection import (QueuedServerConnection, ServerConnection,
+                              ServerTimeoutError, is_retried)
+
+
+class FakeQueuedServerConnection(QueuedServerConnection):
+    scheduled: List[Callable[..., None]]
+    messages: List[Any]
+    release: Event
+
+    def __init__(self, outbox: Optional[Outbox] = None, **kwargs: Any) -> None:
+        self.scheduled = []
+        self.messages = []
+        self.release = Event()
+        super().__init__("inproc://fake", self.scheduled.append, outbox,
+                         **kwargs)
+
+    def _communicate(self, message: Any, timeout: Optional[float] = None) -> Any:
+        self.release.wait()
+        self.messages.append(message)
+        return self._reply(message)
+
+    def _reply(self, message: Any) -> Any:
+        if isinstance(message, MultiOperationRequest):
+            return MultiOperationResponse(
+                [self._reply(x) for x in message.operations])
+        if isinstance(message, BatchNameQueryRequest):
+            return BatchNameQueryResponse("NAME")
+        if isinstance(message, StopWorkRunRequest):
+            raise RejectedError("ValueError: rejected")
+        if isinstance(message, StopActivityPeriodRequest):
+            raise OperationalError("UPDATE", {}, Exception("database is locked"))
+        return StartWorkRunResponse()
+
+
+def test_post_does_not_wait_for_server() -> None:
+    connection = FakeQueuedServerConnection()
+    connection.connect()
+    connection.start_work_run("WS")
+    connection.start_work_run("WS")
+    assert connection.messages == []
+    connection.release.set()
+    connection.stop()
+    first, second = connection.messages
+    assert first.timestamp is not None and second.timestamp is not None
+    assert first.timestamp <= second.timestamp
+    assert first._replace(timestamp=None) == StartWorkRunRequest("WS")
+
+
+def test_request_resolved_on_schedule() -> None:
+    connection = FakeQueuedServerConnection()
+    connection.connect()
+    future = connection.fetch_batch_name("CODE")
+    connection.release.set()
+    connection.stop()
+    assert not future.done()
+    for callback in connection.scheduled:
+        callback(0)
+    assert future.result() == "NAME"
+
+
+def test_call_waits_for_reply() -> None:
+    connection = FakeQueuedServerConnection()
+    connection.release.set()
+    connection.connect()
+    assert connection.get_batch_name("CODE") == "NAME"
+    connection.stop()
+
+
+def test_outbox_survives_until_drained() -> None:
+    outbox = Outbox(":memory:")
+    connection = FakeQueuedServerConnection(outbox)
+    connection.start_work_run("WS")
+    connection.start_work_run("WS")
+    assert len(outbox) == 2
+    connection.release.set()
+    connection.connect()
+    connection.stop()
+    assert len(outbox) == 0
+    assert len(connection.messages) == 1
+    batch = connection.messages[0]
+    assert isinstance(batch, MultiOperationRequest)
+    assert [x.workstation_code for x in batch.operations] == ["WS", "WS"]
+    assert all(isinstance(x.timestamp, datetime) for x in batch.operations)
+    assert batch.operations[0].timestamp <= batch.operations[1].timestamp
+
+
+def test_outbox_drops_rejected_entry() -> None:
+    outbox = Outbox(":memory:")
+    connection = FakeQueuedServerConnection(outbox)
+    connection.release.set()
+    connection.start_work_run("WS")
+    connection.stop_work_run("WS")
+    connection.start_work_run("WS")
+    connection.connect()
+    connection.stop()
+    assert len(outbox) == 0
+    delivered = [x.operations for x in connection.messages[1:]
+                 if not isinstance(x.operations[0], StopWorkRunRequest)]
+    assert [type(x[0]) for x in delivered] == [StartWorkRunRequest,
+                                                StartWorkRunRequest]
+
+
+def test_outbox_keeps_entries_on_transient_error() -> None:
+    outbox = Outbox(":memory:")
+    connection = FakeQueuedServerConnection(outbox)
+    connection.release.set()
+    connection.start_work_run("WS")
+    connection.stop_activity_period("WS")
+    connection.connect()
+    connection.stop()
+    assert [type(x) for _, x in outbox.peek(10)] == [StopActivityPeriodRequest]
+    assert outbox.dead_letters() == []
+
+
+def test_outbox_buries_entry_failing_repeatedly() -> None:
+    outbox = Outbox(":memory:")
+    connection = FakeQueuedServerConnection(outbox, max_attempts=3,
+                                            timeout=0.01)
+    connection.release.set()
+    connection.stop_activity_period("WS")
+    connection.start_work_run("WS")
+    connection.connect()
+    deadline = time.monotonic() + 5
+    while len(outbox) > 0 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    connection.stop()
+    assert len(outbox) == 0
+    (_, message, reason), = outbox.dead_letters()
+    assert isinstance(message, StopActivityPeriodRequest)
+    assert "database is locked" in reason
+    assert isinstance(connection.messages[-1].operations[0],
+                      StartWorkRunRequest)
+
+
+def test_one_drain_queued_for_many_events() -> None:
+    connection = FakeQueuedServerConnection(Outbox(":memory:"))
+    for _ in range(5):
+        connection.start_work_run("WS")
+    assert connection._outbound.qsize() == 1
+
+
+def test_send_time_stamped_on_each_attempt() -> None:
+    context = zmq.Context()
+    # pylint: disable=E1101
+    router = context.socket(zmq.ROUTER)
+    port = router.bind_to_random_port("tcp://127.0.0.1")
+    received: List[Any] = []
+    def serve() -> None:
+        received.append(pickle.loads(router.recv_multipart()[-1]))
+        *envelope, payload = router.recv_multipart()
+        received.append(pickle.loads(payload))
+        router.send_multipart(
+            envelope + [pickle.dumps(RefreshWorkRunResponse())])
+    server = Thread(target=serve)
+    server.start()
+    connection = ServerConnection(f"tcp://127.0.0.1:{port}",
+                                  timeout=0.2, retries=1, backoff=0.01)
+    connection.connect()
+    connection.refresh_work_run("WS")
+    server.join()
+    router.close(linger=0)
+    first, second = received
+    assert first.timestamp == second.timestamp
+    assert first.sent is not None and second.sent is not None
+    assert first.sent < second.sent
+
+
+def test_timeout_reconnects_and_retries() -> None:
+    context = zmq.Context()
+    # pylint: disable=E1101
+    router = context.socket(zmq.ROUTER)
+    port = router.bind_to_random_port("tcp://127.0.0.1")
+    def serve() -> None:
+        router.recv_multipart()
+        *envelope, _ = router.recv_multipart()
+        router.send_multipart(
+            envelope + [pickle.dumps(BatchNameQueryResponse("NAME"))])
+    server = Thread(target=serve)
+    server.start()
+    connection = ServerConnection(f"tcp://127.0.0.1:{port}",
+                                  timeout=0.2, retries=1, backoff=0.01)
+    connection.connect()
+    assert connection.get_batch_name("CODE") == "NAME"
+    assert connection.timeouts == 1
+    assert connection.reconnects == 1
+    server.join()
+    router.close(linger=0)
+
+
+def test_timeout_gives_up_after_retries() -> None:
+    context = zmq.Context()
+    # pylint: disable=E1101
+    router = context.socket(zmq.ROUTER)
+    port = router.bind_to_random_port("tcp://127.0.0.1")
+    connection = ServerConnection(f"tcp://127.0.0.1:{port}",
+                                  timeout=0.05, retries=2, backoff=0.01)
+    connection.connect()
+    try:
+        connection.get_batch_name("CODE")
+    except ServerTimeoutError:
+        pass
+    else:
+        assert False, "expected ServerTimeoutError"
+    assert connection.timeouts == 3
+    assert connection.reconnects == 3
+    router.close(linger=0)
+
+
+def test_timeout_does_not_resend_non_idempotent_message() -> None:
+    context = zmq.Context()
+    # pylint: disable=E1101
+    router = context.socket(zmq.ROUTER)
+    port = router.bind_to_random_port("tcp://127.0.0.1")
+    connection = ServerConnection(f"tcp://127.0.0.1:{port}",
+                                  timeout=0.05, retries=2, backoff=0.01)
+    connection.connect()
+    try:
+        connection.associate_batch("CODE", "NAME")
+    except ServerTimeoutError:
+        pass
+    else:
+        assert False, "expected ServerTimeoutError"
+    assert connection.timeouts == 1
+    assert is_retried(MultiOperationRequest([StartWorkRunRequest("WS")]))
+    assert not is_retried(MultiOperationRequest(
+        [StartWorkRunRequest("WS"), BatchAssociationRequest("CODE", "NAME")]))
+    router.close(linger=0)
+
+
+def test_timeout_fails_over_to_next_address() -> None:
+    context = zmq.Context()
+    # pylint: disable=E1101
+    primary = context.socket(zmq.ROUTER)
+    primary_port = primary.bind_to_random_port("tcp://127.0.0.1")
+    standby = context.socket(zmq.ROUTER)
+    standby_port = standby.bind_to_random_port("tcp://127.0.0.1")
+    def serve() -> None:
+        # The standby announces that it has been promoted, then answers.
+        for reply in [ServerInfoResponse(60.0, PRIMARY),
+                      BatchNameQueryResponse("NAME")]:
+            *envelope, _ = standby.recv_multipart()
+            standby.send_multipart(envelope + [pickle.dumps(reply)])
+    server = Thread(target=serve)
+    server.start()
+    connection = ServerConnection([f"tcp://127.0.0.1:{primary_port}",
+                                   f"tcp://127.0.0.1:{standby_port}"],
+                                  timeout=0.2, retries=1, backoff=0.01)
+    connection.connect()
+    assert connection.get_batch_name("CODE") == "NAME"
+    assert connection.failovers == 1
+    assert connection.address == f"tcp://127.0.0.1:{standby_port}"
+    server.join()
+    primary.close(linger=0)
+    standby.close(linger=0)
+
+
+def test_no_failover_to_standby_not_promoted() -> None:
+    context = zmq.Context()
+    # pylint: disable=E1101
+    primary = context.socket(zmq.ROUTER)
+    primary_port = primary.bind_to_random_port("tcp://127.0.0.1")
+    standby = context.socket(zmq.ROUTER)
+    standby_port = standby.bind_to_random_port("tcp://127.0.0.1")
+    def serve() -> None:
+        for _ in range(2):
+            *envelope, _ = standby.recv_multipart()
+            standby.send_multipart(
+                envelope + [pickle.dumps(ServerInfoResponse(60.0, STANDBY))])
+    server = Thread(target=serve)
+    server.start()
+    connection = ServerConnection([f"tcp://127.0.0.1:{primary_port}",
+                                   f"tcp://127.0.0.1:{standby_port}"],
+                                  timeout=0.2, retries=1, backoff=0.01)
+    connection.connect()
+    try:
+        connection.get_batch_name("CODE")
+    except ServerTimeoutError:
+        pass
+    else:
+        assert False, "expected ServerTimeoutError"
+    assert connection.failovers == 0
+    assert connection.address == f"tcp://127.0.0.1:{primary_port}"
+    server.join()
+    primary.close(linger=0)
+    standby.close(linger=0)
+
+# vim: tw=80 sw=4 ts=4 expandtab:
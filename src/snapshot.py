@@ -0,0 +1,144 @@
+# Copyright (C) 2018 Metatavu Oy
+# 
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+# 
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sqlite3
+import time
+from logging import error
+from threading import Event, Lock, Thread
+from typing import Any, Callable, Optional
+
+from sqlalchemy import create_engine
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session, sessionmaker
+from sqlalchemy.pool import NullPool
+
+from stats import Stats
+
+
+class StaleSnapshotError(Exception):
+    pass
+
+
+class Snapshot:
+    """Read-only copy of a SQLite database for reporting.
+
+    The copy is made with the SQLite backup API in a single read
+    transaction, so it is consistent, and with the source in WAL mode the
+    writers of the source are not blocked while it is made. Reports then
+    read the copy without taking any lock on the source.
+
+    The copy is refreshed every `refresh_interval` seconds by the thread
+    run by `start`. Copying never happens on the caller's thread: if the
+    copy is older than `max_staleness` seconds, `session` wakes the
+    refresher and raises StaleSnapshotError, so no report sees data staler
+    than that and the server is never held up by a copy.
+    """
+    _clock: Callable[[], float]
+    _refreshed: Optional[float]
+    _lock: Lock
+    _stopping: Event
+    _wake: Event
+    _refresher: Optional[Thread]
+    stats: Stats
+
+    def __init__(self,
+                 source: Engine,
+                 path: str,
+                 refresh_interval: float = 60.0,
+                 max_staleness: float = 300.0,
+                 clock: Callable[[], float] = time.monotonic) -> None:
+        self.source = source
+        self.path = path
+        self.refresh_interval = refresh_interval
+        self.max_staleness = max_staleness
+        self._clock = clock
+        self._refreshed = None
+        self._lock = Lock()
+        self._stopping = Event()
+        self._wake = Event()
+        self._refresher = None
+        self.stats = Stats()
+        if source.url.database not in (None, "", ":memory:"):
+            source.execute("PRAGMA journal_mode=WAL")
+        # Every session opens the file anew, so it reads the latest copy.
+        self.engine = create_engine("sqlite://",
+                                    creator=self._connect,
+                                    poolclass=NullPool)
+        self.make_session = sessionmaker(bind=self.engine)
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(f"file:{self.path}?mode=ro", uri=True)
+
+    def age(self) -> float:
+        """Seconds since the data in the copy was current."""
+        if self._refreshed is None:
+            return float("inf")
+        return self._clock() - self._refreshed
+
+    def refresh(self) -> None:
+        with self._lock:
+            began = self._clock()
+            copying = self.path + ".tmp"
+            source: Any = self.source.raw_connection()
+            try:
+                target = sqlite3.connect(copying)
+                try:
+                    source.connection.backup(target)
+                finally:
+                    target.close()
+            finally:
+                source.close()
+            os.replace(copying, self.path)
+            self._refreshed = began
+            self.stats.observe("refresh_seconds", self._clock() - began)
+
+    def session(self) -> Session:
+        age = self.age()
+        if age > self.max_staleness:
+            self._wake.set()
+            raise StaleSnapshotError(
+                f"The reporting snapshot is {age:.0f} s old, more than " +
+                f"{self.max_staleness:.0f} s; it is being refreshed, " +
+                "try again shortly")
+        sess = self.make_session()
+        assert isinstance(sess, Session)
+        return sess
+
+    def _refresh_process(self) -> None:
+        while True:
+            self._wake.wait(self.refresh_interval)
+            self._wake.clear()
+            if self._stopping.is_set():
+                return
+            try:
+                self.refresh()
+            except Exception as e:
+                self.stats.incr("refresh_failures")
+                error(f"Refreshing the reporting snapshot failed: {e!r}")
+
+    def start(self) -> None:
+        self.refresh()
+        self._refresher = Thread(target=self._refresh_process, daemon=True)
+        self._refresher.start()
+
+    def stop(self) -> None:
+        if self._refresher is not None:
+            self._stopping.set()
+            self._wake.set()
+            self._refresher.join()
+            self._refresher = None
+
+# vim: tw=80 sw=4 ts=4 expandtab:
@@ -0,0 +1,65 @@
+# Copyright (C) 2018 Metatavu Oy
+# 
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+# 
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import time
+from datetime import datetime
+from pathlib import Path
+
+import pytest
+
+import server as server_module
+from message import *
+from server import Server, init_lite
+from snapshot import Snapshot, StaleSnapshotError
+
+
+class FakeClock:
+    def __init__(self) -> None:
+        self.time = 0.0
+
+    def __call__(self) -> float:
+        return self.time
+
+
+def test_reports_read_snapshot_within_staleness(tmp_path: Path) -> None:
+    server_module.now = lambda: datetime(2000, 1, 1, 12, 0, 0)
+    engine = init_lite(f"sqlite:///{tmp_path / 'reifer.db'}")
+    clock = FakeClock()
+    snapshot = Snapshot(engine, str(tmp_path / "report.db"),
+                        refresh_interval=60.0, max_staleness=10.0,
+                        clock=clock)
+    server = Server(engine, snapshot=snapshot)
+    server.execute(BatchAssociationRequest("CODE", "NAME"))
+    server.execute(StartWorkRequest("WS", "CODE",
+                                    datetime(2000, 1, 1, 8, 0, 0)))
+    server.execute(StopWorkRequest("WS", datetime(2000, 1, 1, 9, 0, 0)))
+    snapshot.start()
+    report = WorkReportRequest(datetime(2000, 1, 1), datetime(2000, 1, 2))
+    assert server.execute(report).rows == [("WS", "NAME", 3600.0)]
+    server.execute(StartWorkRequest("WS", "CODE",
+                                    datetime(2000, 1, 1, 10, 0, 0)))
+    clock.time = 10.0
+    assert server.execute(report).rows == [("WS", "NAME", 3600.0)]
+    clock.time = 10.5
+    # Too stale: refused at once, and refreshed in the background.
+    with pytest.raises(StaleSnapshotError):
+        server.execute(report)
+    deadline = time.monotonic() + 5.0
+    while snapshot.age() != 0.0 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert server.execute(report).rows == [("WS", "NAME", 3600.0 + 7200.0)]
+    snapshot.stop()
+
+# vim: tw=80 sw=4 ts=4 expandtab:
@@ -0,0 +1,103 @@
+# Copyright (C) 2018 Metatavu Oy
+# 
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+# 
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import os
+from bisect import bisect_left
+from threading import Lock
+from typing import Any, Dict, List, Optional, Sequence
+
+# Bucket upper bounds in seconds, from 10 µs to 10 s.
+DEFAULT_BOUNDS: List[float] = [
+    base * 10.0 ** exponent
+    for exponent in range(-5, 1)
+    for base in (1.0, 2.5, 5.0)
+] + [10.0]
+
+
+class Histogram:
+    """Counts observations into fixed buckets, without allocating."""
+    bounds: List[float]
+    counts: List[int]
+    count: int
+    total: float
+    maximum: float
+
+    def __init__(self, bounds: Optional[Sequence[float]] = None) -> None:
+        self.bounds = list(DEFAULT_BOUNDS if bounds is None else bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.maximum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.maximum:
+            self.maximum = value
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count else 0.0,
+            "max": self.maximum,
+            "bounds": self.bounds,
+            "counts": list(self.counts)
+        }
+
+
+class Stats:
+    """Named counters and histograms of one component.
+
+    Updates may come from any thread.
+    """
+    _lock: Lock
+    _counters: Dict[str, int]
+    _histograms: Dict[str, Histogram]
+
+    def __init__(self) -> None:
+        self._lock = Lock()
+        self._counters = {}
+        self._histograms = {}
+
+    def incr(self, name: str, n: int = 1) -> None:
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + n
+
+    def observe(self, name: str, value: float) -> None:
+        with self._lock:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                histogram = self._histograms[name] = Histogram()
+            histogram.observe(value)
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "counters": dict(self._counters),
+                "histograms": {name: histogram.snapshot()
+                               for name, histogram in self._histograms.items()}
+            }
+
+
+def write_stats(path: str, snapshot: Dict[str, Any]) -> None:
+    """Replaces `path` with `snapshot` as JSON, so readers never see half of it."""
+    temporary = path + ".tmp"
+    with open(temporary, "w") as f:
+        json.dump(snapshot, f, indent=1, sort_keys=True)
+    os.replace(temporary, path)
+
+# vim: tw=80 sw=4 ts=4 expandtab:
@@ -0,0 +1,45 @@
+# Copyright (C) 2018 Metatavu Oy
+# 
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+# 
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+from typing import Any
+
+from stats import Histogram, Stats, write_stats
+
+
+def test_histogram_buckets() -> None:
+    histogram = Histogram([1.0, 2.0])
+    for value in (0.5, 1.0, 1.5, 3.0):
+        histogram.observe(value)
+    snapshot = histogram.snapshot()
+    assert snapshot["counts"] == [2, 1, 1]
+    assert snapshot["count"] == 4
+    assert snapshot["mean"] == 1.5
+    assert snapshot["max"] == 3.0
+
+
+def test_write_stats(tmpdir: Any) -> None:
+    stats = Stats()
+    stats.incr("timeouts")
+    stats.incr("timeouts", 2)
+    stats.observe("round_trip", 0.003)
+    path = str(tmpdir.join("stats.json"))
+    write_stats(path, {"server": stats.snapshot()})
+    with open(path) as f:
+        written = json.load(f)
+    assert written["server"]["counters"] == {"timeouts": 3}
+    assert written["server"]["histograms"]["round_trip"]["count"] == 1
+
+# vim: tw=80 sw=4 ts=4 expandtab:
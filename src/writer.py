@@ -0,0 +1,181 @@
+# Copyright (C) 2018 Metatavu Oy
+# 
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+# 
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import time
+from concurrent.futures import Future
+from logging import error
+from queue import Empty, Queue
+from threading import Lock, Thread
+from typing import Any, Callable, List, NamedTuple, Optional
+
+from sqlalchemy.orm import Session
+
+from stats import Stats
+
+
+class _Command(NamedTuple):
+    apply: Callable[[Session], Any]
+    future: 'Future[Any]'
+    queued: float
+
+
+class Writer:
+    """The one thread that writes to the database.
+
+    Writes are commands, callables that are given a session, and are
+    applied in the order they were submitted. Commands that are waiting
+    together are applied in one transaction, up to `batch_size` at a time,
+    to save a commit per command. If a batch fails, its commands are
+    retried one per transaction, so that a bad command fails alone.
+
+    Until the thread is started, commands are applied at once on the
+    calling thread. An in-memory SQLite database is private to the thread
+    using it, so it can only be written that way.
+    """
+    _make_session: Callable[..., Session]
+    _queue: 'Queue[Optional[_Command]]'
+    _thread: Optional[Thread]
+    _died: Optional[BaseException]
+    _died_lock: Lock
+    stats: Stats
+
+    def __init__(self,
+                 make_session: Callable[..., Session],
+                 batch_size: int = 100) -> None:
+        self._make_session = make_session
+        self.batch_size = batch_size
+        self._queue = Queue()
+        self._thread = None
+        self._died = None
+        self._died_lock = Lock()
+        self.stats = Stats()
+
+    def start(self) -> None:
+        if self._thread is not None:
+            return
+        self._thread = Thread(target=self._write_process, daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Applies the commands submitted so far and stops the thread."""
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+    def submit(self, apply: Callable[[Session], Any]) -> 'Future[Any]':
+        """Queues a command and returns a future for its result.
+
+        The future is resolved once the transaction is committed.
+        """
+        command = _Command(apply, Future(), time.perf_counter())
+        if self._thread is None:
+            self._commit([command])
+            return command.future
+        with self._died_lock:
+            if self._died is None:
+                self._queue.put(command)
+                return command.future
+        command.future.set_exception(
+            RuntimeError(f"Database writer died: {self._died!r}"))
+        return command.future
+
+    def write(self, apply: Callable[[Session], Any]) -> Any:
+        """Applies a command and waits for its result."""
+        return self.submit(apply).result()
+
+    def _write_process(self) -> None:
+        try:
+            self._write_batches()
+        except BaseException as e:
+            # Nothing is left waiting for a thread that is gone: commands
+            # still queued fail now, and later ones fail when submitted.
+            error(f"Database writer died: {e!r}")
+            with self._died_lock:
+                self._died = e
+            while True:
+                try:
+                    command = self._queue.get_nowait()
+                except Empty:
+                    break
+                if command is not None:
+                    command.future.set_exception(
+                        RuntimeError(f"Database writer died: {e!r}"))
+
+    def _write_batches(self) -> None:
+        while True:
+            command = self._queue.get()
+            if command is None:
+                return
+            batch = [command]
+            stopping = False
+            while len(batch) < self.batch_size:
+                try:
+                    command = self._queue.get_nowait()
+                except Empty:
+                    break
+                if command is None:
+                    stopping = True
+                    break
+                batch.append(command)
+            began = time.perf_counter()
+            try:
+                for command in batch:
+                    self.stats.observe("queue_seconds",
+                                       began - command.queued)
+                self._commit(batch)
+            except BaseException as e:
+                for command in batch:
+                    if not command.future.done():
+                        command.future.set_exception(e)
+                if not isinstance(e, Exception):
+                    raise
+                error(f"Database writer failed a batch: {e!r}")
+            if stopping:
+                return
+
+    def _commit(self, batch: List[_Command]) -> None:
+        began = time.perf_counter()
+        try:
+            results = self._transaction(batch)
+        except Exception as e:
+            if len(batch) == 1:
+                batch[0].future.set_exception(e)
+                return
+            self.stats.incr("failed_batches")
+            for command in batch:
+                self._commit([command])
+            return
+        self.stats.incr("commits")
+        self.stats.incr("commands", len(batch))
+        self.stats.observe("commit_seconds", time.perf_counter() - began)
+        for command, result in zip(batch, results):
+            command.future.set_result(result)
+
+    def _transaction(self, batch: List[_Command]) -> List[Any]:
+        # Results are used after the session is closed, so they are not
+        # expired on commit.
+        sess = self._make_session(expire_on_commit=False)
+        try:
+            results = [command.apply(sess) for command in batch]
+            sess.commit()
+            return results
+        except Exception:
+            sess.rollback()
+            raise
+        finally:
+            sess.close()
+
+# vim: tw=80 sw=4 ts=4 expandtab:
@@ -0,0 +1,104 @@
+# Copyright (C) 2018 Metatavu Oy
+# 
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+# 
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from pathlib import Path
+from threading import Event
+from typing import Callable, List
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session, sessionmaker
+from sqlalchemy.sql import text
+
+from writer import Writer
+
+
+def make_writer(tmp_path: Path) -> Writer:
+    engine = create_engine(f"sqlite:///{tmp_path / 'writer.db'}")
+    engine.execute("CREATE TABLE t (x INTEGER NOT NULL)")
+    return Writer(sessionmaker(bind=engine))
+
+
+def insert(x: object) -> Callable[[Session], int]:
+    def apply(sess: Session) -> int:
+        sess.execute(text("INSERT INTO t (x) VALUES (:x)"), dict(x=x))
+        return 1
+    return apply
+
+
+def block(writer: Writer, release: Event) -> None:
+    # Once the command runs, the writer has taken it off the queue alone.
+    started = Event()
+    def wait(sess: Session) -> None:
+        started.set()
+        release.wait()
+    writer.submit(wait)
+    started.wait()
+
+
+def values(writer: Writer) -> List[int]:
+    return [x for x, in writer.write(
+        lambda sess: sess.execute(text("SELECT x FROM t")).fetchall())]
+
+
+def test_waiting_commands_share_a_transaction(tmp_path: Path) -> None:
+    writer = make_writer(tmp_path)
+    writer.start()
+    release = Event()
+    block(writer, release)
+    futures = [writer.submit(insert(x)) for x in range(3)]
+    release.set()
+    assert [future.result() for future in futures] == [1, 1, 1]
+    writer.stop()
+    snapshot = writer.stats.snapshot()
+    assert snapshot["counters"]["commits"] == 2
+    assert snapshot["counters"]["commands"] == 4
+    assert values(writer) == [0, 1, 2]
+
+
+def test_failing_command_fails_alone(tmp_path: Path) -> None:
+    writer = make_writer(tmp_path)
+    writer.start()
+    release = Event()
+    block(writer, release)
+    good = writer.submit(insert(1))
+    bad = writer.submit(insert(None))
+    also_good = writer.submit(insert(2))
+    release.set()
+    writer.stop()
+    assert good.result() == 1 and also_good.result() == 1
+    assert bad.exception() is not None
+    assert writer.stats.snapshot()["counters"]["failed_batches"] == 1
+    assert values(writer) == [1, 2]
+
+
+def test_dead_writer_fails_commands_instead_of_hanging(
+        tmp_path: Path) -> None:
+    class Fatal(BaseException):
+        pass
+    def die(sess: Session) -> None:
+        raise Fatal()
+    writer = make_writer(tmp_path)
+    writer.start()
+    release = Event()
+    block(writer, release)
+    fatal = writer.submit(die)
+    queued = writer.submit(insert(1))
+    release.set()
+    assert isinstance(fatal.exception(5), Fatal)
+    assert queued.exception(5) is not None
+    later = writer.submit(insert(2))
+    assert isinstance(later.exception(5), RuntimeError)
+
+# vim: tw=80 sw=4 ts=4 expandtab: